@@ -0,0 +1,173 @@
+#!/usr/bin/python
+#
+# beamline.py - description of the electron beamline upstream of the Hall D
+#               radiator for the harp tools: the harp monitors with their s
+#               positions and default errors, the primary collimator, the
+#               nominal emittances, and the focusing elements between them,
+#               read from the config file beamline.json.
+#
+# The transverse coordinates are (x, x', y, y') in mm and mrad, with s in
+# m, so a drift of length L has x -> x + L x'. The transfer matrices from
+# the collimator to each monitor and to a grid of points for the plots are
+# computed once when the config is loaded and cached, so the fits only do
+# linear algebra on precomputed matrices, whatever the number of monitors.
+#
+# Elements in the config are listed as
+#    {"name": "MQA5C12", "type": "quad", "s": 125.0, "length": 0.3, "k1": 0.5}
+#    {"name": "XYZ", "type": "matrix", "s": 130.0, "matrix": [[...4x4...]]}
+# where s is the upstream end of the element, k1 (1/m**2) is positive for a
+# quadrupole focusing in x, and a "matrix" element is a thin element with
+# the given 4x4 transfer matrix.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import json
+import numpy
+import hashlib
+
+config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "beamline.json")
+loaded = {}
+
+def drift(length):
+   """
+   Transfer matrix of a field-free drift of length (m).
+   """
+   R = numpy.eye(4)
+   R[0,1] = length
+   R[2,3] = length
+   return R
+
+def quadrupole(length, k1):
+   """
+   Transfer matrix of a quadrupole of length (m) and strength k1 (1/m**2),
+   focusing in x for k1 > 0 and in y for k1 < 0.
+   """
+   R = numpy.eye(4)
+   for i, k in ((0, k1), (2, -k1)):
+      if k > 0:
+         w = k**0.5
+         R[i:i+2,i:i+2] = [[numpy.cos(w * length), numpy.sin(w * length) / w],
+                           [-w * numpy.sin(w * length), numpy.cos(w * length)]]
+      elif k < 0:
+         w = (-k)**0.5
+         R[i:i+2,i:i+2] = [[numpy.cosh(w * length), numpy.sinh(w * length) / w],
+                           [w * numpy.sinh(w * length), numpy.cosh(w * length)]]
+      else:
+         R[i,i+1] = length
+   return R
+
+class Beamline:
+   """
+   Monitors, collimator and optics of the beamline in a config, with a
+   cache of the transfer matrices between points along it.
+   """
+   def __init__(self, config):
+      self.monitors = config["monitors"]
+      self.collimator = float(config["collimator"]["s"])
+      self.emittance = config.get("emittance", {})
+      self.elements = sorted(config.get("elements", []), key=lambda e: e["s"])
+      self.cache = {}
+      self.digest = hashlib.sha1(json.dumps(config, sort_keys=True)
+                                 .encode("utf-8")).hexdigest()[:20]
+
+   def names(self):
+      return [monitor["name"] for monitor in self.monitors]
+
+   def has_optics(self):
+      """
+      True if there are focusing elements, so that the beam envelope is
+      not just the drift model of harpfit.envelope.
+      """
+      return len(self.elements) > 0
+
+   def defaults(self):
+      """
+      Default values of the harp tool form fields taken from the config.
+      """
+      values = {"collimator_spos": self.collimator}
+      for plane in self.emittance:
+         values["emittance_" + plane] = self.emittance[plane]
+      for monitor in self.monitors:
+         values[monitor["name"] + "_spos"] = monitor["s"]
+         for plane in monitor.get("sigma_err", {}):
+            values[monitor["name"] + "_" + plane + "sigma_err"] = monitor["sigma_err"][plane]
+      return values
+
+   def element_matrix(self, element, length):
+      """
+      Transfer matrix through length (m) of element.
+      """
+      kind = element.get("type", "drift")
+      if kind == "quad":
+         return quadrupole(length, float(element["k1"]))
+      elif kind == "matrix":
+         return numpy.array(element["matrix"], dtype=float)
+      elif kind == "drift":
+         return drift(length)
+      raise ValueError("unknown beamline element type " + repr(kind))
+
+   def forward(self, s0, s1):
+      """
+      Transfer matrix from s0 to s1 >= s0 (m) through the elements.
+      """
+      R = numpy.eye(4)
+      pos = s0
+      for element in self.elements:
+         start = float(element["s"])
+         end = start + float(element.get("length", 0))
+         if end > start and (start >= s1 or end <= s0):
+            continue
+         elif end == start and (start >= s1 or start < s0):
+            continue
+         a = max(start, s0)
+         b = min(end, s1)
+         R = self.element_matrix(element, b - a) @ drift(a - pos) @ R
+         pos = b
+      return drift(s1 - pos) @ R
+
+   def transport(self, s0, s1):
+      """
+      Transfer matrix from s0 to s1 (m) in either direction, cached.
+      """
+      key = (float(s0), float(s1))
+      if key not in self.cache:
+         if s1 >= s0:
+            self.cache[key] = self.forward(*key)
+         else:
+            self.cache[key] = numpy.linalg.inv(self.transport(s1, s0))
+      return self.cache[key]
+
+   def matrices(self, sref, spos):
+      """
+      Transfer matrices [n, 4, 4] from sref to each of the points spos[n].
+      """
+      return numpy.array([self.transport(sref, s) for s in spos]).reshape(-1, 4, 4)
+
+   def grid(self, slimits, npoints):
+      return numpy.linspace(slimits[0], slimits[1], npoints)
+
+   def precompute(self, slimits, npoints):
+      """
+      Fill the cache with the matrices from the collimator to the monitors
+      and to the plotting grid.
+      """
+      self.matrices(self.collimator, [monitor["s"] for monitor in self.monitors])
+      self.matrices(self.collimator, self.grid(slimits, npoints))
+
+def load(filename=None, slimits=(100, 200), npoints=101):
+   """
+   Return the Beamline for the config in filename (default beamline.json),
+   reading it and precomputing its transfer matrices only the first time
+   or when the file has changed since.
+   """
+   filename = filename or config_file
+   mtime = os.stat(filename).st_mtime
+   if filename not in loaded or loaded[filename][0] != mtime:
+      with open(filename) as f:
+         optics = Beamline(json.load(f))
+      optics.precompute(slimits, npoints)
+      loaded[filename] = (mtime, optics)
+   return loaded[filename][1]
@@ -0,0 +1,389 @@
+#!/usr/bin/python
+#
+# benchmark.py - timing and correctness benchmarks for the harp tools and
+#                the coherent bremsstrahlung spectrum calculation.
+#
+# usage: benchmark.py [-o RESULTS] [--baseline FILE] [--save-baseline FILE]
+#                     [--nbins N,N,...] [--repeat R] [--only PATTERN]
+#        benchmark.py --make-reference
+#
+# The harp benchmarks fit synthetic harp scans, generated from known beam
+# envelopes at the monitors of beamline.json, with the harptool.py x/y
+# envelope fits and the harptool_2d.py sigma matrix fit, and time the
+# confidence band and 2d ellipse calculations and the svg (and ROOT, if it
+# is installed) rendering of the plots separately from the fits. The page
+# benchmarks time the complete response of each tool to a simulated cgi
+# form submission, once with a new fit and once answered from the cache.
+# The spectrum benchmarks time the cobrems.py kernels dNcdx, dNidx,
+# acceptance and convol, and the whole cobrems.rates calculation, at each
+# of the --nbins binnings.
+#
+# Every benchmark is run --repeat times and the best and median times are
+# written as json to RESULTS, with the python, numpy and host details.
+# Given a --baseline file of earlier results, each time is compared with
+# it and the ones that are more than regression_factor slower are listed,
+# with exit status 1 if there are any. The results also record the
+# correctness checks: the harp fits must recover the envelopes that the
+# noiseless scans were made from, and the cobrems.py spectra must agree
+# with the reference spectra in benchmark_reference.json, which are made
+# with the fortran routines of work/cobrems.f by --make-reference.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import re
+import sys
+import json
+import time
+import glob
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+
+import numpy
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, basedir)
+import harpfit
+import harpcache
+import harpbatch
+import harptool
+import harptool_2d
+import beamline
+import cobrems
+import toolmetrics
+import harphistory
+
+reference_file = basedir + "/benchmark_reference.json"
+default_nbins = (100, 200, 1000, 4000)
+regression_factor = 1.25
+timing_floor = 2e-4
+
+# noise of the synthetic scans in units of the harp errors, small enough
+# that every harp measures a physical (real) beam ellipse
+scan_noise = 0.5
+
+# beam envelopes (focus s (m), focus sigma (mm)) of the synthetic scans
+truth = {"x": (185., 0.45), "y": (190., 0.35)}
+
+# cobrems setup of the spectrum benchmarks and reference spectra
+spectrum_setup = (12., 9., 250e-3, 2.5e-9, 20e-6, 76., 3.4e-3)
+
+def synthetic_fields(noise=0., seed=1):
+   """
+   Harp tool form fields for a scan of the beam envelopes in truth with
+   the emittances of beamline.json, measured at each monitor with its
+   default errors, and gaussian noise of noise times those errors.
+   """
+   optics = beamline.load(slimits=harptool_2d.slimits, npoints=harptool_2d.band_points)
+   fields = optics.defaults()
+   random = numpy.random.RandomState(seed)
+   for monitor in optics.monitors:
+      name = monitor["name"]
+      sigma = {}
+      for plane in "xy":
+         par = numpy.array(truth[plane] + (optics.emittance[plane],))
+         sigma[plane] = float(harpfit.envelope(numpy.array([monitor["s"]]), par)[0])
+      sigma["u"] = ((sigma["x"]**2 + sigma["y"]**2) / 2)**0.5
+      for plane in "xuy":
+         error = fields[name + "_" + plane + "sigma_err"]
+         fields[name + "_" + plane + "sigma"] = sigma[plane] + noise * error * random.normal()
+   return fields
+
+def query_string(fields, **extra):
+   values = dict(fields, **extra)
+   return "&".join("{0}={1}".format(key, values[key]) for key in values)
+
+def time_call(func, repeat):
+   """
+   Best and median wall time (s) of repeat calls of func.
+   """
+   times = []
+   for n in range(repeat):
+      start = time.perf_counter()
+      func()
+      times.append(time.perf_counter() - start)
+   return {"best": min(times), "median": float(numpy.median(times)), "repeat": repeat}
+
+def harp_benchmarks():
+   """
+   Generate (name, func) for the harp fit, band, ellipse and rendering
+   benchmarks, with the tool modules set up for the synthetic scan.
+   """
+   fields = synthetic_fields(noise=scan_noise)
+   optics = beamline.load(slimits=harptool_2d.slimits, npoints=harptool_2d.band_points)
+   harptool.form = harptool_2d.form = harpbatch.ScanForm(fields)
+   harptool.optics = harptool_2d.optics = optics
+   harptool.workdir = harptool_2d.workdir = basedir + "/work/"
+   harps1 = harptool.read_harps()[:6]
+   harps2 = harptool_2d.read_harps()[:9]
+   sigx, su, sigu, sigy = harps2[1], harps2[3], harps2[4], harps2[7]
+
+   yield "harp.fit_xy", lambda: harptool.fit_harps(*harps1)
+   yield "harp.fit_2d", lambda: harptool_2d.fit_harps(*harps2)
+   fits = harptool.fit_harps(*harps1)
+   yield "harp.bands_xy", lambda: harpfit.confidence_bands(fits, harptool.slimits,
+                                                           harptool.band_points)
+   planes = harptool_2d.fit_harps(*harps2).planes()
+   yield "harp.bands_2d", lambda: harpfit.confidence_bands(planes, harptool_2d.slimits,
+                                                           harptool_2d.band_points)
+   yield "harp.ellipses_2d", lambda: (harptool_2d.harp_ellipses(su, sigx, sigy, list(sigu)),
+                                      harptool_2d.collimator_ellipse())
+   yield "harp.curves_2d", lambda: harptool_2d.fit_curves(*harps2)
+   for render in ("svg", "root"):
+      if render == "root" and harptool.ROOT is None:
+         continue
+      fields["render"] = render
+      harptool.form = harptool_2d.form = harpbatch.ScanForm(fields)
+      harptool.fitname = harptool_2d.fitname = "benchmark"
+      harptool.fitimage = harptool_2d.fitimage = "benchmark.png"
+      yield ("harp.plot_xy_" + render,
+             lambda: harpcache.capture(harptool.fit_and_plot, *harps1))
+      yield ("harp.plot_2d_" + render,
+             lambda: harpcache.capture(harptool_2d.fit_and_plot_2d, *harps2))
+
+def page_benchmarks():
+   """
+   Generate (name, func) for the complete responses of the tools to a
+   simulated cgi form submission, with a new fit each time ("new") and
+   from the cache ("cached").
+   """
+   fields = synthetic_fields(noise=scan_noise)
+   count = [0]
+
+   def page(module, **extra):
+      environ = {"REQUEST_METHOD": "GET", "QUERY_STRING": query_string(fields, **extra)}
+      with contextlib.redirect_stdout(open(os.devnull, "w")):
+         module.main(environ, "benchmark")
+
+   def new_page(module):
+      # a different collimator position each time, so the cache is missed
+      count[0] += 1
+      page(module, fit=1, collimator_spos=fields["collimator_spos"] + count[0] * 1e-6)
+
+   for module in (harptool, harptool_2d):
+      name = "page." + module.__name__
+      yield name + "_form", lambda: page(module)
+      yield name + "_new", lambda: new_page(module)
+      yield name + "_cached", lambda: page(module, fit=1)
+   import ratetool
+   ratetool.use_queue = False
+   ratetool.surrogate_add = False
+   yield "page.ratetool_numpy", lambda: page(ratetool, run=1, engine="numpy")
+
+def spectrum_benchmarks(nbins_list):
+   """
+   Generate (name, func) for the cobrems.py kernels and the complete
+   rates calculation at each binning in nbins_list.
+   """
+   setup = cobrems.Setup(*spectrum_setup)
+   theta2 = numpy.linspace(0, 30, 10000)**2
+
+   def acceptance_table():
+      cobrems.acceptance_cache.clear()
+      setup.acceptance_table()
+
+   yield "cobrems.acceptance_table", acceptance_table
+   yield "cobrems.acceptance", lambda: setup.acceptance(theta2)
+   for nbins in nbins_list:
+      x = (numpy.arange(nbins) + 0.5) / nbins
+      spectrum = setup.dNcdx(x)
+
+      def convol_new(x=x, spectrum=spectrum):
+         cobrems.kernel_cache.clear()
+         setup.convol(x, spectrum)
+
+      yield "cobrems.dNcdx[{0}]".format(nbins), lambda x=x: setup.dNcdx(x)
+      yield "cobrems.dNidx[{0}]".format(nbins), lambda x=x: setup.dNidx(x)
+      yield "cobrems.convol[{0}]".format(nbins), lambda x=x, s=spectrum: setup.convol(x, s)
+      yield "cobrems.convol_new[{0}]".format(nbins), convol_new
+      yield "cobrems.rates[{0}]".format(nbins), lambda n=nbins: cobrems.rates(nbins=n)
+
+def harp_checks():
+   """
+   Fit the noiseless synthetic scans and return the largest deviations
+   of the fitted focus positions (m) and sigmas (mm), and of the sigmas
+   at the collimator (mm), from the envelopes they were made from.
+   """
+   fields = synthetic_fields()
+   optics = beamline.load(slimits=harptool_2d.slimits, npoints=harptool_2d.band_points)
+   harptool.form = harptool_2d.form = harpbatch.ScanForm(fields)
+   harptool.optics = harptool_2d.optics = optics
+   fits = harptool.fit_harps(*harptool.read_harps()[:6])
+   planes = harptool_2d.fit_harps(*harptool_2d.read_harps()[:9]).planes()
+   ds0 = dsigma0 = dcol = 0
+   scol = numpy.array([optics.collimator])
+   for plane, fit1, fit2 in zip("xy", fits, (planes[0], planes[2])):
+      par = numpy.array(truth[plane] + (optics.emittance[plane],))
+      for fit in (fit1, fit2):
+         ds0 = max(ds0, abs(fit.par[0] - par[0]))
+         dsigma0 = max(dsigma0, abs(fit.par[1] - par[1]))
+         dcol = max(dcol, abs(harpfit.envelope(scol, fit.par)[0] -
+                              harpfit.envelope(scol, par)[0]))
+   return {"s0": float(ds0), "sigma0": float(dsigma0), "sigma_collimator": float(dcol),
+           "pass": bool(ds0 < 1e-3 and dsigma0 < 1e-5 and dcol < 1e-5)}
+
+def spectrum_checks():
+   """
+   Compare the cobrems.py spectra with the reference spectra, returning
+   the largest relative deviation of each and whether it is within its
+   tolerance. The incoherent spectrum is compared both with the 50-point
+   rule of cobrems.f and with the adaptive integration, which is more
+   accurate than the reference by up to a few 1e-4.
+   """
+   if not os.path.exists(reference_file):
+      return {"error": "no reference spectra, see --make-reference"}
+   with open(reference_file) as f:
+      ref = json.load(f)
+   setup = cobrems.Setup(*ref["setup"])
+   x = numpy.array(ref["x"])
+   computed = {"dNcdx": (setup.dNcdx(x, 0), 1e-4),
+               "dNcdx_linear": (setup.dNcdx(x, 1), 1e-4),
+               "dNidx_niter50": (setup.dNidx(x, 0, niter=50), 1e-4),
+               "dNidx": (setup.dNidx(x, 0), 1e-3),
+               "convol": (setup.convol(numpy.array(ref["convol_x"]),
+                                       numpy.array(ref["convol_input"])), 1e-4)}
+   checks = {}
+   for name, (y, tol) in computed.items():
+      yref = numpy.array(ref[name.replace("_niter50", "")])
+      scale = numpy.max(numpy.abs(yref))
+      deviation = float(numpy.max(numpy.abs(y - yref)) / scale)
+      checks[name] = {"deviation": deviation, "tolerance": tol, "pass": deviation <= tol}
+   return checks
+
+def make_reference():
+   """
+   Compute the reference spectra for spectrum_checks with the fortran
+   routines of work/cobrems.f and write them to reference_file.
+   """
+   import ctypes
+   import ratetool
+   lib = ratetool.fortran_library()
+   if lib is None:
+      raise RuntimeError("the fortran library of work/cobrems.f cannot be built")
+   x = (numpy.arange(60) + 0.5) / 60
+   ref = {"source": "work/cobrems.f", "setup": spectrum_setup, "x": list(x)}
+   nbins = 200
+   xc = (numpy.arange(nbins) + 0.5) / nbins
+   spectrum = cobrems.Setup(*spectrum_setup).dNcdx(xc)
+
+   def setup(polar):
+      args = [ctypes.c_float(a) for a in spectrum_setup]
+      lib.cobrems_(*args, ctypes.c_int(polar), ctypes.c_float(0), ctypes.c_float(2e-5))
+
+   sys.stdout.flush()
+   stdout = os.dup(1)
+   with open(os.devnull, "w") as devnull:
+      os.dup2(devnull.fileno(), 1)
+      try:
+         for name, polar, func in (("dNcdx", 0, lib.dncdx_),
+                                   ("dNcdx_linear", 1, lib.dncdx_),
+                                   ("dNidx", 0, lib.dnidx_)):
+            setup(polar)
+            ref[name] = [float(func(ctypes.c_float(xi))) for xi in x]
+         setup(0)
+         for i in range(nbins):
+            lib.hisx[i] = xc[i]
+            lib.hisy[i] = spectrum[i]
+         lib.convol_(ctypes.c_int(nbins))
+      finally:
+         os.dup2(stdout, 1)
+         os.close(stdout)
+   ref.update(convol_x=list(xc), convol_input=[float(y) for y in spectrum],
+              convol=[float(y) for y in lib.hisy[:nbins]])
+   with open(reference_file, "w") as f:
+      json.dump(ref, f, indent=0)
+
+def compare(results, baseline):
+   """
+   Benchmarks whose best time in results is more than regression_factor
+   times that in baseline, as a list of (name, ratio). Differences below
+   timing_floor (s) are ignored as timer noise.
+   """
+   slower = []
+   for name, timing in results["timings"].items():
+      if name in baseline["timings"]:
+         ratio = timing["best"] / baseline["timings"][name]["best"]
+         if timing["best"] > regression_factor * baseline["timings"][name]["best"] + timing_floor:
+            slower.append((name, ratio))
+   return slower
+
+def cleanup(workdir):
+   """
+   Remove the files that the page benchmarks left in workdir.
+   """
+   for name in glob.glob(workdir + "cobrems_benchmark.*"):
+      os.remove(name)
+   for name in glob.glob(workdir + "harp-*benchmark*"):
+      os.remove(name)
+
+def run(nbins_list, repeat, only=None):
+   """
+   Run the benchmarks and checks, returning the results document.
+   """
+   results = {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "host": socket.gethostname(), "python": platform.python_version(),
+              "numpy": numpy.__version__, "root": harptool.ROOT is not None,
+              "timings": {}}
+   workdir = basedir + "/work/"
+   before = set(os.listdir(workdir))
+   # keep the timings and fits of the benchmark pages out of the tool
+   # metrics and the fit history
+   toolmetrics.metricsdir = tempfile.mkdtemp() + "/"
+   harphistory.historydir = tempfile.mkdtemp() + "/"
+   try:
+      for group in (harp_benchmarks(), page_benchmarks(), spectrum_benchmarks(nbins_list)):
+         for name, func in group:
+            if only and not re.search(only, name):
+               continue
+            func()
+            results["timings"][name] = time_call(func, repeat)
+            sys.stderr.write("{0:32s} {1:10.3f} ms\n".format(name, 1e3 * results["timings"][name]["best"]))
+   finally:
+      shutil.rmtree(toolmetrics.metricsdir)
+      shutil.rmtree(harphistory.historydir)
+      cleanup(workdir)
+      # the fits of the page benchmarks are new cache entries, remove them too
+      for name in set(os.listdir(workdir)) - before:
+         if name.startswith("harp-"):
+            os.remove(workdir + name)
+   results["checks"] = {"harp": harp_checks(), "spectra": spectrum_checks()}
+   return results
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="harp tool and cobrems benchmarks")
+   parser.add_argument("-o", "--output", default="benchmark.json", help="results file")
+   parser.add_argument("--baseline", help="earlier results to compare with")
+   parser.add_argument("--save-baseline", metavar="FILE", help="also save the results as a baseline")
+   parser.add_argument("--nbins", default=",".join(str(n) for n in default_nbins),
+                       help="binnings of the spectrum benchmarks")
+   parser.add_argument("--repeat", type=int, default=5, help="runs of each benchmark")
+   parser.add_argument("--only", metavar="PATTERN", help="run only the benchmarks matching PATTERN")
+   parser.add_argument("--make-reference", action="store_true",
+                       help="make the reference spectra from work/cobrems.f")
+   args = parser.parse_args()
+   if args.make_reference:
+      make_reference()
+      sys.exit(0)
+   results = run([int(n) for n in args.nbins.split(",")], args.repeat, args.only)
+   for filename in (args.output, args.save_baseline):
+      if filename:
+         with open(filename, "w") as f:
+            json.dump(results, f, indent=1)
+   failed = [name for group in results["checks"].values() for name, check in
+             (group.items() if "pass" not in group else [("harp", group)])
+             if isinstance(check, dict) and not check.get("pass", False)]
+   for name in failed:
+      sys.stderr.write("benchmark: check {0} failed\n".format(name))
+   slower = []
+   if args.baseline:
+      with open(args.baseline) as f:
+         slower = compare(results, json.load(f))
+      for name, ratio in slower:
+         sys.stderr.write("benchmark: {0} is {1:.2f} times slower than the baseline\n"
+                          .format(name, ratio))
+   sys.exit(1 if slower or failed else 0)
@@ -0,0 +1,754 @@
+#!/usr/bin/python
+#
+# cobrems.py - numpy engine for the coherent bremsstrahlung spectrum from
+#              a diamond radiator, following the calculation in cobrems.f
+#              that is run by the ratetool paw macros, for use from the
+#              python tools.
+#
+# The formalism is that described in the following paper.
+#  W. Kaune, G. Miller, W. Oliver, R.W. Williams, and K.K. Young,
+#   "Inclusive cross sections for pion and proton production by photons
+#    using collimated coherent bremsstrahlung", Phys Rev D, vol 11,
+#    no 3 (1975) pp. 478-494.
+#
+# Where cobrems.f loops over the (h,k,l) reciprocal lattice vectors for
+# every x and phi, recomputing the structure factor, rotated q vector and
+# form factor of each one, here the table of allowed reflections with
+# these factors is built once for each crystal orientation and cached,
+# and the coherent spectrum is summed over the table for all x and phi
+# points in one pass of array operations. The acceptance of a reflection
+# does not depend on phi, so it is evaluated once for all phi points,
+# and it is interpolated in a table that is computed once for each
+# collimator and beam setup, instead of being integrated at every call.
+# The smearing of the spectrum for the crystal mosaic spread and beam
+# divergence (convol) is a banded matrix, built once per binning and
+# beam setup and cached, with no limit on the number of bins.
+#
+# Units are as in cobrems.f: length in m; energy, momentum, mass in GeV;
+# angles in radians, with theta2 the square of the photon emission angle
+# in units of me/E.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import numpy
+
+me = 5.1099891e-4           # electron mass (GeV)
+alpha = 7.2973525698e-3     # fine structure constant
+hbarc = 1.973269718e-16     # Planck's constant * speed of light (GeV m)
+Z = 6                       # atomic number of diamond
+a = 3.56e-10                # dimension of diamond unit cell (m)
+Aphonon = 0.40e9            # phonon-free recoil constant (GeV**-2)
+betaFF = 111 * Z**(-1/3.) / me  # cutoff for atomic form-factor (/GeV)
+hmax, kmax, lmax = 4, 10, 10    # range of reciprocal lattice vectors summed
+
+# the 8 atoms of the diamond unit cell, in units of a
+ucell = numpy.array([[0, 0, 0], [0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0],
+                     [0.25, 0.25, 0.25], [0.25, 0.75, 0.75],
+                     [0.75, 0.25, 0.75], [0.75, 0.75, 0.25]])
+nsites = len(ucell)
+
+structure_cache = {}
+lattice_cache = {}
+max_lattices = 64
+kernel_cache = {}
+max_kernels = 8
+max_kernel_size = 2**22
+kernel_cutoff = 12          # smearing kernel is cut off at this many sigmas
+acceptance_cache = {}
+max_acceptances = 32
+acceptance_cutoff = 12      # acceptance is tabulated out to this many sigmas
+acceptance_points = 4000    # minimum number of steps in the acceptance table
+acceptance_density = 200    # minimum steps per sigma in the acceptance table
+incoherent_tolerance = 1e-5 # relative error goal of the incoherent integral
+incoherent_intervals = 64   # maximum number of intervals in the integral
+
+# 15-point Gauss-Kronrod rule on [-1, 1], with the embedded 7-point Gauss
+# rule on the odd nodes, from QUADPACK
+kronrod_nodes = numpy.array([0.991455371120812639, 0.949107912342758525,
+                             0.864864423359769073, 0.741531185599394440,
+                             0.586087235467691130, 0.405845151377397167,
+                             0.207784955007898468, 0.])
+kronrod_weights = numpy.array([0.022935322010529225, 0.063092092629978553,
+                               0.104790010322250184, 0.140653259715525919,
+                               0.169004726639267903, 0.190350578064785410,
+                               0.204432940075298892, 0.209482141084727828])
+gauss_weights = numpy.array([0., 0.129484966168869693, 0., 0.279705391489276668,
+                             0., 0.381830050505118945, 0., 0.417959183673469388])
+kronrod_nodes = numpy.concatenate((-kronrod_nodes[:-1], kronrod_nodes[::-1]))
+kronrod_weights = numpy.concatenate((kronrod_weights[:-1], kronrod_weights[::-1]))
+gauss_weights = numpy.concatenate((gauss_weights[:-1], gauss_weights[::-1]))
+
+def expint(x):
+   """
+   Exponential integral E1(x) for x > 0, as the CERNLIB function EXPINT,
+   from its power series for x <= 1 and the rational approximation of
+   Abramowitz and Stegun 5.1.56 (relative error < 2e-8) above that.
+   """
+   x = numpy.asarray(x, dtype=float)
+   xs = numpy.minimum(x, 1)
+   series = 0
+   for k in range(16, 0, -1):
+      series = xs * ((-1)**(k + 1) / (k * numpy.prod(numpy.arange(1., k + 1))) + series)
+   small = -0.5772156649015329 - numpy.log(xs) + series
+   xl = numpy.clip(x, 1, 700)
+   large = (numpy.exp(-xl) / xl *
+            ((((xl + 8.5733287401) * xl + 18.0590169730) * xl +
+              8.6347608925) * xl + 0.2677737343) /
+            ((((xl + 9.5733223454) * xl + 25.6329561486) * xl +
+              21.0996530827) * xl + 3.9584969228))
+   return numpy.where(x <= 1, small, large)
+
+def erfc(x):
+   """
+   Complementary error function, from the Chebyshev fit in Numerical
+   Recipes (relative error < 1.2e-7 everywhere).
+   """
+   x = numpy.asarray(x, dtype=float)
+   z = numpy.abs(x)
+   t = 1 / (1 + 0.5 * z)
+   poly = -1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277))
+   poly = -0.18628806 + t * (0.27886807 + t * poly)
+   poly = 1.00002368 + t * (0.37409196 + t * (0.09678418 + t * poly))
+   ans = t * numpy.exp(-z * z - 1.26551223 + t * poly)
+   return numpy.where(x >= 0, ans, 2 - ans)
+
+def erf(x):
+   return 1 - erfc(x)
+
+def rotmat(matrix, thx, thy, thz):
+   """
+   Return Rx(thx) Ry(thy) Rz(thz) matrix, with the rotations understood
+   in the passive sense, as the subroutine rotmat in cobrems.f.
+   """
+   cx, sx = numpy.cos(thx), numpy.sin(thx)
+   cy, sy = numpy.cos(thy), numpy.sin(thy)
+   cz, sz = numpy.cos(thz), numpy.sin(thz)
+   Rx = numpy.array([[1, 0, 0], [0, cx, sx], [0, -sx, cx]])
+   Ry = numpy.array([[cy, 0, -sy], [0, 1, 0], [sy, 0, cy]])
+   Rz = numpy.array([[cz, sz, 0], [-sz, cz, 0], [0, 0, 1]])
+   return Rx @ Ry @ Rz @ matrix
+
+def orientation(thx, thy):
+   """
+   Crystal -> lab rotation matrix for goniometer angles thx, thy (rad),
+   with the crystal (1,0,0) axis along the beam and (0,1,1) vertical
+   before the goniometer rotations.
+   """
+   rotate = rotmat(numpy.eye(3), 0, numpy.pi/2, 0)
+   rotate = rotmat(rotate, 0, 0, numpy.pi/4)
+   rotate = rotmat(rotate, -thx, 0, 0)
+   return rotmat(rotate, 0, -thy, 0)
+
+def structure_factors():
+   """
+   Miller indices hkl[n, 3] of the reciprocal lattice vectors summed over
+   in the coherent spectrum and the squared structure factors S2[n] of the
+   diamond unit cell for them, keeping only the allowed reflections. They
+   do not depend on the orientation and are computed only once.
+   """
+   key = (hmax, kmax, lmax)
+   if key in structure_cache:
+      return structure_cache[key]
+   h, k, l = numpy.meshgrid(numpy.arange(-hmax, hmax + 1),
+                            numpy.arange(-kmax, kmax + 1),
+                            numpy.arange(-lmax, lmax + 1), indexing="ij")
+   hkl = numpy.stack((h.ravel(), k.ravel(), l.ravel()), axis=-1)
+   qdota = 2 * numpy.pi * hkl @ ucell.T
+   S2 = numpy.sum(numpy.cos(qdota), axis=-1)**2 + numpy.sum(numpy.sin(qdota), axis=-1)**2
+   allowed = S2 >= 1e-4
+   structure_cache[key] = (hkl[allowed], S2[allowed])
+   return structure_cache[key]
+
+class Lattice:
+   """
+   Table of the allowed reflections contributing to the coherent spectrum
+   for one crystal orientation, those with a positive component q3 of the
+   reciprocal lattice vector along the beam.
+    q[n, 3] = reciprocal lattice vector in the lab frame (GeV)
+    weight[n] = qT2 S2 exp(-Aphonon q2) (FF betaFF**2)**2, the factors of
+                the coherent cross section that depend only on q
+   """
+   def __init__(self, thx, thy):
+      self.rotate = orientation(thx, thy)
+      hkl, S2 = structure_factors()
+      q = (2 * numpy.pi * hbarc / a) * hkl @ self.rotate.T
+      keep = q[:,2] > 0
+      self.hkl = hkl[keep]
+      self.S2 = S2[keep]
+      self.q = q[keep]
+      self.q2 = numpy.sum(self.q**2, axis=-1)
+      self.qT2 = self.q[:,0]**2 + self.q[:,1]**2
+      FF = 1 / (1 + self.q2 * betaFF**2)
+      self.weight = (self.qT2 * self.S2 * numpy.exp(-Aphonon * self.q2) *
+                     (FF * betaFF**2)**2)
+
+   def xmax(self, E):
+      """
+      Coherent edge x = k/E of each reflection for beam energy E (GeV).
+      """
+      y = 2 * E * self.q[:,2]
+      return y / (y + me**2)
+
+def lattice(thx, thy):
+   """
+   Return the Lattice for goniometer angles thx, thy (rad), building it
+   only the first time that orientation is used. The tables of the last
+   max_lattices orientations used are kept.
+   """
+   key = (float(thx), float(thy))
+   if key in lattice_cache:
+      lattice_cache[key] = lattice_cache.pop(key)
+   else:
+      lattice_cache[key] = Lattice(*key)
+      while len(lattice_cache) > max_lattices:
+         del lattice_cache[next(iter(lattice_cache))]
+   return lattice_cache[key]
+
+def smearing_widths(var0, varMS, alph, x0, x1, nbins):
+   """
+   Step c[j] (rad) in the crystal angle per bin of offset at each bin j
+   of the convol binning, and the half-width width[j] (bins) of the
+   smearing kernel there out to kernel_cutoff sigmas.
+   """
+   x = x0 + (x1 - x0) * (numpy.arange(nbins) + 0.5) / nbins
+   c = numpy.abs((x1 - x0) / nbins * alph / (x * (1 - x)))
+   cutoff = kernel_cutoff * (var0 + varMS)**0.5
+   with numpy.errstate(divide="ignore"):
+      width = numpy.minimum(numpy.ceil(cutoff / c), 2 * nbins).astype(int)
+   return c, width
+
+def smearing_blocks(var0, varMS, alph, x0, x1, nbins, chunk=2**20):
+   """
+   Banded smearing matrix of convol in cobrems.f for nbins bins between
+   x0 and x1, for a gaussian spread var0 (rad**2) in the crystal angle
+   alph (rad) folded with multiple scattering varMS (rad**2). Generates
+   the matrix in blocks of consecutive source bins j0 <= j < j1 as
+   (j0, j1, W, dest), with the weights W[j, m] moving the contents of bin
+   j to bin dest[j, m] = j - m (1-based, reflected at the low end, and
+   nbins+1 for weight that is dropped) for offsets |m| <= M covering the
+   kernel out to kernel_cutoff sigmas. M is chosen separately for each
+   block, which holds at most chunk weights, and each row of W is
+   normalized to unit sum, so every kernel value is computed only once.
+   """
+   j = numpy.arange(1, nbins + 1)
+   c, width = smearing_widths(var0, varMS, alph, x0, x1, nbins)
+   j0 = 0
+   while j0 < nbins:
+      size = numpy.arange(1, nbins - j0 + 1) * (2 * numpy.maximum.accumulate(width[j0:]) + 1)
+      j1 = j0 + max(int(numpy.searchsorted(size, chunk, side="right")), 1)
+      M = int(numpy.max(width[j0:j1]))
+      m = numpy.arange(-M, M + 1)
+      dalph = numpy.abs(c[j0:j1,None] * m)
+      if varMS / var0 > 1e-4:
+         term = (dalph / varMS * (erfc(dalph / (2 * var0)**0.5) -
+                                  erfc(dalph / (2 * (var0 + varMS))**0.5)) +
+                 (2 / numpy.pi)**0.5 / varMS *
+                 (numpy.exp(-dalph**2 / (2 * (var0 + varMS))) * (var0 + varMS)**0.5 -
+                  numpy.exp(-dalph**2 / (2 * var0)) * var0**0.5))
+      else:
+         term = numpy.exp(-dalph**2 / (2 * var0)) / (2 * numpy.pi * var0)**0.5
+      i = j[j0:j1,None] - m
+      term = numpy.where((i >= -nbins) & (i <= nbins), term, 0)
+      W = term / numpy.sum(term, axis=1, keepdims=True)
+      dest = numpy.minimum(numpy.where(i < 1, 1 - i, i), nbins + 1).astype(numpy.int32)
+      yield j0, j1, W, dest
+      j0 = j1
+
+def smearing(var0, varMS, alph, x0, x1, nbins):
+   """
+   Blocks of the smearing matrix for the arguments of smearing_blocks,
+   from the cache if they were already built. Matrices of up to
+   max_kernel_size weights are kept in the cache, dropping the oldest
+   beyond max_kernels of them; bigger ones are generated block by block
+   each time they are used, so that they never have to fit in memory.
+   """
+   key = (float(var0), float(varMS), float(alph), float(x0), float(x1), int(nbins))
+   if key in kernel_cache:
+      return kernel_cache[key]
+   width = smearing_widths(*key)[1]
+   if numpy.sum(2 * width + 1) > max_kernel_size:
+      return smearing_blocks(*key)
+   kernel_cache[key] = list(smearing_blocks(*key))
+   while len(kernel_cache) > max_kernels:
+      del kernel_cache[next(iter(kernel_cache))]
+   return kernel_cache[key]
+
+class Setup:
+   """
+   Beam, radiator and collimator parameters of a spectrum calculation, as
+   set up by the subroutine cobrems in cobrems.f, with the same arguments.
+    Emax = electron beam energy (GeV)
+    Epeak = desired position of the primary coherent edge (GeV)
+    ytilt = secondary tilt of the crystal about the y axis (rad)
+    emit = electron beam emittance (m.rad)
+    radt = thickness of the radiator (m)
+    dist = distance from radiator to collimator (m)
+    coldiam = collimator diameter (m)
+    polar = 0 for total flux, 1 for linear or 2 for circular polarized flux
+    epol = electron beam circular polarization (signed)
+    mos = crystal r.m.s. mosaic spread (rad)
+   """
+   def __init__(self, Emax, Epeak, ytilt, emit, radt, dist, coldiam,
+                polar=0, epol=0, mos=2e-5):
+      if Epeak >= Emax:
+         raise ValueError("coherent edge must be below the beam energy")
+      self.E = float(Emax)
+      self.Erms = 6.0e-4
+      self.emit = float(emit)
+      self.spot = 0.0005
+      self.D = float(dist)
+      self.t = float(radt)
+      self.collim = float(coldiam)
+      self.polarflux = int(polar)
+      self.ecircpolar = float(epol)
+      self.mospread = float(mos)
+      self.Epeak = float(Epeak)
+      # approximate calculation of angle from primary edge energy
+      qtotal = 9.8e-6
+      qlong = Epeak / (Emax - Epeak) * me**2 / (2 * Emax)
+      self.thx = -qlong / qtotal
+      self.thy = float(ytilt)
+      self.lattice = lattice(self.thx, self.thy)
+      # PDG formula for radiation length, converted to meters
+      c = alpha * Z
+      self.radlen = 1 / (4 * nsites * alpha**3 * (hbarc / (a * me))**2 / a *
+                         (Z**2 * (numpy.log(184.15 * Z**(-1/3.)) -
+                                  c**2 * (1 / (1 + c**2) + 0.20206 - 0.0369 * c**2 +
+                                          0.0083 * c**4 - 0.002 * c**6)) +
+                          Z * numpy.log(1194 * Z**(-2/3.))))
+
+   def sigma2MS(self, tt):
+      """
+      Mean square multiple-scattering angle (rad**2) in a radiator of
+      thickness tt (m), from the Moliere theory formula used in Geant3.
+      """
+      F = 0.98                  # probability cutoff in definition of sigma2MS
+      density = 3.534           # g/cm^3
+      chi2cc = (0.39612e-2)**2 * (Z * (Z + 1)) * (density / 12)
+      chi2c = chi2cc * (tt / self.E**2)
+      rBohr = 0.52917721e-10    # m
+      chi2alpha = (1.13 * (hbarc / (self.E * rBohr * 0.885))**2 *
+                   Z**(2/3.) * (1 + 3.34 * (alpha * Z)**2))
+      omega0 = chi2c / (1.167 * chi2alpha)
+      gnu = omega0 / (2 * (1 - F))
+      return abs(chi2c / (1 + F**2) * ((1 + gnu) / gnu * numpy.log(1 + gnu) - 1))
+
+   def polarization(self, x, theta2, phi, polar=None):
+      """
+      Linear polarization of the photons at x, theta2, phi for polar=1,
+      circular polarization for polar=2, or 1 for polar=0 (default is the
+      polar of the setup), from Eq. A4 of Kaune, Miller, et.al.
+      """
+      polar = self.polarflux if polar is None else polar
+      if polar == 0:
+         return 1
+      elif polar == 2:
+         paverage = 2 * (1 - x) / ((1 - x)**2 + 1)
+         return (1 - paverage**2)**0.5 * self.ecircpolar
+      cs2 = (numpy.cos(phi) * numpy.sin(phi))**2
+      Npara = (0.5 * (2 - x)**2 * (1 + theta2)**2 -
+               8 * theta2 * (1 - x) * numpy.cos(phi)**2 -
+               8 * theta2**2 * (1 - x) * cs2)
+      Nperp = 0.5 * x**2 * (1 + theta2)**2 + 8 * theta2**2 * (1 - x) * cs2
+      return (Npara - Nperp) / (Npara + Nperp)
+
+   def acceptance(self, theta2, collim=None):
+      """
+      Fraction of photons emitted at theta2 that pass a collimator of
+      diameter collim (default that of the setup), for a beam spot of
+      r.m.s. size spot and multiple scattering in the radiator,
+      interpolated in the acceptance table of the setup.
+      """
+      theta, acc = self.acceptance_table(collim)
+      return numpy.interp(numpy.asarray(theta2, dtype=float)**0.5, theta, acc, right=0)
+
+   def acceptance_table(self, collim=None):
+      """
+      Acceptance acc[n] tabulated at theta[n] (units of me/E) out to where
+      it vanishes, for a collimator of diameter collim (default that of the
+      setup) and the current beam and radiator setup. The table is computed
+      by acceptance_integral the first time a setup is used and cached on
+      (collim, D, E, spot, t), so that a change to any of them gets a new
+      table.
+      """
+      collim = self.collim if collim is None else float(collim)
+      key = (collim, self.D, self.E, self.spot, self.t)
+      if key not in acceptance_cache:
+         thetaC = collim / (2 * self.D) * (self.E / me)
+         sigma = (((self.spot / self.D)**2 + self.sigma2MS(self.t)) *
+                  (self.E / me)**2)**0.5
+         thmax = thetaC + acceptance_cutoff * sigma
+         npoints = int(max(acceptance_points, thmax / sigma * acceptance_density))
+         theta = numpy.linspace(0, thmax, npoints + 1)
+         acceptance_cache[key] = (theta, self.acceptance_integral(theta**2, collim))
+         while len(acceptance_cache) > max_acceptances:
+            del acceptance_cache[next(iter(acceptance_cache))]
+      return acceptance_cache[key]
+
+   def acceptance_integral(self, theta2, collim=None, niter=50):
+      """
+      Acceptance at theta2 for a collimator of diameter collim, integrated
+      numerically over the beam spot and multiple scattering distribution,
+      as in cobrems.f.
+      """
+      collim = self.collim if collim is None else collim
+      theta2 = numpy.asarray(theta2, dtype=float)
+      theta = theta2**0.5
+      thetaC = collim / (2 * self.D) * (self.E / me)
+      var0 = (self.spot / self.D * (self.E / me))**2
+      varMS = self.sigma2MS(self.t) * (self.E / me)**2
+
+      def pu(u2):
+         if varMS / var0 > 1e-4:
+            return (expint(u2 / (2 * (var0 + varMS))) - expint(u2 / (2 * var0))) / (2 * varMS)
+         return numpy.exp(-u2 / (2 * var0)) / (2 * var0)
+
+      full = (theta < thetaC) & ((thetaC - theta)**2 / (var0 + varMS) > 20)
+      inside = (theta < thetaC) & numpy.logical_not(full)
+      result = numpy.zeros(theta2.shape)
+      u1 = thetaC - theta[inside]
+      for it in range(niter):
+         u = u1 * (it + 0.5) / niter
+         result[inside] += pu(u**2) * 2 * u * u1 / niter
+      outer = numpy.logical_not(full)
+      th2 = theta2[outer]
+      u0 = numpy.abs(theta[outer] - thetaC)
+      u1 = theta[outer] + thetaC
+      for it in range(niter):
+         u = u0 + (u1 - u0) * (it + 0.5) / niter
+         u2 = u**2
+         result[outer] += (pu(u2) * 2 * u * (u1 - u0) / niter / numpy.pi *
+                           numpy.arctan2(numpy.maximum((th2 - (thetaC - u)**2) *
+                                                       ((thetaC + u)**2 - th2), 0)**0.5,
+                                         th2 - thetaC**2 + u2))
+      result[full] = 1
+      return result
+
+   def coherent(self, x, modes, nphi=2, chunk=1000000):
+      """
+      Coherent bremsstrahlung spectra dN/dx[m, n] at x[n] = k/E for the
+      modes[m] = (polar, collim) together, averaged over nphi points in
+      the photon azimuth and summed over the lattice table. The kinematics
+      of the reflections are computed once for all modes, the acceptance
+      once for each collimator diameter collim (m) and the polarization
+      once for each polar; chunk bounds the size of the x * reflection
+      arrays.
+      """
+      x = numpy.atleast_1d(numpy.asarray(x, dtype=float))
+      lat = self.lattice
+      xmax = lat.xmax(self.E)
+      sigma0 = (16 * numpy.pi * self.t * Z**2 * alpha**3 * self.E *
+                (hbarc / a**2) * (hbarc / a / me)**4)
+      phi = (numpy.arange(nphi) + 0.5) * numpy.pi / (2 * nphi)
+      result = numpy.zeros((len(modes), len(x)))
+      step = max(chunk // max(len(xmax), 1), 1)
+      for start in range(0, len(x), step):
+         xc = x[start:start + step, None]
+         hit = (xc <= xmax) & (xmax <= 1)
+         theta2 = numpy.where(hit, (1 - xc) * xmax / (xc * (1 - xmax)) - 1, 0)
+         term = sigma0 * lat.weight * ((1 - xc) / (xc * (1 + theta2))**2)
+         shape = ((1 + (1 - xc[..., None])**2) -
+                  8 * (theta2 / (1 + theta2)**2 * (1 - xc))[..., None] * numpy.cos(phi)**2)
+         acc = {}
+         phisum = {}
+         for polar, collim in modes:
+            if collim not in acc:
+               acc[collim] = numpy.zeros(theta2.shape)
+               acc[collim][hit] = self.acceptance(theta2[hit], collim)
+            if polar not in phisum:
+               phisum[polar] = numpy.sum(shape * self.polarization(xc[..., None],
+                                         theta2[..., None], phi, polar), axis=-1)
+         for m, (polar, collim) in enumerate(modes):
+            result[m, start:start + step] = (2 * numpy.pi / nphi *
+               numpy.sum(term * acc[collim] * phisum[polar], axis=-1))
+      return result
+
+   def coherent_edge(self, x, spectrum, xrange=None):
+      """
+      Position x = k/E of the primary coherent edge in spectrum[n] at the
+      bin centers x[n], found as the steepest drop in the spectrum, or in
+      the part of it between xrange = (xlow, xhigh) if given, and put
+      exactly at the kinematic limit xmax of the strongest reflection that
+      ends within a bin of that drop.
+      """
+      x = numpy.asarray(x, dtype=float)
+      drop = numpy.diff(spectrum)
+      if xrange is not None:
+         drop = numpy.where((x[1:] >= xrange[0]) & (x[:-1] <= xrange[1]), drop, numpy.inf)
+      j = int(numpy.argmin(drop))
+      xmax = self.lattice.xmax(self.E)
+      near = (xmax >= x[max(j - 1, 0)]) & (xmax <= x[min(j + 2, len(x) - 1)])
+      if not numpy.any(near):
+         return (x[j] + x[j + 1]) / 2
+      return float(xmax[numpy.argmax(numpy.where(near, self.lattice.weight, -1))])
+
+   def dNcdx(self, x, polar=None, nphi=2):
+      """
+      Coherent bremsstrahlung spectrum dN/dx at x = k/E, weighted by the
+      polarization for polar = 1 or 2 (default is the polar of the setup).
+      """
+      polar = self.polarflux if polar is None else polar
+      return self.coherent(x, [(polar, self.collim)], nphi)[0]
+
+   def incoherent_kernel(self, x, theta2):
+      """
+      Incoherent bremsstrahlung spectrum d2N/dx/dtheta2 for x[..., None]
+      and theta2[n] before the collimator acceptance.
+      """
+      delta = 1.02
+      zeta = numpy.log(1440 * Z**(-2/3.)) / numpy.log(183 * Z**(-1/3.))
+      x = x[..., None]
+      MSchiff = 1 / (((me * x) / (2 * self.E * (1 - x)))**2 +
+                     1 / (betaFF * me * (1 + theta2))**2)
+      return (2 * nsites * self.t * Z * (Z + zeta) * alpha**3 *
+              (hbarc / (a * me))**2 / (a * x) *
+              (((1 + (1 - x)**2) - 4 * theta2 * (1 - x) / (1 + theta2)**2) /
+               (1 + theta2)**2 * (numpy.log(MSchiff) - 2 * delta * Z / (Z + zeta)) +
+               16 * theta2 * (1 - x) / (1 + theta2)**4 -
+               (2 - x)**2 / (1 + theta2)**2))
+
+   def dNidxdt2(self, x, theta2, polar=None, collim=None):
+      """
+      Incoherent bremsstrahlung spectrum d2N/dx/dtheta2 for x[..., None]
+      and theta2[n] through a collimator of diameter collim (m).
+      """
+      polar = self.polarflux if polar is None else polar
+      result = self.incoherent_kernel(x, theta2) * self.acceptance(theta2, collim)
+      if polar == 2:
+         result = result * self.polarization(x[..., None], 0, 0, polar)
+      return result
+
+   def incoherent(self, x, modes, niter=None, tol=None):
+      """
+      Incoherent bremsstrahlung spectra dN/dx[m, n] at x[n] = k/E for the
+      modes[m] = (polar, collim) together, integrated over theta2 in
+      u = 1/(1+theta2) by adaptive Gauss-Kronrod quadrature to a relative
+      error tol (default incoherent_tolerance), or by the midpoint rule
+      with niter points as in cobrems.f if niter is given.
+      """
+      x = numpy.atleast_1d(numpy.asarray(x, dtype=float))
+      if niter is None:
+         result = self.incoherent_adaptive(x, modes, tol)
+      else:
+         result = self.incoherent_midpoint(x, modes, niter)
+      for m, (polar, collim) in enumerate(modes):
+         if polar == 2:
+            result[m] *= self.polarization(x, 0, 0, polar)
+      return numpy.where(x > 1, 0, result)
+
+   def incoherent_midpoint(self, x, modes, niter=50):
+      """
+      Integrals over theta2 of incoherent for the acceptance of each mode,
+      by the midpoint rule in u with niter points. The acceptance is the
+      same for all x, so it is looked up only once per collimator.
+      """
+      u = (numpy.arange(niter) + 0.5) / niter
+      theta2 = (1 - u) / u
+      kernel = self.incoherent_kernel(x, theta2) / u**2 / niter
+      result = numpy.zeros((len(modes), len(x)))
+      for m, (_, collim) in enumerate(modes):
+         result[m] = numpy.sum(kernel * self.acceptance(theta2, collim), axis=-1)
+      return result
+
+   def incoherent_adaptive(self, x, modes, tol=None):
+      """
+      Integrals over theta2 of incoherent for the acceptance of each mode,
+      by 15-point Gauss-Kronrod quadrature in u on a set of intervals that
+      is shared by all x and modes. The intervals start out split at the
+      collimator edges, and those whose Kronrod and Gauss estimates differ
+      by more than their share of tol times the integral for any x and
+      collimator are bisected, up to incoherent_intervals intervals.
+      """
+      tol = incoherent_tolerance if tol is None else tol
+      collims = sorted({collim for polar, collim in modes})
+      breaks = {0., 1.}
+      for collim in collims:
+         thetaC = collim / (2 * self.D) * (self.E / me)
+         breaks.add(1 / (1 + thetaC**2))
+      breaks = numpy.array(sorted(breaks))
+      lower, upper = breaks[:-1], breaks[1:]
+      total = numpy.zeros((len(collims), len(x)))
+      nintervals = len(lower)
+      while len(lower) > 0:
+         half = (upper - lower) / 2
+         u = (lower + upper)[:,None] / 2 + half[:,None] * kronrod_nodes
+         theta2 = (1 - u) / u
+         kernel = (self.incoherent_kernel(x, theta2.ravel()) /
+                   u.ravel()**2).reshape(len(x), len(lower), -1)
+         kronrod = numpy.empty((len(collims), len(x), len(lower)))
+         gauss = numpy.empty((len(collims), len(x), len(lower)))
+         for c, collim in enumerate(collims):
+            f = kernel * self.acceptance(theta2, collim)
+            kronrod[c] = f @ kronrod_weights * half
+            gauss[c] = f @ gauss_weights * half
+         estimate = total + numpy.sum(kronrod, axis=-1)
+         budget = tol * numpy.abs(estimate)[..., None] * (2 * half) + 1e-300
+         excess = numpy.max(numpy.abs(kronrod - gauss) / budget, axis=(0, 1))
+         bad = excess > 1
+         room = incoherent_intervals - nintervals
+         if numpy.sum(bad) > room:
+            bad[:] = False
+            bad[numpy.argsort(excess)[len(excess) - room:]] = room > 0
+         total += numpy.sum(kronrod[..., ~bad], axis=-1)
+         middle = (lower[bad] + upper[bad]) / 2
+         lower, upper = (numpy.concatenate((lower[bad], middle)),
+                         numpy.concatenate((middle, upper[bad])))
+         nintervals += numpy.sum(bad)
+      return total[[collims.index(collim) for polar, collim in modes]]
+
+   def dNidx(self, x, polar=None, niter=None):
+      """
+      Incoherent bremsstrahlung spectrum dN/dx at x = k/E, weighted by the
+      circular polarization for polar = 2.
+      """
+      polar = self.polarflux if polar is None else polar
+      return self.incoherent(x, [(polar, self.collim)], niter)[0]
+
+   def dNBidx(self, x):
+      """
+      Incoherent bremsstrahlung spectrum dN/dx at x = k/E integrated over
+      all angles without a collimator, from the closed form of Nucl. Instr.
+      Meth. 204 (1983) pp.299-310, as dNBidx in cobrems.f. It is some 15%
+      lower than dNidx with an open collimator and is kept as a cross check.
+      """
+      x = numpy.asarray(x, dtype=float)
+      AoverB2 = Aphonon / betaFF**2
+      Tfact = -(1 + AoverB2) * numpy.exp(AoverB2) * expint(AoverB2)
+      psiC1 = 2 * (2 * numpy.log(betaFF * me) + Tfact + 2)
+      psiC2 = psiC1 - 2/3.
+      zeta = numpy.log(1440 * Z**(-2/3.)) / numpy.log(183 * Z**(-1/3.))
+      return (nsites * self.t * Z * (Z + zeta) * alpha**3 * (hbarc / (a * me))**2 /
+              (a * x) * (psiC1 * (1 + (1 - x)**2) - psiC2 * (1 - x) * 2/3.))
+
+   def spectra(self, x, coldiam=0.1):
+      """
+      The four spectra dN/dx at x = k/E of a ratetool run, computed
+      together in one pass over the lattice table and the theta2 points:
+       "uncollimated" = total spectrum through a collimator of diameter
+                        coldiam (m), large enough to pass all photons
+       "linear" = coherent spectrum weighted by the linear polarization
+       "circular" = total spectrum weighted by the circular polarization
+       "total" = total spectrum through the collimator of the setup
+      """
+      modes = [(0, coldiam), (1, self.collim), (2, self.collim), (0, self.collim)]
+      coh = self.coherent(x, modes)
+      inc = self.incoherent(x, modes)
+      return {"uncollimated": coh[0] + inc[0],
+              "linear": coh[1],
+              "circular": coh[2] + inc[2],
+              "total": coh[3] + inc[3]}
+
+   def convol(self, hisx, hisy):
+      """
+      Spectrum hisy[..., nbins] in bins centered at x = hisx[nbins] smeared
+      for the crystal mosaic spread, beam divergence and multiple scattering
+      in the radiator, as by convol in cobrems.f. Several spectra with the
+      same binning can be smeared together.
+      """
+      hisx = numpy.asarray(hisx, dtype=float)
+      hisy = numpy.asarray(hisy, dtype=float)
+      nbins = len(hisx)
+      var0 = self.mospread**2 + (self.emit / self.spot)**2
+      varMS = self.sigma2MS(self.t)
+      # the characteristic angle inside the crystal that is dominantly
+      # responsible for the coherent photons is taken to be the smaller
+      # goniometer angle, but not below the mosaic spread -- BEWARE!!!
+      alph = min(abs(self.thx), abs(self.thy))
+      if alph == 0:
+         alph = max(abs(self.thx), abs(self.thy))
+      else:
+         alph = max(alph, self.mospread)
+      rows = hisy.reshape(-1, nbins)
+      result = numpy.zeros((len(rows), nbins + 2))
+      for j0, j1, W, dest in smearing(var0, varMS, alph, hisx[0], hisx[-1], nbins):
+         for n in range(len(rows)):
+            result[n] += numpy.bincount(dest.ravel(), (W * rows[n,j0:j1,None]).ravel(),
+                                        nbins + 2)
+      result = result[:,1:nbins + 1]
+      result = numpy.where(numpy.abs(result) > 1e-35, result, 0)
+      return result.reshape(hisy.shape)
+
+   def dNtdx(self, x, polar=None):
+      """
+      Total coherent + incoherent spectrum dN/dx at x = k/E.
+      """
+      return self.dNcdx(x, polar) + self.dNidx(x, polar)
+
+   def dNtdk(self, k, polar=None):
+      """
+      Total spectrum dN/dk at photon energy k (GeV).
+      """
+      return self.dNtdx(numpy.asarray(k) / self.E, polar) / self.E
+
+default_windows = {"tagged": (8.4, 9.0), "background": (0.1, 3.0),
+                   "endpoint": (10.7, 11.7)}
+
+def window_sum(edges, y, Elow, Ehigh):
+   """
+   Integral of the histogram y with bin edges from Elow to Ehigh, over the
+   whole bins that they fall in, as in the cobrems#sum macro.
+   """
+   width = (edges[-1] - edges[0]) / len(y)
+   i0 = max(int(numpy.floor((Elow + 1e-9 - edges[0]) / width)), 0)
+   i1 = min(int(numpy.floor((Ehigh - 1e-9 - edges[0]) / width)), len(y) - 1)
+   return float(numpy.sum(y[i0:i1 + 1]) * width)
+
+def ratio(num, den):
+   """
+   Bin by bin ratio of two histograms, 0 where den is 0 as for paw div.
+   """
+   return numpy.divide(num, den, out=numpy.zeros(len(num)), where=(den != 0))
+
+def rates(E0=12., Epeak=9., ytilt=250e-3, emit=2.5e-9, radt=20e-6, dist=76.,
+          coldiam=3.4e-3, epol=0., mos=2e-5, nbins=200, Emin=0., Emax=12.,
+          cur=2.2, windows=None, uncollimated=0.1):
+   """
+   Photon beam rate spectra of the four cobrems macro runs made by
+   ratetool (ids 100, 200, 250 and 300), with their ratios and window
+   sums, from a single setup, one pass over the lattice table and energy
+   grid, and one convol for all four. The arguments are those of the
+   cobrems macro, with windows a dict of name -> (Elow, Ehigh) (GeV) for
+   the sums (default default_windows) and uncollimated the collimator
+   diameter (m) of the uncollimated run. Returns a dict with
+    "edges" = photon energy bin edges (GeV)
+    "energy" = photon energy bin centers (GeV)
+    "rate" = rate spectra (/GeV/s) "uncollimated", "linear", "circular"
+             and "total", see Setup.spectra
+    "linear_polarization" = linear / total
+    "circular_polarization" = circular / total
+    "tagging_efficiency" = total / uncollimated
+    "sums" = for each spectrum, the rates (/s) in each window and the
+             "beam_power" (W) over the whole spectrum
+    "peak_polarization" = linear / total rate in the "tagged" window
+   """
+   setup = Setup(E0, Epeak, ytilt, emit, radt, dist, coldiam, 0, epol, mos)
+   edges = numpy.linspace(Emin, Emax, nbins + 1)
+   x = (edges[:-1] + edges[1:]) / 2 / E0
+   spectra = setup.spectra(x, uncollimated)
+   names = list(spectra)
+   hisy = setup.convol(x, numpy.array([spectra[name] for name in names]) * cur / 1.6e-13)
+   return rate_summary(edges, dict(zip(names, hisy / E0)), windows)
+
+def rate_summary(edges, rate, windows=None):
+   """
+   Complete a rates result from the photon energy bin edges (GeV) and the
+   dict rate of the four rate spectra (/GeV/s), adding the ratios and the
+   window sums as described in rates.
+   """
+   windows = default_windows if windows is None else windows
+   energy = (edges[:-1] + edges[1:]) / 2
+   result = {"edges": edges, "energy": energy, "rate": rate, "sums": {}}
+   for name, y in rate.items():
+      sums = {}
+      for window in windows:
+         sums[window] = window_sum(edges, y, *windows[window])
+      sums["beam_power"] = window_sum(edges, y * energy * 1.6e-10, edges[0], edges[-1])
+      result["sums"][name] = sums
+   result["linear_polarization"] = ratio(rate["linear"], rate["total"])
+   result["circular_polarization"] = ratio(rate["circular"], rate["total"])
+   result["tagging_efficiency"] = ratio(rate["total"], rate["uncollimated"])
+   if "tagged" in windows:
+      result["peak_polarization"] = (result["sums"]["linear"]["tagged"] /
+                                     (result["sums"]["total"]["tagged"] + 1e-99))
+   return result
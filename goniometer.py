@@ -0,0 +1,272 @@
+#!/usr/bin/python
+#
+# goniometer.py - find the goniometer setting of the diamond radiator that
+#                 puts the primary coherent edge, and optionally the peak
+#                 polarization in the tagged window, at the requested
+#                 values, from the coherent bremsstrahlung spectra computed
+#                 by cobrems.py.
+#
+# usage: goniometer.py [--edge E] [--polarization P] [--ytilt Y]
+#                      [--ytilt-range LO:HI] [other fixed parameters]
+#
+# The crystal angle thx is set by cobrems from the photonEpeak parameter
+# with an approximate single-reflection formula, so the coherent edge in
+# the computed spectrum does not come out exactly at photonEpeak, and it
+# moves with the secondary tilt radSecondTilt (ytilt) as well. Instead of
+# rerunning ratetool by hand, this solves for the photonEpeak setting that
+# puts the real coherent edge, found in the computed spectrum by
+# cobrems.Setup.coherent_edge, at the requested energy. With a target peak
+# polarization in the tagged window, the edge is moved above the window
+# until the polarization comes down to the target, or, if the edge is also
+# given, ytilt is varied in --ytilt-range with the edge held in place. The
+# polarization changes by only a few percent of itself that way, mostly
+# where the edges of other reflections cross the tagged window, so a
+# target that is out of reach is reported with the range that is possible.
+#
+# The roots are found by a bracketing search that evaluates a batch of
+# trial settings in each round, placed around the linear interpolation of
+# the last bracket, so that it takes a few rounds of a few spectra each.
+# The trial spectra share the energy grid, the collimator acceptance table
+# and the incoherent spectrum, which do not depend on the crystal angles,
+# and the lattice of each trial orientation is built only once.
+#
+# The result is printed as the photonEpeak and radSecondTilt values to
+# enter in the ratetool form, with the goniometer angles thx, thy (rad)
+# they correspond to, the edge energy and the peak polarization.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import sys
+import json
+import argparse
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cobrems
+
+batch_size = 6              # trial settings evaluated in each round
+max_rounds = 12             # rounds of the root search before giving up
+edge_span = 1.5             # half-width (GeV) of the photonEpeak search range
+edge_window = 1.0           # the edge is looked for within this (GeV) of photonEpeak
+
+def find_root(func, lo, hi, tol, batch=None):
+   """
+   Root of func in [lo, hi] to within tol, where func takes an array of
+   trial points and returns an array of values, so that each round of
+   the search is one batch of evaluations. The first round spreads batch
+   points evenly over [lo, hi]; later ones put them around the linear
+   interpolation of the innermost bracket, over the distance the estimate
+   moved in the last round. Raises ValueError if func does not change sign
+   in [lo, hi] or the search does not converge.
+   """
+   batch = batch_size if batch is None else batch
+   points = numpy.linspace(lo, hi, batch + 2)
+   values = numpy.asarray(func(points), dtype=float)
+   estimate = None
+   for _ in range(max_rounds):
+      change = numpy.nonzero(numpy.sign(values[:-1]) * numpy.sign(values[1:]) <= 0)[0]
+      if len(change) == 0:
+         raise ValueError("no solution between {0:.6g} and {1:.6g}".format(points[0], points[-1]))
+      j = change[0]
+      lo, hi, flo, fhi = points[j], points[j + 1], values[j], values[j + 1]
+      if flo == 0 or fhi == 0:
+         return lo if flo == 0 else hi
+      guess = lo - flo * (hi - lo) / (fhi - flo)
+      if hi - lo < tol:
+         return guess
+      if estimate is None:
+         spread = (hi - lo) / (batch + 1)
+      else:
+         spread = max(abs(guess - estimate), tol / 4)
+      estimate = guess
+      trial = guess + spread * numpy.linspace(-1, 1, batch)
+      trial = numpy.unique(trial[(trial > lo) & (trial < hi)])
+      points = numpy.concatenate(([lo], trial, [hi]))
+      values = numpy.concatenate(([flo], func(trial), [fhi]))
+   raise ValueError("no convergence after {0} rounds".format(max_rounds))
+
+class Solver:
+   """
+   Evaluates the coherent edge and peak polarization for trial photonEpeak
+   and ytilt settings with the other cobrems parameters fixed, sharing all
+   the parts of the calculation that do not depend on the crystal angles.
+    E0 = electron beam energy (GeV)
+    emit = electron beam emittance (m.rad)
+    radt = thickness of the radiator (m)
+    dist = distance from radiator to collimator (m)
+    coldiam = collimator diameter (m)
+    mos = crystal r.m.s. mosaic spread (rad)
+    nbins, Emin, Emax = photon energy binning of the spectra (GeV)
+    tagged = (Elow, Ehigh) of the tagged window (GeV)
+   """
+   def __init__(self, E0=12., emit=2.5e-9, radt=20e-6, dist=76., coldiam=3.4e-3,
+                mos=2e-5, nbins=200, Emin=0., Emax=12., tagged=None):
+      self.E0 = float(E0)
+      self.args = (float(emit), float(radt), float(dist), float(coldiam), 0, 0., float(mos))
+      self.edges = numpy.linspace(Emin, Emax, int(nbins) + 1)
+      self.x = (self.edges[:-1] + self.edges[1:]) / 2 / self.E0
+      self.tagged = cobrems.default_windows["tagged"] if tagged is None else tagged
+      self.incoherent = None
+      self.evaluations = 0
+
+   def setup(self, Epeak, ytilt):
+      """
+      Return the cobrems.Setup for photonEpeak Epeak (GeV) and ytilt (rad).
+      """
+      emit, radt, dist, coldiam, polar, epol, mos = self.args
+      return cobrems.Setup(self.E0, Epeak, ytilt, emit, radt, dist, coldiam,
+                           polar, epol, mos)
+
+   def edge(self, Epeaks, ytilts):
+      """
+      Energies (GeV) of the primary coherent edge in the spectra for each
+      of the trial settings Epeaks[n], ytilts[n], looked for within
+      edge_window of Epeaks[n] so that strong edges of other reflections
+      further away are not taken for it.
+      """
+      result = []
+      for Epeak, ytilt in numpy.broadcast(Epeaks, ytilts):
+         setup = self.setup(Epeak, ytilt)
+         coh = setup.coherent(self.x, [(0, setup.collim)])[0]
+         xrange = ((Epeak - edge_window) / self.E0, (Epeak + edge_window) / self.E0)
+         result.append(setup.coherent_edge(self.x, coh, xrange) * self.E0)
+         self.evaluations += 1
+      return numpy.array(result)
+
+   def polarization(self, Epeaks, ytilts):
+      """
+      Peak polarization, linear over total rate in the tagged window, of
+      the smeared spectra for each of the trial settings Epeaks[n], ytilts[n].
+      """
+      result = []
+      for Epeak, ytilt in numpy.broadcast(Epeaks, ytilts):
+         setup = self.setup(Epeak, ytilt)
+         if self.incoherent is None:
+            self.incoherent = setup.incoherent(self.x, [(0, setup.collim)])[0]
+         coh = setup.coherent(self.x, [(1, setup.collim), (0, setup.collim)])
+         coh[1] += self.incoherent
+         linear, total = setup.convol(self.x, coh)
+         result.append(cobrems.window_sum(self.edges, linear, *self.tagged) /
+                       (cobrems.window_sum(self.edges, total, *self.tagged) + 1e-99))
+         self.evaluations += 1
+      return numpy.array(result)
+
+   def Epeak_for_edge(self, edge, ytilt, tol=1e-3):
+      """
+      The photonEpeak setting (GeV) that puts the coherent edge at edge
+      (GeV) for secondary tilt ytilt (rad), to within tol (GeV). The edge
+      moves almost one for one with photonEpeak, so the search starts in a
+      narrow range around photonEpeak = edge corrected by the offset of the
+      edge found there, and only goes to the full edge_span if need be.
+      """
+      func = lambda Epeaks: self.edge(Epeaks, ytilt) - edge
+      lo = max(edge - edge_span, (self.edges[0] + self.edges[1]) / 2)
+      hi = min(edge + edge_span, self.E0 * 0.98)
+      guess = edge - func(min(max(edge, lo), hi))[0]
+      if lo < guess - 20 * tol and guess + 20 * tol < hi:
+         try:
+            return find_root(func, guess - 20 * tol, guess + 20 * tol, tol)
+         except ValueError:
+            pass
+      return find_root(func, lo, hi, tol)
+
+def solve(edge=None, polarization=None, ytilt=250e-3, ytilt_range=(0.05, 0.6),
+          tol=1e-3, **fixed):
+   """
+   Goniometer setting for a target coherent edge energy edge (GeV) and/or
+   peak polarization in the tagged window, with the other parameters of
+   Solver in fixed. With only one of the two targets ytilt (rad) is held
+   fixed; with both, ytilt is searched for in ytilt_range. tol is the
+   tolerance (GeV) on the edge, and tol/10 that on the polarization.
+   Returns a dict with
+    "Epeak" = photonEpeak setting for ratetool (GeV)
+    "ytilt" = radSecondTilt setting for ratetool (rad)
+    "thx", "thy" = goniometer angles of the crystal (rad)
+    "edge" = energy of the coherent edge in the spectrum (GeV)
+    "peak_polarization" = linear / total rate in the tagged window
+    "evaluations" = number of trial spectra computed
+   Raises ValueError if the targets cannot be reached.
+   """
+   if edge is None and polarization is None:
+      raise ValueError("no target edge or polarization given")
+   solver = Solver(**fixed)
+   if polarization is None:
+      Epeak = solver.Epeak_for_edge(edge, ytilt, tol)
+   elif edge is None:
+      # the polarization is highest with the edge just above the window
+      top = solver.tagged[1] + (solver.edges[1] - solver.edges[0])
+      lo = solver.Epeak_for_edge(top, ytilt, tol)
+      hi = min(lo + 2 * edge_span, solver.E0 * 0.98)
+      if solver.polarization(lo, ytilt)[0] < polarization:
+         raise ValueError("peak polarization of {0:.4g} cannot be reached".format(polarization))
+      Epeak = find_root(lambda Epeaks: solver.polarization(Epeaks, ytilt) - polarization,
+                        lo, hi, tol)
+   else:
+      def excess(ytilts):
+         Epeaks = [solver.Epeak_for_edge(edge, y, tol) for y in ytilts]
+         return solver.polarization(Epeaks, ytilts) - polarization
+      # with the edge in place the polarization changes only a little
+      # with ytilt, so first check that the target is in reach
+      ytilts = numpy.linspace(ytilt_range[0], ytilt_range[1], batch_size + 2)
+      values = excess(ytilts)
+      change = numpy.nonzero(numpy.sign(values[:-1]) * numpy.sign(values[1:]) <= 0)[0]
+      if len(change) == 0:
+         raise ValueError("with the edge at {0:.4g} GeV the peak polarization only "
+                          "goes from {1:.4g} to {2:.4g}".format(edge,
+                          polarization + min(values), polarization + max(values)))
+      j = change[0]
+      ytilt = find_root(excess, ytilts[j], ytilts[j + 1], tol / 10)
+      Epeak = solver.Epeak_for_edge(edge, ytilt, tol)
+   setup = solver.setup(Epeak, ytilt)
+   return {"Epeak": float(Epeak), "ytilt": float(ytilt),
+           "thx": float(setup.thx), "thy": float(setup.thy),
+           "edge": float(solver.edge(Epeak, ytilt)[0]),
+           "peak_polarization": float(solver.polarization(Epeak, ytilt)[0]),
+           "evaluations": solver.evaluations}
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="goniometer setting for a coherent edge and polarization")
+   parser.add_argument("--edge", type=float, help="target coherent edge energy (GeV)")
+   parser.add_argument("--polarization", type=float,
+                       help="target peak polarization in the tagged window")
+   parser.add_argument("--ytilt", type=float, default=250e-3,
+                       help="radiator secondary tilt (rad), if not solved for")
+   parser.add_argument("--ytilt-range", default="0.05:0.6",
+                       help="LO:HI range of secondary tilt (rad) searched with both targets")
+   parser.add_argument("--tol", type=float, default=1e-3, help="tolerance on the edge (GeV)")
+   parser.add_argument("--json", action="store_true", help="print the result as json")
+   fixed_defaults = (("E0", 12., "electron beam energy (GeV)"),
+                     ("emit", 2.5e-9, "electron beam emittance (m.rad)"),
+                     ("radt", 20e-6, "radiator thickness (m)"),
+                     ("dist", 76., "radiator-collimator distance (m)"),
+                     ("coldiam", 3.4e-3, "collimator diameter (m)"),
+                     ("mos", 2e-5, "radiator mosaic spread (rad)"),
+                     ("nbins", 200, "number of bins in photon spectrum"),
+                     ("Emin", 0., "photon spectrum energy minimum (GeV)"),
+                     ("Emax", 12., "photon spectrum energy maximum (GeV)"))
+   for par, default, desc in fixed_defaults:
+      parser.add_argument("--" + par, type=type(default), default=default, help=desc)
+   parser.add_argument("--tagged", default="{0}:{1}".format(*cobrems.default_windows["tagged"]),
+                       help="Elow:Ehigh of the tagged window (GeV)")
+   args = parser.parse_args()
+   fixed = {par: getattr(args, par) for par, default, desc in fixed_defaults}
+   fixed["tagged"] = tuple(float(e) for e in args.tagged.split(":"))
+   try:
+      result = solve(args.edge, args.polarization, args.ytilt,
+                     tuple(float(y) for y in args.ytilt_range.split(":")),
+                     args.tol, **fixed)
+   except ValueError as err:
+      sys.stderr.write("goniometer: " + str(err) + "\n")
+      sys.exit(1)
+   if args.json:
+      print(json.dumps(result, indent=1))
+   else:
+      print("photonEpeak = {0:.4f} GeV".format(result["Epeak"]))
+      print("radSecondTilt = {0:.5g} rad".format(result["ytilt"]))
+      print("thx = {0:.6g} rad, thy = {1:.6g} rad".format(result["thx"], result["thy"]))
+      print("coherent edge = {0:.4f} GeV".format(result["edge"]))
+      print("peak polarization = {0:.4f}".format(result["peak_polarization"]))
+      sys.stderr.write("goniometer: {0} trial spectra\n".format(result["evaluations"]))
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# harpbatch.py - command-line batch refitting of archived harp scans with
+#                the harptool_2d.py x/u/y envelope fits and 2d beam ellipse
+#                reconstruction, spread over a pool of worker processes.
+#
+# usage: harpbatch.py [-j N] [-o OUTPUT] [--plots DIR] SCANS
+#
+# SCANS is a csv file with a header row, a json list of objects, or a
+# file of json lines, one scan per row/object, with fields named as the
+# harptool_2d form parameters (harp5C11_xsigma, radHarp_usigma_err, ...).
+# Fields that are missing take the same defaults as on the web form, from
+# the beamline config in beamline.json. An optional "scan" field is copied
+# to the output to identify each scan, otherwise its position in the input
+# file is used. The results are
+# written as json lines, one per scan in the order they finish, each
+# containing the same fields as the format=json response of the web tool.
+# With --plots, the svg plots for each scan are also saved as an html file
+# in DIR, which costs more than the fits themselves.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import sys
+import csv
+import json
+import argparse
+import multiprocessing
+
+# each worker does many small fits, so numpy threading only gets in the way
+for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+   os.environ.setdefault(var, "1")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harpcache
+import harptool_2d
+import beamline
+
+optics = beamline.load(slimits=harptool_2d.slimits,
+                       npoints=harptool_2d.band_points)
+defaults = optics.defaults()
+
+class ScanForm:
+   """
+   Stand-in for the cgi.FieldStorage form of harptool_2d, holding the
+   fields of one scan with the web form defaults filled in.
+   """
+   def __init__(self, fields):
+      self.fields = {}
+      for key in defaults:
+         self.fields[key] = str(defaults[key])
+      for key in fields:
+         if fields[key] is not None and str(fields[key]).strip() != "":
+            self.fields[key] = str(fields[key]).strip()
+
+   def __contains__(self, key):
+      return key in self.fields
+
+   def getfirst(self, key, default=None):
+      return self.fields.get(key, default)
+
+def read_scans(filename):
+   """
+   Generate the scans in filename (or stdin for "-") one at a time, as
+   dicts of field name -> value.
+   """
+   f = sys.stdin if filename == "-" else open(filename)
+   with f:
+      first = f.read(1)
+      while first.isspace():
+         first = f.read(1)
+      if first == "[":
+         for scan in json.loads(first + f.read()):
+            yield scan
+      elif first == "{":
+         for line in (first + f.readline(), *f):
+            if line.strip():
+               yield json.loads(line)
+      elif first:
+         for scan in csv.DictReader([first + f.readline()] + [line for line in f]):
+            yield scan
+
+def fit_scan(task):
+   """
+   Fit one scan in a worker process, returning its results as a line
+   of json text.
+    task = (index, fields, plotdir) with plotdir None for no plots
+   """
+   index, fields, plotdir = task
+   harptool_2d.form = ScanForm(fields)
+   harptool_2d.optics = optics
+   harptool_2d.reset()
+   scan = fields.get("scan", index)
+   result = {"scan": scan}
+   result.update(harptool_2d.scan_results())
+   if plotdir is not None and "error" not in result:
+      harps = harptool_2d.read_harps()
+      sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr = harps[:9]
+      out = harpcache.capture(harptool_2d.fit_and_plot,
+                              sx, list(sigx), list(sigxerr),
+                              su, list(sigu), list(siguerr),
+                              sy, list(sigy), list(sigyerr))
+      out += harpcache.capture(harptool_2d.fit_and_plot_2d,
+                               sx, sigx, sigxerr, su, sigu, siguerr,
+                               sy, sigy, sigyerr)
+      plotfile = os.path.join(plotdir, "harp-scan-" + str(scan) + ".html")
+      with open(plotfile, "w") as f:
+         f.write("<html>\n<body>\n<table>\n" + out +
+                 "</table>\n</body>\n</html>\n")
+      result["plots"] = plotfile
+   return json.dumps(result)
+
+def run(scans, output, jobs, plotdir=None, chunksize=8):
+   """
+   Fit all scans on a pool of jobs processes, writing each result line
+   to output as soon as it is available. Returns the number of scans.
+   """
+   tasks = ((index, scan, plotdir) for index, scan in enumerate(scans))
+   count = 0
+   with multiprocessing.Pool(jobs) as pool:
+      for line in pool.imap_unordered(fit_scan, tasks, chunksize):
+         output.write(line + "\n")
+         output.flush()
+         count += 1
+   return count
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="batch refit of harp scans")
+   parser.add_argument("scans", help="csv, json or json lines file of scans, - for stdin")
+   parser.add_argument("-o", "--output", default="-",
+                       help="json lines output file (default stdout)")
+   parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                       help="number of worker processes")
+   parser.add_argument("--plots", metavar="DIR",
+                       help="also save the svg plots of each scan in DIR")
+   parser.add_argument("--chunksize", type=int, default=8,
+                       help="scans handed to a worker at a time")
+   args = parser.parse_args()
+   if args.plots:
+      os.makedirs(args.plots, exist_ok=True)
+   if args.output == "-":
+      count = run(read_scans(args.scans), sys.stdout, args.jobs,
+                  args.plots, args.chunksize)
+   else:
+      with open(args.output, "w") as output:
+         count = run(read_scans(args.scans), output, args.jobs,
+                     args.plots, args.chunksize)
+   sys.stderr.write("harpbatch: fitted {0} scans\n".format(count))
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+#
+# harpcache.py - content-addressed cache of harp scan fit results and
+#                plots for harptool.py and harptool_2d.py.
+#
+# Each fit is keyed on a hash of its normalized inputs, and the images
+# it produces are named after that key instead of the process id, so a
+# repeated request is answered from the files in the work directory
+# without refitting or rendering. Identical requests arriving together
+# are serialized on a lock file, so only the first one computes. The
+# cache entries are evicted least-recently-used first when a new entry
+# brings the harp files in the work directory beyond max_bytes.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import io
+import os
+import re
+import json
+import fcntl
+import hashlib
+import contextlib
+
+version = 3
+max_bytes = 200 * 1024**2
+entry_pattern = re.compile(r"^harp-(?:(?:x|u|y|2d)-)?(.+)\.(png|pdf|svg|json|lock)$")
+
+def make_key(tool, inputs):
+   """
+   tool = name of the tool producing the results
+   inputs = dict of input name -> number, string or list of numbers
+   """
+   norm = {}
+   for name in inputs:
+      value = inputs[name]
+      if isinstance(value, str):
+         norm[name] = value
+      elif isinstance(value, (list, tuple)):
+         norm[name] = [repr(float(v)) for v in value]
+      else:
+         norm[name] = repr(float(value))
+   text = json.dumps([tool, version, norm], sort_keys=True)
+   return hashlib.sha1(text.encode("utf-8")).hexdigest()[:20]
+
+@contextlib.contextmanager
+def locked(workdir, key):
+   """
+   Hold an exclusive lock on the cache entry for key, blocking until
+   any other process working on the same entry has finished.
+   """
+   with open(workdir + "harp-" + key + ".lock", "a") as lockfile:
+      fcntl.flock(lockfile, fcntl.LOCK_EX)
+      try:
+         yield
+      finally:
+         fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+def lookup(workdir, key):
+   """
+   Return the stored results for key, or None if they are not cached.
+   The entry is marked as recently used by touching its json file.
+   """
+   try:
+      with open(workdir + "harp-" + key + ".json") as f:
+         result = json.load(f)
+      os.utime(workdir + "harp-" + key + ".json")
+   except (OSError, ValueError):
+      return None
+   return result
+
+def store(workdir, key, result):
+   """
+   Save the results for key, written atomically so that readers never
+   see a partial entry.
+   """
+   tmpname = workdir + "harp-" + key + ".json." + str(os.getpid())
+   with open(tmpname, "w") as f:
+      json.dump(result, f)
+   os.replace(tmpname, workdir + "harp-" + key + ".json")
+
+def cached(workdir, key, produce):
+   """
+   Return the results for key, calling produce() to compute them only
+   if they are not already in the cache. The results must be a dict
+   that can be saved as json. Only a cache miss adds to the work
+   directory, so only then are old entries evicted.
+   """
+   with locked(workdir, key):
+      result = lookup(workdir, key)
+      if result is not None:
+         return result
+      result = produce()
+      store(workdir, key, result)
+   evict(workdir)
+   return result
+
+def evict(workdir, limit=None):
+   """
+   Delete the least recently used harp files from workdir, one whole
+   entry at a time, until their total size is below limit bytes. The
+   last use of an entry is the time of its json file, see lookup. An
+   entry is only deleted while holding its lock, and is skipped if some
+   other process holds it. The lock files themselves are never deleted,
+   since a process waiting on one would otherwise lose its lock to the
+   next one to open the same name.
+   """
+   if limit is None:
+      limit = max_bytes
+   entries = {}
+   total = 0
+   for name in os.listdir(workdir):
+      match = entry_pattern.match(name)
+      if not match or match.group(2) == "lock":
+         continue
+      try:
+         st = os.stat(workdir + name)
+      except OSError:
+         continue
+      entry = entries.setdefault(match.group(1), [0, 0, []])
+      if match.group(2) == "json" or entry[0] == 0:
+         entry[0] = st.st_mtime
+      entry[1] += st.st_size
+      entry[2].append(name)
+      total += st.st_size
+   for key in sorted(entries, key=lambda k: entries[k][0]):
+      if total <= limit:
+         break
+      with open(workdir + "harp-" + key + ".lock", "a") as lockfile:
+         try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+         except OSError:
+            continue
+         try:
+            for name in entries[key][2]:
+               try:
+                  os.remove(workdir + name)
+               except OSError:
+                  pass
+         finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+      total -= entries[key][1]
+
+def capture(func, *args):
+   """
+   Call func(*args) and return everything that it printed to stdout.
+   """
+   out = io.StringIO()
+   with contextlib.redirect_stdout(out):
+      func(*args)
+   return out.getvalue()
@@ -0,0 +1,755 @@
+#!/usr/bin/python
+#
+# harpfit.py - numpy fitting engine for the harp scan beam envelope model
+#              used by harptool.py and harptool_2d.py. It replaces the
+#              ROOT TF1 / TGraphErrors fit, which called back into python
+#              for every function evaluation, with a batched least-squares
+#              minimization using the analytic model derivatives, so that
+#              all planes of a harp scan are fitted together without ROOT.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import numpy
+
+class FitResult:
+   """
+   Result of a single plane fit, with the same accessors as the ROOT
+   TFitResult that harptool used before. Fixed parameters have zero
+   rows and columns in the covariance matrix, as in ROOT.
+   par[0] = s coordinate (m) of focus
+   par[1] = sigma at the focus (mm)
+   par[2] = emittance (mm.mrad)
+   """
+   def __init__(self, par, covar, chi2, ndf):
+      self.par = par
+      self.covar = covar
+      self.chi2 = chi2
+      self.ndf = ndf
+
+   def Parameter(self, i):
+      return self.par[i]
+
+   def ParError(self, i):
+      return self.covar[i,i]**0.5
+
+   def Chi2(self):
+      return self.chi2
+
+   def Ndf(self):
+      return self.ndf
+
+   def summary(self):
+      """
+      Fit parameters, covariance and chi2 as plain python numbers.
+      """
+      return {"s0": float(self.par[0]),
+              "sigma0": float(self.par[1]),
+              "emittance": float(self.par[2]),
+              "covariance": self.covar.tolist(),
+              "chi2": float(self.chi2),
+              "ndf": int(self.ndf)}
+
+def envelope(s, par):
+   """
+   s[..., n] = s coordinate (m)
+   par[..., 0] = s coordinate (m) of focus
+   par[..., 1] = sigma at the focus (mm)
+   par[..., 2] = emittance (mm.mrad)
+   """
+   s0 = par[..., 0, None]
+   sig0 = par[..., 1, None]
+   eps = par[..., 2, None]
+   return (sig0**2 + (eps/sig0 * (s - s0))**2)**0.5
+
+def envelope_gradient(s, par):
+   """
+   Derivatives of envelope(s, par) with respect to par[..., i],
+   returned with shape [..., n, 3].
+   """
+   s0 = par[..., 0, None]
+   sig0 = par[..., 1, None]
+   eps = par[..., 2, None]
+   y = (sig0**2 + (eps/sig0 * (s - s0))**2)**0.5
+   dyds0 = -(eps/sig0)**2 * (s - s0) / y
+   dydsig0 = (sig0**2 - (eps/sig0 * (s - s0))**2) / (y * sig0)
+   dydeps = eps * ((s - s0) / sig0)**2 / y
+   return numpy.stack((dyds0, dydsig0, dydeps), axis=-1)
+
+def minimize(resid, par, free, maxiter=200, tol=1e-12, covar=True):
+   """
+   Batched Levenberg-Marquardt minimization of chi2 = sum(r**2).
+    resid(par) = function returning the weighted residuals r[b, n] and
+                 their jacobian J[b, n, p] for parameters par[b, p]
+    par[b, p] = starting values, one row per independent fit b
+    free[b, p] = True for parameters that are varied in fit b
+    covar = False to skip the covariance, returning None in its place
+   Returns the fitted parameters, the chi2 of each fit, and the
+   covariance matrix from the hessian of chi2 at the minimum.
+   """
+   par = numpy.array(par, dtype=float)
+   free = numpy.broadcast_to(free, par.shape)
+   nfit, npar = par.shape
+   fixed = numpy.logical_not(free)
+   lam = numpy.full(nfit, 1e-3)
+   active = numpy.ones(nfit, dtype=bool)
+   r, J = resid(par)
+   J = numpy.where(free[:, None, :], J, 0)
+   chi2 = numpy.sum(r**2, axis=-1)
+   for it in range(maxiter):
+      A = numpy.einsum("bni,bnj->bij", J, J)
+      g = numpy.einsum("bni,bn->bi", J, r)
+      diag = numpy.diagonal(A, axis1=1, axis2=2)
+      floor = 1e-9 * numpy.max(diag, axis=-1, keepdims=True)
+      damp = lam[:, None] * numpy.where(diag > floor, diag, floor + 1e-300)
+      damp = numpy.where(fixed, 1, damp)
+      A = A + numpy.einsum("bi,ij->bij", damp, numpy.eye(npar))
+      g = numpy.where(fixed, 0, g)
+      delta = numpy.linalg.solve(A, -g[..., None])[..., 0]
+      trial = par + numpy.where(active[:, None], delta, 0)
+      rt, Jt = resid(trial)
+      chi2t = numpy.sum(rt**2, axis=-1)
+      better = active & numpy.isfinite(chi2t) & (chi2t <= chi2)
+      converged = better & (chi2 - chi2t <= tol * (1 + chi2))
+      par[better] = trial[better]
+      r[better] = rt[better]
+      J[better] = numpy.where(free[better][:, None, :], Jt[better], 0)
+      chi2[better] = chi2t[better]
+      lam = numpy.where(better, lam / 10, lam * 10)
+      active &= numpy.logical_not(converged) & (lam < 1e10)
+      if not numpy.any(active):
+         break
+   if not covar:
+      return par, chi2, None
+   return par, chi2, covariance(resid, par, free)
+
+def covariance(resid, par, free):
+   """
+   Inverse of half the hessian of chi2 with respect to the free
+   parameters, as computed by Minuit at the end of a ROOT fit. The
+   hessian is taken by central differences of the analytic gradient
+   of chi2, falling back on J^T J wherever it is not positive definite.
+   """
+   nfit, npar = par.shape
+   fixed = numpy.logical_not(free)
+   r, J = resid(par)
+   J = numpy.where(free[:, None, :], J, 0)
+   H = numpy.einsum("bni,bnj->bij", J, J)
+   Hnum = numpy.zeros_like(H)
+   for j in range(npar):
+      h = 1e-5 * (abs(par[:, j]) + 1e-3)
+      step = numpy.zeros_like(par)
+      step[:, j] = h
+      rp, Jp = resid(par + step)
+      rm, Jm = resid(par - step)
+      gp = numpy.einsum("bni,bn->bi", numpy.where(free[:, None, :], Jp, 0), rp)
+      gm = numpy.einsum("bni,bn->bi", numpy.where(free[:, None, :], Jm, 0), rm)
+      Hnum[:, :, j] = (gp - gm) / (2 * h[:, None])
+   Hnum = (Hnum + numpy.swapaxes(Hnum, 1, 2)) / 2
+   mask = free[:, :, None] & free[:, None, :]
+   eye = numpy.eye(npar) * fixed[:, :, None]
+   Hnum = numpy.where(mask, Hnum, 0) + eye
+   H = numpy.where(mask, H, 0) + eye
+   good = numpy.all(numpy.linalg.eigvalsh(Hnum) > 0, axis=-1)
+   H[good] = Hnum[good]
+   return numpy.where(mask, numpy.linalg.pinv(H), 0)
+
+def fit_envelopes(s, sigma, sigma_err, emittance, start=(200, 1.0),
+                  free_emittance=False):
+   """
+   Fit the envelope model to any number of planes in one batched call.
+    s[k] = s coordinates (m) of the harps measuring plane k
+    sigma[k] = measured beam sigmas (mm) in plane k
+    sigma_err[k] = errors on the measured sigmas (mm) in plane k
+    emittance[k] = emittance (mm.mrad) for plane k, held fixed in the
+                   fit unless free_emittance is True
+    start = initial values for the focus s (m) and sigma (mm)
+   Returns a list of FitResult, one for each plane.
+   """
+   nplanes = len(s)
+   npoints = max(len(sk) for sk in s)
+   ss = numpy.zeros((nplanes, npoints))
+   yy = numpy.zeros((nplanes, npoints))
+   ww = numpy.zeros((nplanes, npoints))
+   for k in range(nplanes):
+      n = len(s[k])
+      ss[k,:n] = s[k]
+      yy[k,:n] = sigma[k]
+      ww[k,:n] = 1 / numpy.asarray(sigma_err[k], dtype=float)
+
+   def resid(par):
+      r = (envelope(ss, par) - yy) * ww
+      J = envelope_gradient(ss, par) * ww[..., None]
+      return r, J
+
+   par = numpy.empty((nplanes, 3))
+   par[:,0] = start[0]
+   par[:,1] = start[1]
+   par[:,2] = emittance
+   free = numpy.array([True, True, free_emittance])
+   par, chi2, covar = minimize(resid, par, free)
+   flip = numpy.where(par[:,1] < 0, -1, 1)
+   par[:,1] *= flip
+   covar[:,1,:] *= flip[:, None]
+   covar[:,:,1] *= flip[:, None]
+   nfree = 3 if free_emittance else 2
+   return [FitResult(par[k], covar[k], chi2[k], len(s[k]) - nfree)
+           for k in range(nplanes)]
+
+def confidence_bands(fits, slimits, npoints=101, minvar=0.01**2):
+   """
+   Evaluate the fitted envelopes of all planes on a grid of npoints
+   s values spanning slimits, with 1-sigma error bands propagated
+   through the full parameter covariance of each fit, including the
+   emittance term whenever the emittance was a free parameter.
+    fits[k] = FitResult for plane k
+    minvar = floor (mm**2) added to the variance of the band
+   Returns the grid s[n] and the band edges lower[k, n], upper[k, n].
+   """
+   s = numpy.linspace(slimits[0], slimits[1], npoints)
+   par = numpy.array([fit.par for fit in fits])
+   covar = numpy.array([fit.covar for fit in fits])
+   mu = envelope(s, par)
+   grad = envelope_gradient(s, par)
+   sigma = (numpy.einsum("kni,kij,knj->kn", grad, covar, grad) + minvar)**0.5
+   return s, numpy.maximum(mu - sigma, 0), mu + sigma
+
+def band_polygon(s, lower, upper):
+   """
+   Outline of a shaded band as a closed polygon, running out along
+   the lower edge and back along the upper one.
+   """
+   return (numpy.concatenate((s, s[::-1])),
+           numpy.concatenate((lower, upper[::-1])))
+
+def ellipse_parameters(sigx, sigy, sigu):
+   """
+   Shape of the beam ellipse with projected sigmas sigx, sigy (mm)
+   along x and y and sigu (mm) along the u = (x + y)/sqrt(2) diagonal,
+   computed elementwise for scalars or arrays. Returns the semi-axes
+   A, B (mm) as drawn by harptool_2d and the tilt angle alpha (rad).
+   """
+   tan2alpha = ((sigx**2 + sigy**2 - 2*sigu**2) /
+                (sigx**2 - sigy**2 + 1e-99))
+   alpha = numpy.arctan(tan2alpha) / 2
+   cos2alpha = numpy.cos(2 * alpha)
+   cosalpha = numpy.cos(alpha)
+   sinalpha = numpy.sin(alpha)
+   A2 = ((sigx * cosalpha)**2 - (sigy * sinalpha)**2) / (2 * cos2alpha)
+   B2 = ((sigy * cosalpha)**2 - (sigx * sinalpha)**2) / (2 * cos2alpha)
+   return A2**0.5, B2**0.5, alpha
+
+def refit_samples(model, par, free, yy, ww, nsamples, seed=0, maxiter=50):
+   """
+   Refit the model to nsamples pseudo-experiments, each with the
+   measurements yy[n] redrawn from gaussians of widths 1/ww[n] about
+   their fitted values, all in one batch of minimize. Every refit
+   starts from the best fit par[p] and varies the same free[p]
+   parameters, for at most maxiter steps, which is enough for the
+   spread of the refits to settle even where some of them creep along
+   a flat direction of chi2. Returns the refitted parameters
+   [nsamples, p], with the rows of refits that did not reach a finite
+   result set to nan.
+   """
+   rng = numpy.random.default_rng(seed)
+   ysamples = model(par[None, :])[0] + rng.standard_normal((nsamples, len(yy))) / ww
+
+   def resid(par):
+      return ((model(par) - ysamples) * ww,
+              numerical_jacobian(model, par) * ww[:, None])
+
+   start = numpy.tile(par, (nsamples, 1))
+   samples, chi2 = minimize(resid, start, free, maxiter, covar=False)[:2]
+   good = numpy.all(numpy.isfinite(samples), axis=-1) & numpy.isfinite(chi2)
+   samples[numpy.logical_not(good)] = numpy.nan
+   return samples
+
+def major_axis_tilt(A, B, alpha):
+   """
+   Angle (rad) of the major axis of the ellipses (A, B, alpha) from x
+   towards y, in (-pi/2, pi/2]. The semi-axis A is drawn at -alpha.
+   """
+   tilt = numpy.where(A >= B, -alpha, numpy.pi/2 - alpha)
+   return numpy.where(tilt > numpy.pi/2, tilt - numpy.pi, tilt)
+
+def inverse_square_radius(A, B, alpha, phi):
+   """
+   1/r**2 (mm**-2) for the distance r from the center to the ellipses
+   (A[n], B[n], alpha[n]) in the directions phi[m] (rad), returned as
+   [n, m] in single precision. It is a quadratic form in cos(phi) and
+   sin(phi), so only its three coefficients are computed per ellipse.
+   """
+   c, s = numpy.cos(-alpha), numpy.sin(-alpha)
+   a2, b2 = A**-2, B**-2
+   qcc = (c**2 * a2 + s**2 * b2).astype(numpy.float32)
+   qcs = (2 * c * s * (a2 - b2)).astype(numpy.float32)
+   qss = (s**2 * a2 + c**2 * b2).astype(numpy.float32)
+   cp = numpy.cos(phi).astype(numpy.float32)
+   sp = numpy.sin(phi).astype(numpy.float32)
+   return (qcc[:, None] * cp**2 + qcs[:, None] * (cp * sp) +
+           qss[:, None] * sp**2)
+
+def quantiles(values, levels, reverse=False):
+   """
+   Median and central intervals containing the fractions levels of
+   values, along the first axis, as a dict {"median": m, level: (lo, hi)}.
+   With reverse, values are in decreasing order of the quantity wanted,
+   so the quantiles are taken from the other end.
+   """
+   probs = [0.5]
+   for level in levels:
+      probs += [(1 - level) / 2, (1 + level) / 2]
+   if reverse:
+      probs = [1 - p for p in probs]
+   q = numpy.quantile(values, probs, axis=0)
+   result = {"median": q[0]}
+   for n, level in enumerate(levels):
+      result[level] = q[1 + 2*n: 3 + 2*n]
+   return result
+
+def ellipse_confidence(sigx, sigy, sigu, levels=(0.68, 0.95), ndirections=72):
+   """
+   Confidence regions of the beam ellipse from the sampled sigmas
+   sigx[n], sigy[n], sigu[n] (mm), see ellipse_parameters. Samples that
+   do not describe a real ellipse are counted and left out. Returns a
+   dict with the median and the central interval at each of levels of
+   sigma_x, sigma_y, sigma_u and the major axis tilt (rad), and of the
+   radius of the ellipse in each of ndirections directions phi, which
+   bounds the region swept out by the ellipse.
+   """
+   with numpy.errstate(invalid="ignore"):
+      A, B, alpha = ellipse_parameters(sigx, sigy, sigu)
+   good = numpy.isfinite(A) & numpy.isfinite(B) & (A > 0) & (B > 0)
+   A, B, alpha = A[good], B[good], alpha[good]
+   tilt = major_axis_tilt(A, B, alpha)
+   # the tilt is an axis direction, so take its spread about the mean axis
+   center = numpy.angle(numpy.mean(numpy.exp(2j * tilt))) / 2
+   tilt = center + (tilt - center + numpy.pi/2) % numpy.pi - numpy.pi/2
+   phi = numpy.linspace(0, 2 * numpy.pi, ndirections, endpoint=False)
+   result = {"samples": int(len(sigx)), "real": float(numpy.mean(good)),
+             "phi": phi}
+   for name, values in (("sigma_x", sigx[good]), ("sigma_y", sigy[good]),
+                        ("sigma_u", sigu[good]), ("tilt", tilt)):
+      result[name] = quantiles(values, levels)
+   radius = quantiles(inverse_square_radius(A, B, alpha, phi), levels, reverse=True)
+   result["radius"] = {key: numpy.asarray(value, dtype=float)**-0.5
+                       for key, value in radius.items()}
+   return result
+
+class SigmaMatrixFit:
+   """
+   Result of a joint fit of the beam sigma matrix to the x, u and y
+   harp measurements, see fit_sigma_matrix.
+   par[0:3] = s0, sigma0, emittance of the x plane, as for envelope
+   par[3:6] = s0, sigma0, emittance of the y plane
+   par[6:9] = m11, m12, m22 of the symmetric x-y coupling matrix M
+   free[9] = True for the parameters that were varied in the fit
+   """
+   def __init__(self, par, covar, chi2, ndf, plane_chi2, plane_points, free=None):
+      self.par = par
+      self.covar = covar
+      self.chi2 = chi2
+      self.ndf = ndf
+      self.plane_chi2 = plane_chi2
+      self.plane_points = plane_points
+      self.free = free
+
+   def planes(self):
+      """
+      Envelope fits for the x, u and y planes as FitResult objects. The
+      x and y planes are subsets of the joint parameters; for u, whose
+      sigma**2 is also quadratic in s, the equivalent focus, sigma and
+      emittance are derived from them with the covariance propagated.
+      Each carries the chi2 of its own measurements, and the number of
+      those measurements as ndf.
+      """
+      jac = numerical_jacobian(lambda p: u_envelope(p), self.par[None, :])[0]
+      results = []
+      for k, (par, covar) in enumerate(((self.par[0:3], self.covar[0:3,0:3]),
+                                        (u_envelope(self.par[None, :])[0],
+                                         jac @ self.covar @ jac.T),
+                                        (self.par[3:6], self.covar[3:6,3:6]))):
+         results.append(FitResult(par, covar, self.plane_chi2[k],
+                                  self.plane_points[k]))
+      return results
+
+   def summary(self):
+      """
+      Joint fit parameters, covariance and chi2 as plain python numbers.
+      """
+      return {"parameters": self.par.tolist(),
+              "covariance": self.covar.tolist(),
+              "chi2": float(self.chi2),
+              "ndf": int(self.ndf)}
+
+def sigma_matrix(s, par):
+   """
+   Second moments <xx>, <xy>, <yy> (mm**2) of the beam at s (m), for
+   the parameters par[..., 9] described under SigmaMatrixFit. The
+   transverse coordinates are
+     x(s) = sig0x * a1 + epsx/sig0x * (s - s0x) * a2
+     y(s) = sig0y * b1 + epsy/sig0y * (s - s0y) * b2
+   with unit normal deviates (a1,a2) and (b1,b2) correlated through
+   K = <a b^T> = M / sqrt(1 + |M|**2). Since every singular value of K
+   is below 1, the 4x4 correlation matrix is positive definite for any
+   M, so the moments always describe a physical beam.
+   """
+   wx = numpy.stack(numpy.broadcast_arrays(par[..., 1, None],
+                    par[..., 2, None] / par[..., 1, None] *
+                    (s - par[..., 0, None])), axis=-1)
+   wy = numpy.stack(numpy.broadcast_arrays(par[..., 4, None],
+                    par[..., 5, None] / par[..., 4, None] *
+                    (s - par[..., 3, None])), axis=-1)
+   m11 = par[..., 6]
+   m12 = par[..., 7]
+   m22 = par[..., 8]
+   norm = (1 + m11**2 + 2 * m12**2 + m22**2)**0.5
+   K = numpy.stack((numpy.stack((m11, m12), axis=-1),
+                    numpy.stack((m12, m22), axis=-1)), axis=-2)
+   K = K / norm[..., None, None]
+   sxx = numpy.sum(wx**2, axis=-1)
+   syy = numpy.sum(wy**2, axis=-1)
+   sxy = numpy.einsum("...ni,...ij,...nj->...n", wx, K, wy)
+   return sxx, sxy, syy
+
+def coupled_sigmas(s, par):
+   """
+   Beam sigmas (mm) along x, u = (x + y)/sqrt(2) and y at s (m) for the
+   joint sigma matrix parameters par[..., 9].
+   """
+   sxx, sxy, syy = sigma_matrix(s, par)
+   return sxx**0.5, ((sxx + syy) / 2 + sxy)**0.5, syy**0.5
+
+def u_envelope(par, span=100):
+   """
+   Focus s0 (m), sigma0 (mm) and emittance (mm.mrad) of the envelope
+   in u = (x + y)/sqrt(2) for the joint parameters par[b, 9], obtained
+   from the exact quadratic dependence of sigma_u**2 on s.
+   """
+   t = numpy.array([-span, 0., span])
+   s = par[:, 0, None] + t
+   sxx, sxy, syy = sigma_matrix(s, par)
+   suu = (sxx + syy) / 2 + sxy
+   a = (suu[:, 2] + suu[:, 0] - 2 * suu[:, 1]) / (2 * span**2)
+   b = (suu[:, 2] - suu[:, 0]) / (2 * span)
+   s0 = s[:, 1] - b / (2 * a)
+   sig0 = (suu[:, 1] - b**2 / (4 * a))**0.5
+   return numpy.stack((s0, sig0, sig0 * a**0.5), axis=-1)
+
+def numerical_jacobian(func, par):
+   """
+   Derivatives of func(par)[b, n] with respect to par[b, p] by central
+   differences, returned with shape [b, n, p]. All of the displaced
+   parameter sets are passed to func together as one batch.
+   """
+   nfit, npar = par.shape
+   h = 1e-6 * (abs(par) + 1e-3)
+   step = numpy.einsum("bj,jk->jbk", h, numpy.eye(npar))
+   trial = numpy.concatenate((par + step, par - step)).reshape(-1, npar)
+   f = func(trial).reshape(2, npar, nfit, -1)
+   return numpy.einsum("jbn,bj->bnj", f[0] - f[1], 1 / (2 * h))
+
+def joint_problem(s, sigma, sigma_err):
+   """
+   Measured sigmas and their weights for fit_sigma_matrix, concatenated
+   over the x, u and y planes, with the model sigma(par)[b, n] for the
+   joint parameters par[b, 9] and the plane index of each measurement.
+   """
+   ss = numpy.concatenate([numpy.asarray(sk, dtype=float) for sk in s])
+   yy = numpy.concatenate([numpy.asarray(sk, dtype=float) for sk in sigma])
+   ww = 1 / numpy.concatenate([numpy.asarray(sk, dtype=float)
+                               for sk in sigma_err])
+   plane = numpy.concatenate([[k] * len(s[k]) for k in range(3)]).astype(int)
+   points = numpy.arange(len(ss))
+
+   def model(par):
+      return numpy.stack(coupled_sigmas(ss, par))[plane, :, points].T
+
+   return yy, ww, model, plane
+
+def fit_sigma_matrix(s, sigma, sigma_err, emittance, start=(200, 1.0),
+                     free_emittance=False):
+   """
+   Fit the beam sigma matrix and its evolution in s to the x, u and y
+   harp measurements together, in a single minimization.
+    s[k] = s coordinates (m) of the harps measuring plane k = x, u, y
+    sigma[k] = measured beam sigmas (mm) in plane k
+    sigma_err[k] = errors on the measured sigmas (mm) in plane k
+    emittance = (x, y) emittances (mm.mrad), held fixed in the fit
+                unless free_emittance is True
+    start = initial values for the focus s (m) and sigma (mm)
+   The x and y envelopes are first fitted separately to give starting
+   values for the joint fit, which begins with no x-y coupling.
+   Returns a SigmaMatrixFit.
+   """
+   xfit, yfit = fit_envelopes((s[0], s[2]), (sigma[0], sigma[2]),
+                              (sigma_err[0], sigma_err[2]), emittance,
+                              start, free_emittance)
+   yy, ww, model, plane = joint_problem(s, sigma, sigma_err)
+
+   def resid(par):
+      return ((model(par) - yy) * ww,
+              numerical_jacobian(model, par) * ww[:, None])
+
+   par = numpy.concatenate((xfit.par, yfit.par, [0, 0, 0]))[None, :]
+   free = numpy.array([True, True, free_emittance] * 2 + [True] * 3)
+   par, chi2, covar = minimize(resid, par, free)
+   par, covar = par[0], covar[0]
+   flip = numpy.ones(9)
+   flip[[1, 6, 7, 8]] *= numpy.sign(par[1]) or 1
+   flip[[4, 6, 7, 8]] *= numpy.sign(par[4]) or 1
+   par = par * flip
+   covar = covar * numpy.outer(flip, flip)
+   r2 = ((model(par[None, :])[0] - yy) * ww)**2
+   plane_chi2 = [numpy.sum(r2[plane == k]) for k in range(3)]
+   return SigmaMatrixFit(par, covar, chi2[0], len(yy) - numpy.sum(free),
+                         plane_chi2, [len(sk) for sk in s], free)
+
+projections = numpy.array([[1, 0, 0, 0],
+                           [0.5**0.5, 0, 0.5**0.5, 0],
+                           [0, 0, 1, 0]])
+
+class TransportFit:
+   """
+   Result of a fit of the beam sigma matrix at a reference point to harp
+   measurements transported through known optics, see fit_transport.
+   The results are given as the independent elements sigma[i,j], i <= j,
+   of the 4x4 sigma matrix in (x, x', y, y') listed in pairs, in mm**2,
+   mm.mrad and mrad**2, with their covariance propagated from that of
+   the fitted parameters model_par, described under transport_sigma.
+   """
+   def __init__(self, pairs, par, covar, chi2, ndf, model_par=None, free=None):
+      self.pairs = pairs
+      self.par = par
+      self.covar = covar
+      self.chi2 = chi2
+      self.ndf = ndf
+      self.model_par = model_par
+      self.free = free
+      self.sigma = numpy.zeros((4, 4))
+      for (i, j), p in zip(pairs, par):
+         self.sigma[i,j] = self.sigma[j,i] = p
+
+   def coefficients(self, R, plane):
+      """
+      Coefficients c[n, p] with sigma**2 = c . par in plane k = 0, 1, 2
+      for x, u, y, at the points with transfer matrices R[n, 4, 4] from
+      the reference point.
+      """
+      return transport_coefficients(projections[plane] @ R, self.pairs)
+
+   def bands(self, R, minvar=0.01**2):
+      """
+      Fitted sigmas (mm) in x, u and y at the points with transfer
+      matrices R[n, 4, 4], with 1-sigma error bands propagated from the
+      fit covariance as in confidence_bands. Returns the arrays
+      sigma[k, n], lower[k, n] and upper[k, n].
+      """
+      curves = []
+      errors = []
+      for plane in range(3):
+         c = self.coefficients(R, plane)
+         sigma = numpy.maximum(c @ self.par, 0)**0.5
+         var = numpy.einsum("ni,ij,nj->n", c, self.covar, c)
+         curves.append(sigma)
+         errors.append((var / (4 * sigma**2 + 1e-99) + minvar)**0.5)
+      curves = numpy.array(curves)
+      errors = numpy.array(errors)
+      return curves, numpy.maximum(curves - errors, 0), curves + errors
+
+   def twiss(self, plane):
+      """
+      Emittance (mm.mrad), beta (m) and alpha at the reference point for
+      plane "x" or "y", from the corresponding 2x2 block of sigma.
+      """
+      i = {"x": 0, "y": 2}[plane]
+      block = self.sigma[i:i+2,i:i+2]
+      emittance = max(numpy.linalg.det(block), 0)**0.5
+      return {"emittance": float(emittance),
+              "beta": float(block[0,0] / emittance) if emittance > 0 else None,
+              "alpha": float(-block[0,1] / emittance) if emittance > 0 else None}
+
+   def summary(self):
+      """
+      Fitted sigma matrix, covariance of its elements, chi2 and Twiss
+      parameters as plain python numbers.
+      """
+      return {"sigma_matrix": self.sigma.tolist(),
+              "elements": [list(p) for p in self.pairs],
+              "covariance": self.covar.tolist(),
+              "chi2": float(self.chi2),
+              "ndf": int(self.ndf),
+              "twiss": {"x": self.twiss("x"), "y": self.twiss("y")}}
+
+def transport_coefficients(rows, pairs):
+   """
+   Coefficients of the sigma matrix elements in pairs for the squared
+   projections rows[n, 4] . (x, x', y, y') of the beam.
+   """
+   i, j = numpy.array(pairs).T
+   return rows[:, i] * rows[:, j] * numpy.where(i == j, 1, 2)
+
+def transport_sigma(par):
+   """
+   Sigma matrices [b, 4, 4] at the reference point of fit_transport for
+   the parameters par[b, 10], built as W C W^T with W block diagonal in
+   the lower triangular factors [[a, 0], [b, emittance/a]] of the x and
+   y blocks, and C = [[1, K], [K^T, 1]] with the x-y correlation
+   K = M / sqrt(1 + |M|**2) as in sigma_matrix. Since every singular
+   value of K is below 1, the result is a physical sigma matrix for any
+   parameters.
+    par[..., 0:3] = a (mm), b (mrad) and emittance (mm.mrad) in x
+    par[..., 3:6] = the same in y
+    par[..., 6:10] = m11, m12, m21, m22 of the coupling matrix M
+   """
+   nfit = par.shape[0]
+   W = numpy.zeros((nfit, 4, 4))
+   for i, k in ((0, 0), (2, 3)):
+      W[:,i,i] = par[:,k]
+      W[:,i+1,i] = par[:,k+1]
+      W[:,i+1,i+1] = par[:,k+2] / par[:,k]
+   M = par[:,6:10].reshape(nfit, 2, 2)
+   norm = (1 + numpy.sum(M**2, axis=(1, 2)))**0.5
+   C = numpy.tile(numpy.eye(4), (nfit, 1, 1))
+   C[:,0:2,2:4] = M / norm[:, None, None]
+   C[:,2:4,0:2] = numpy.swapaxes(C[:,0:2,2:4], 1, 2)
+   return W @ C @ numpy.swapaxes(W, 1, 2)
+
+def transport_problem(R, sigma, sigma_err, symmetric):
+   """
+   Projections rows[n, 4] from the reference point to the harps of the
+   measurements of fit_transport, the measured sigmas and their weights
+   concatenated over the planes, and the model sigma(par)[b, n]. With
+   symmetric, the coupling matrix M is held symmetric by using m12 in
+   place of m21.
+   """
+   rows = []
+   for k in range(3):
+      if len(sigma[k]) > 0:
+         rows.append(projections[k] @ numpy.asarray(R[k], dtype=float))
+   rows = numpy.concatenate(rows)
+   yy = numpy.concatenate([numpy.asarray(sk, dtype=float) for sk in sigma if len(sk) > 0])
+   ww = 1 / numpy.concatenate([numpy.asarray(ek, dtype=float)
+                               for ek in sigma_err if len(ek) > 0])
+
+   def model(par):
+      if symmetric:
+         par = par.copy()
+         par[:,8] = par[:,7]
+      S = transport_sigma(par)
+      return numpy.maximum(numpy.einsum("ni,bij,nj->bn", rows, S, rows), 0)**0.5
+
+   return rows, yy, ww, model
+
+def transport_start(A, b, pairs, emittance, sigma):
+   """
+   Starting values of the x and y parameters of transport_sigma, with
+   the given emittances, from the weighted linear least squares solution
+   A . elements = b for the sigma matrix elements in pairs. The waist
+   position and size of that solution in each plane, as for a drift,
+   are kept, falling back on an upright ellipse of the measured size
+   wherever the solution is not a physical sigma matrix.
+   """
+   U, sv, Vt = numpy.linalg.svd(A, full_matrices=False)
+   keep = sv > 1e-10 * sv[0]
+   lin = Vt[keep].T @ ((U[:, keep].T @ b) / sv[keep])
+   S = numpy.zeros((4, 4))
+   for (i, j), p in zip(pairs, lin):
+      S[i,j] = S[j,i] = p
+   par = numpy.zeros(10)
+   for i, k, plane in ((0, 0, 0), (2, 3, 2)):
+      eps = emittance[plane // 2]
+      waist2 = S[i,i] - S[i,i+1]**2 / S[i+1,i+1] if S[i+1,i+1] > 0 else 0
+      if waist2 > 0:
+         d = -S[i,i+1] / S[i+1,i+1]
+         s22 = eps**2 / waist2
+         s11 = waist2 + d**2 * s22
+         par[k] = s11**0.5
+         par[k+1] = -d * s22 / par[k]
+      else:
+         par[k] = numpy.mean(numpy.asarray(sigma[plane], dtype=float)**2)**0.5
+      par[k+2] = eps
+   return par
+
+def fit_transport(R, sigma, sigma_err, coupled=True, emittance=None,
+                  free_emittance=None):
+   """
+   Fit the beam sigma matrix at a reference point to any number of harp
+   measurements, in the parameters of transport_sigma so that the result
+   is always a physical beam.
+    R[k] = transfer matrices [n_k, 4, 4] from the reference point to
+           the harps measuring plane k = x, u, y
+    sigma[k] = measured beam sigmas (mm) in plane k
+    sigma_err[k] = errors on the measured sigmas (mm) in plane k
+    coupled = fit the x-y elements of the sigma matrix, which is only
+              possible with u measurements
+    emittance = (x, y) emittances (mm.mrad) to hold fixed when there
+                are too few measurements to fit them, or None
+    free_emittance = True or False to fit the emittances or hold them
+                     at emittance, or None to decide as below
+   Parameters that the data cannot determine are fixed explicitly,
+   never left to a minimum-norm solution: the coupling matrix M is held
+   symmetric, as in fit_sigma_matrix, unless there are at least 4 u
+   measurements, and the emittances are held at the given values if
+   there are fewer measurements than elements of the sigma matrix. The
+   coupled fit starts from the separate x and y fits. Raises ValueError
+   if the fit is still not determined by the data, which is checked at
+   the uncoupled start where no parameter is at a limit, or if it does
+   not converge to a finite result.
+   Returns a TransportFit.
+   """
+   if coupled:
+      pairs = [(i, j) for i in range(4) for j in range(i, 4)]
+   else:
+      pairs = [(0, 0), (0, 1), (1, 1), (2, 2), (2, 3), (3, 3)]
+   nmeas = sum(len(sk) for sk in sigma)
+   symmetric = coupled and len(sigma[1]) < 4
+   free = numpy.ones(10, dtype=bool)
+   if not coupled:
+      free[6:10] = False
+   elif symmetric:
+      free[8] = False
+   if free_emittance is None:
+      free_emittance = nmeas >= len(pairs) or emittance is None
+   if not free_emittance:
+      free[[2, 5]] = False
+   if nmeas < numpy.sum(free):
+      raise ValueError("{0} harp measurements are too few to fit {1} parameters"
+                       " of the sigma matrix".format(nmeas, numpy.sum(free)))
+   rows, yy, ww, model = transport_problem(R, sigma, sigma_err, symmetric)
+
+   def resid(par):
+      return ((model(par) - yy) * ww,
+              numerical_jacobian(model, par) * ww[:, None])
+
+   if coupled:
+      # start from the separate x and y fits, with no x-y coupling
+      planes = fit_transport((R[0], [], R[2]), (sigma[0], [], sigma[2]),
+                             (sigma_err[0], [], sigma_err[2]), False,
+                             emittance, free_emittance)
+      par = planes.model_par.copy()
+   else:
+      A = transport_coefficients(rows, pairs) * (ww / (2 * yy))[:, None]
+      par = transport_start(A, yy * ww / 2, pairs, emittance or (1e-3, 1e-3), sigma)
+   par = par[None, :]
+   J = resid(par)[1]
+   sv = numpy.linalg.svd(J[0][:, free], compute_uv=False)
+   if not sv[-1] > 1e-10 * sv[0]:
+      raise ValueError("the harp measurements do not determine the sigma matrix")
+
+   par, chi2, covar = minimize(resid, par, free)
+   if symmetric:
+      par[:,8] = par[:,7]
+   if not numpy.all(numpy.isfinite(par)) or not numpy.isfinite(chi2[0]):
+      raise ValueError("the sigma matrix fit did not converge")
+
+   def elements(par):
+      S = transport_sigma(par)
+      return numpy.stack([S[:,i,j] for i, j in pairs], axis=-1)
+
+   tied = numpy.eye(10)
+   if symmetric:
+      tied[8] = tied[7]
+   jac = numerical_jacobian(lambda p: elements(p @ tied.T), par)[0]
+   return TransportFit(pairs, elements(par)[0], jac @ covar[0] @ jac.T, chi2[0],
+                       nmeas - int(numpy.sum(free)), par[0], free)
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+script=`echo $0 | sed 's/.cgi/.py/'`
+exec python $script
@@ -0,0 +1,428 @@
+#!/usr/bin/python
+#
+# harphistory.py - append-only history of the harp scan fits made by
+#                  harptool.py and harptool_2d.py, with range queries,
+#                  downsampled trends and a trend page of the focus
+#                  position and spot size drift.
+#
+# usage: harphistory.py                    (summary of the stored fits)
+#        harphistory.py --days 30 --nbins 20 [--tool harptool_2d]
+#                                          (trend table of the last 30 days)
+#        harphistory.cgi                   (trend page, when run by the
+#                                           web server)
+#
+# The history is kept as a column store in work/history/, with one flat
+# binary file of fixed-size values per column, so that each fit appends
+# one row to every column and a query reads only the columns it needs,
+# through numpy memory maps, without loading the rest. The rows are in
+# time order, so the time column is itself the index: a range of times
+# is found by a binary search of it, and a trend over months is reduced
+# to a few hundred bins in one pass over the rows in the range. Appends
+# are serialized on a lock file and the time column is written last, so
+# that its length is the number of complete rows; a row that was cut off
+# by a crash is dropped at the next append.
+#
+# Every fit answered by the tools is appended, whether it is computed
+# or taken from the harpcache, where the row of each fit is kept with its
+# results, and for the html pages and the json output alike.
+#
+# Each row holds the tool and fit kind, the harpcache key of the fit,
+# the harp measurements, form emittances and collimator position that
+# went into it, the fitted parameters padded to max_par with their
+# covariance, the chi2, the focus position s0 and size sigma0 in x and y,
+# and the sigmas and beam ellipse at the collimator. For the transport
+# fits, s0 and sigma0 are those of the drift-space waist that the fitted
+# sigma matrix at the collimator extrapolates to.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import sys
+import cgi
+import html
+import time
+import fcntl
+import argparse
+import contextlib
+
+import numpy
+import harpfit
+import harpplot
+import toolmetrics
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+historydir = basedir + "/work/history/"
+max_harps = 16
+max_par = 10
+max_days = 3650
+max_bins = 2000
+tools = ("harptool", "harptool_2d")
+fit_kinds = ("envelope", "joint", "transport")
+columns = (("tool", "u1", ()),
+           ("kind", "u1", ()),
+           ("key", "S20", ()),
+           ("collimator_spos", "f8", ()),
+           ("emittance", "f8", (2,)),
+           ("harps", "f4", (3, 3, max_harps)),
+           ("npar", "u1", ()),
+           ("par", "f8", (max_par,)),
+           ("covar", "f8", (max_par, max_par)),
+           ("chi2", "f8", ()),
+           ("ndf", "i4", ()),
+           ("s0", "f8", (2,)),
+           ("sigma0", "f8", (2,)),
+           ("sigma_collimator", "f8", (3,)),
+           ("ellipse", "f8", (3,)),
+           ("time", "f8", ()))
+metrics = toolmetrics.Timer("harphistory", enabled=False)
+column_types = {name: (numpy.dtype(dtype), shape) for name, dtype, shape in columns}
+
+# scalar quantities for the trends, as (column, index)
+quantities = {"s0_x": ("s0", 0), "s0_y": ("s0", 1),
+              "sigma0_x": ("sigma0", 0), "sigma0_y": ("sigma0", 1),
+              "sigma_collimator_x": ("sigma_collimator", 0),
+              "sigma_collimator_u": ("sigma_collimator", 1),
+              "sigma_collimator_y": ("sigma_collimator", 2),
+              "ellipse_A": ("ellipse", 0), "ellipse_B": ("ellipse", 1),
+              "ellipse_alpha": ("ellipse", 2),
+              "chi2": ("chi2", None), "collimator_spos": ("collimator_spos", None)}
+
+# trend page figures, as (title, unit, [(quantity, color)])
+figures = (("focus position", "s0 (m)", (("s0_x", 2), ("s0_y", 4))),
+           ("focus size", "&#963;0 (mm)", (("sigma0_x", 2), ("sigma0_y", 4))),
+           ("spot size at the collimator", "&#963; (mm)",
+            (("sigma_collimator_x", 2), ("sigma_collimator_u", 3),
+             ("sigma_collimator_y", 4))))
+
+def column_file(name):
+   return historydir + name + ".col"
+
+@contextlib.contextmanager
+def locked():
+   os.makedirs(historydir, exist_ok=True)
+   with open(historydir + "history.lock", "a") as lockfile:
+      fcntl.flock(lockfile, fcntl.LOCK_EX)
+      try:
+         yield
+      finally:
+         fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+def rows():
+   """
+   Number of complete rows in the history.
+   """
+   try:
+      return os.path.getsize(column_file("time")) // column_types["time"][0].itemsize
+   except OSError:
+      return 0
+
+def row_bytes(name):
+   dtype, shape = column_types[name]
+   return dtype.itemsize * int(numpy.prod(shape, dtype=int))
+
+def fit_summary(fit, scol):
+   """
+   Columns of the history row describing fit, which is the list of x
+   and y harpfit.FitResult of the envelope fits, a SigmaMatrixFit or a
+   TransportFit with its reference point at the collimator.
+    scol = s coordinate of the collimator (m)
+   """
+   if isinstance(fit, harpfit.TransportFit):
+      s0 = []
+      sigma0 = []
+      for i in (0, 2):
+         s11, s12, s22 = fit.sigma[i,i], fit.sigma[i,i+1], fit.sigma[i+1,i+1]
+         s0.append(scol - s12 / s22 if s22 > 0 else numpy.nan)
+         sigma0.append(max(s11 - s12**2 / s22, 0)**0.5 if s22 > 0 else numpy.nan)
+      return {"kind": fit_kinds.index("transport"), "par": fit.par, "covar": fit.covar,
+              "chi2": fit.chi2, "ndf": fit.ndf, "s0": s0, "sigma0": sigma0}
+   if isinstance(fit, harpfit.SigmaMatrixFit):
+      return {"kind": fit_kinds.index("joint"), "par": fit.par, "covar": fit.covar,
+              "chi2": fit.chi2, "ndf": fit.ndf, "s0": fit.par[[0, 3]],
+              "sigma0": fit.par[[1, 4]]}
+   xfit, yfit = fit
+   covar = numpy.zeros((6, 6))
+   covar[0:3,0:3] = xfit.covar
+   covar[3:6,3:6] = yfit.covar
+   return {"kind": fit_kinds.index("envelope"),
+           "par": numpy.concatenate((xfit.par, yfit.par)), "covar": covar,
+           "chi2": xfit.chi2 + yfit.chi2, "ndf": xfit.ndf + yfit.ndf,
+           "s0": (xfit.par[0], yfit.par[0]), "sigma0": (xfit.par[1], yfit.par[1])}
+
+def make_row(tool, key, harps, fit, scol, emittance, sigmas, ellipse=None):
+   """
+   The history row of one fit as a dict of column -> numpy array.
+    tool = name of the tool, one of tools
+    key = harpcache key of the fit
+    harps = dict of plane -> (s, sigma, error) lists of the harp data
+    fit = fit result, see fit_summary
+    scol = s coordinate of the collimator (m)
+    emittance = x and y emittances (mm.mrad) from the form
+    sigmas = dict of plane -> sigma (mm) at the collimator
+    ellipse = (A, B, alpha) of the beam at the collimator, or None
+   """
+   row = fit_summary(fit, scol)
+   row.update(tool=tools.index(tool), key=key.encode("ascii"),
+              collimator_spos=scol, emittance=emittance)
+   row["harps"] = numpy.full((3, 3, max_harps), numpy.nan)
+   for k, plane in enumerate("xuy"):
+      for i, values in enumerate(harps.get(plane, ())):
+         values = values[:max_harps]
+         row["harps"][k, i, :len(values)] = values
+   par = numpy.asarray(row["par"], dtype=float)
+   row["npar"] = len(par)
+   row["par"] = numpy.full(max_par, numpy.nan)
+   row["par"][:len(par)] = par
+   covar = row["covar"]
+   row["covar"] = numpy.full((max_par, max_par), numpy.nan)
+   row["covar"][:len(par),:len(par)] = covar
+   row["sigma_collimator"] = [sigmas.get(plane, numpy.nan) for plane in "xuy"]
+   row["ellipse"] = ellipse if ellipse is not None else (numpy.nan,) * 3
+   return {name: numpy.asarray(row[name], dtype=column_types[name][0])
+           for name, dtype, shape in columns if name != "time"}
+
+def row_json(row):
+   """
+   A make_row row as plain python values, so that it can be kept with
+   the harpcache entry of its fit and appended again from there.
+   """
+   return {name: (value.item().decode("ascii") if value.dtype.kind == "S"
+                  else value.tolist())
+           for name, value in row.items()}
+
+def row_from_json(doc):
+   """
+   The make_row row saved by row_json.
+   """
+   return {name: numpy.asarray(doc[name], dtype=column_types[name][0])
+           for name, dtype, shape in columns if name != "time"}
+
+def append(row):
+   """
+   Append a make_row row to the history, stamped with the current time.
+   Problems writing the history are not allowed to fail the request.
+   """
+   try:
+      with locked():
+         n = rows()
+         for name, dtype, shape in columns:
+            # drop what a cut off append left beyond the complete rows
+            path = column_file(name)
+            if os.path.exists(path) and os.path.getsize(path) > n * row_bytes(name):
+               os.truncate(path, n * row_bytes(name))
+         if n > 0:
+            last = column("time")[-1]
+            row["time"] = numpy.asarray(max(time.time(), last))
+         else:
+            row["time"] = numpy.asarray(time.time())
+         for name, dtype, shape in columns:
+            with open(column_file(name), "ab") as f:
+               f.write(row[name].tobytes())
+   except OSError as err:
+      sys.stderr.write("harphistory: cannot append fit: {0}\n".format(err))
+
+def column(name, nrows=None):
+   """
+   Read-only memory map of the first nrows (default all) rows of a
+   column, with shape [nrows, ...].
+   """
+   dtype, shape = column_types[name]
+   if nrows is None:
+      nrows = rows()
+   if nrows == 0:
+      return numpy.zeros((0,) + shape, dtype=dtype)
+   return numpy.memmap(column_file(name), dtype=dtype, mode="r", shape=(nrows,) + shape)
+
+def time_range(start=None, stop=None, nrows=None):
+   """
+   Range of rows [first, last) with start <= time < stop, found by a
+   binary search of the time column.
+   """
+   times = column("time", nrows)
+   first = 0 if start is None else int(numpy.searchsorted(times, start, side="left"))
+   last = len(times) if stop is None else int(numpy.searchsorted(times, stop, side="left"))
+   return first, max(first, last)
+
+def select(start=None, stop=None, names=None):
+   """
+   Columns names (default all) of the fits made between the times start
+   and stop (s since the epoch), as a dict of column -> array.
+   """
+   nrows = rows()
+   first, last = time_range(start, stop, nrows)
+   names = names or [name for name, dtype, shape in columns]
+   return {name: numpy.array(column(name, nrows)[first:last]) for name in names}
+
+def quantity(name, first, last, nrows):
+   col, index = quantities[name]
+   values = column(col, nrows)[first:last]
+   return values if index is None else values[:, index]
+
+def trend(names, start, stop, nbins=200, tool=None):
+   """
+   Downsampled trends of the quantities names between the times start
+   and stop, in nbins equal bins of time. Returns the bin edges[nbins+1]
+   and a dict of name -> (count, mean, lower, upper) arrays[nbins] with
+   the number of fits with a finite value, their mean, minimum and
+   maximum in each bin, nan where the bin is empty.
+    tool = only the fits of this tool, or None for all
+   """
+   nrows = rows()
+   first, last = time_range(start, stop, nrows)
+   edges = numpy.linspace(start, stop, nbins + 1)
+   times = column("time", nrows)[first:last]
+   bounds = numpy.searchsorted(times, edges[:-1], side="left")
+   filled = bounds < len(times)
+   offsets = bounds[filled]
+   mask = numpy.ones(len(times), dtype=bool)
+   if tool is not None:
+      mask = column("tool", nrows)[first:last] == tools.index(tool)
+   results = {}
+   for name in names:
+      values = numpy.asarray(quantity(name, first, last, nrows), dtype=float)
+      good = mask & numpy.isfinite(values)
+      count = numpy.zeros(nbins)
+      mean = numpy.full(nbins, numpy.nan)
+      lower = numpy.full(nbins, numpy.nan)
+      upper = numpy.full(nbins, numpy.nan)
+      if len(offsets) > 0:
+         n = numpy.add.reduceat(good, offsets).astype(float)
+         # reduceat returns the first element for a bin that is empty
+         n[numpy.append(offsets[1:], len(times)) == offsets] = 0
+         total = numpy.add.reduceat(numpy.where(good, values, 0), offsets)
+         lo = numpy.minimum.reduceat(numpy.where(good, values, numpy.inf), offsets)
+         hi = numpy.maximum.reduceat(numpy.where(good, values, -numpy.inf), offsets)
+         seen = n > 0
+         bins = numpy.flatnonzero(filled)[seen]
+         count[filled] = n
+         mean[bins] = total[seen] / n[seen]
+         lower[bins] = lo[seen]
+         upper[bins] = hi[seen]
+      results[name] = (count, mean, lower, upper)
+   return edges, results
+
+def read_range(form):
+   """
+   Number of days back and of time bins for the trend page from the
+   form, clamped to max_days and max_bins, with the defaults in place of
+   a value that is not a number. Returns days, nbins and an error message
+   or None.
+   """
+   values = {}
+   error = None
+   for par, default, limit, convert in (("days", 30, max_days, float),
+                                        ("nbins", 200, max_bins, int)):
+      try:
+         value = convert(form.getfirst(par, default))
+         if not value > 0:
+            raise ValueError
+      except (TypeError, ValueError):
+         error = par + " must be a positive number"
+         value = default
+      values[par] = min(value, limit)
+   return values["days"], values["nbins"], error
+
+def print_page(form):
+   """
+   Trend page of the focus position, focus size and collimator spot size
+   of the fits over the last days given in the form.
+   """
+   days, nbins, error = read_range(form)
+   tool = form.getfirst("tool")
+   tool = tool if tool in tools else None
+   stop = time.time()
+   start = stop - days * 86400
+   print("Content-Type: text/html")
+   print()
+   print("<html>")
+   print("<head><title>Harp fit history</title></head>")
+   print("<body>")
+   print("<h1>Harp fit history</h1>")
+   print("<form method=\"get\">")
+   print("last <input type=\"text\" name=\"days\" value=\"{0:g}\" size=\"6\"> days".format(days))
+   print("in <input type=\"text\" name=\"nbins\" value=\"{0}\" size=\"6\"> bins".format(nbins))
+   print("from <select name=\"tool\">")
+   for name in ("",) + tools:
+      selected = " selected" if name == (tool or "") else ""
+      print("<option value=\"{0}\"{1}>{2}</option>".format(name, selected, name or "all tools"))
+   print("</select>")
+   print("<input type=\"submit\" value=\"show\">")
+   print("</form>")
+   if error is not None:
+      print("<p><font color=\"red\">")
+      print("Invalid input: " + html.escape(error) + ", please correct it and try again!")
+      print("</font></p>")
+      print("</body>")
+      print("</html>")
+      return
+   with metrics.phase("query"):
+      names = [name for title, unit, curves in figures for name, color in curves]
+      edges, trends = trend(names, start, stop, nbins, tool)
+   count = trends[names[0]][0]
+   print("<p>{0} fits between {1} and {2}, {3} rows in the history</p>".format(
+         int(count.sum()), time.strftime("%Y-%m-%d %H:%M", time.localtime(start)),
+         time.strftime("%Y-%m-%d %H:%M", time.localtime(stop)), rows()))
+   t = ((edges[:-1] + edges[1:]) / 2 - stop) / 86400
+   with metrics.phase("svg plot"):
+      for k, (title, unit, curves) in enumerate(figures):
+         print("<h2>" + title + "</h2>")
+         print("<p>" + ", ".join("<font color=\"{0}\">{1}</font>".format(
+               harpplot.colors[color], name) for name, color in curves) + "</p>")
+         print(harpplot.trend_figure("history-{0}".format(k), t, (-days, 0), unit,
+                                     [trends[name][1:] + (color,) for name, color in curves]))
+   if form.getfirst("debug"):
+      print("<table>" + metrics.html(colspan=1) + "</table>")
+   print("</body>")
+   print("</html>")
+
+def main(environ=None):
+   """
+   environ = cgi environment to read the form from (default os.environ)
+   """
+   global metrics
+   metrics = toolmetrics.Timer("harphistory")
+   if environ is None:
+      form = cgi.FieldStorage()
+   else:
+      form = cgi.FieldStorage(environ=environ)
+   print_page(form)
+   metrics.finish()
+
+def print_summary():
+   nrows = rows()
+   print("{0} fits in {1}".format(nrows, historydir))
+   if nrows == 0:
+      return
+   times = column("time", nrows)
+   print("from {0} to {1}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(times[0])),
+                                  time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(times[-1]))))
+   for k, tool in enumerate(tools):
+      print("{0:12s} {1:8d} fits".format(tool, int((column("tool", nrows) == k).sum())))
+   size = sum(os.path.getsize(column_file(name)) for name, dtype, shape in columns)
+   print("{0:.1f} kB on disk, {1} bytes per fit".format(size / 1024, size // nrows))
+
+def print_trend(days, nbins, tool=None):
+   stop = time.time()
+   names = ["s0_x", "s0_y", "sigma0_x", "sigma0_y", "sigma_collimator_x", "sigma_collimator_y"]
+   edges, trends = trend(names, stop - days * 86400, stop, nbins, tool)
+   print("{0:16s} {1:>5s}".format("bin start", "fits") +
+         "".join(" {0:>18s}".format(name) for name in names))
+   for i in range(nbins):
+      print("{0:16s} {1:5d}".format(time.strftime("%Y-%m-%d %H:%M", time.localtime(edges[i])),
+                                    int(trends[names[0]][0][i])) +
+            "".join(" {0:18.4f}".format(trends[name][1][i]) for name in names))
+
+if __name__ == "__main__":
+   if "GATEWAY_INTERFACE" in os.environ:
+      main()
+      sys.exit(0)
+   parser = argparse.ArgumentParser(description="history of the harp scan fits")
+   parser.add_argument("--days", type=float, help="show the trends over the last days")
+   parser.add_argument("--nbins", type=int, default=20, help="time bins of the trends")
+   parser.add_argument("--tool", choices=tools, help="only the fits of this tool")
+   args = parser.parse_args()
+   if args.days:
+      print_trend(args.days, args.nbins, args.tool)
+   else:
+      print_summary()
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+#
+# harpplot.py - lightweight svg renderer for the harp scan plots, used by
+#               harptool.py and harptool_2d.py as an alternative to the
+#               ROOT TCanvas. It draws the same figures (data points with
+#               errors, fit curve, error band, collimator line, spec arrow
+#               and beam ellipses) directly as svg text that can be put
+#               inline in the html response, so nothing is written to the
+#               work directory and ROOT is not needed.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import math
+import html
+
+# svg equivalents of the ROOT color indices used by the harp tools
+colors = {1: "#000000", 2: "#ff0000", 3: "#00ff00", 4: "#0000ff",
+          5: "#ffff00", 6: "#ff00ff", "red": "#ff0000",
+          "green": "#00ff00", "blue": "#0000ff", "black": "#000000"}
+
+def nice_ticks(lo, hi, nticks=8):
+   """
+   Round-numbered tick positions spanning the interval [lo, hi].
+   """
+   if hi <= lo:
+      return [lo]
+   step = 10**math.floor(math.log10((hi - lo) / nticks))
+   for mult in (1, 2, 5, 10):
+      if (hi - lo) / (step * mult) <= nticks:
+         step *= mult
+         break
+   first = math.ceil(lo / step - 1e-9)
+   last = math.floor(hi / step + 1e-9)
+   return [n * step for n in range(first, last + 1)]
+
+def tick_label(value):
+   return "{0:g}".format(round(value, 10))
+
+class SVGCanvas:
+   """
+   A single pad with a frame, labelled axes and user coordinates,
+   collecting svg elements that are returned by svg(). The name must
+   be unique within the html page that the svg is put into.
+   """
+   def __init__(self, name, width, height, xlim, ylim, xtitle="", ytitle="",
+                margins=(80, 20, 20, 60)):
+      self.name = name
+      self.width = width
+      self.height = height
+      self.xlim = xlim
+      self.ylim = ylim
+      self.xtitle = xtitle
+      self.ytitle = ytitle
+      self.left, self.right, self.top, self.bottom = margins
+      self.elements = []
+
+   def px(self, x):
+      frac = (x - self.xlim[0]) / (self.xlim[1] - self.xlim[0])
+      return self.left + frac * (self.width - self.left - self.right)
+
+   def py(self, y):
+      frac = (y - self.ylim[0]) / (self.ylim[1] - self.ylim[0])
+      return self.height - self.bottom - frac * (self.height - self.top -
+                                                 self.bottom)
+
+   def points(self, xs, ys):
+      return " ".join("{0:.2f},{1:.2f}".format(self.px(x), self.py(y))
+                      for x, y in zip(xs, ys))
+
+   def polyline(self, xs, ys, color="black", width=1):
+      self.elements.append("<polyline points=\"{0}\" fill=\"none\" "
+                           "stroke=\"{1}\" stroke-width=\"{2}\" "
+                           "clip-path=\"url(#{name}-frame)\"/>"
+                           .format(self.points(xs, ys), colors[color], width,
+                                   name=self.name))
+
+   def polygon(self, xs, ys, color="black", opacity=0.2):
+      self.elements.append("<polygon points=\"{0}\" fill=\"{1}\" "
+                           "fill-opacity=\"{2}\" stroke=\"none\" "
+                           "clip-path=\"url(#{name}-frame)\"/>"
+                           .format(self.points(xs, ys), colors[color], opacity,
+                                   name=self.name))
+
+   def errorbars(self, xs, ys, yerrs, color="black", width=2, radius=4):
+      for x, y, e in zip(xs, ys, yerrs):
+         self.polyline((x, x), (y - e, y + e), color, width)
+         self.elements.append("<circle cx=\"{0:.2f}\" cy=\"{1:.2f}\" "
+                              "r=\"{2}\" fill=\"{3}\"/>"
+                              .format(self.px(x), self.py(y), radius,
+                                      colors[color]))
+
+   def arrow(self, x0, y0, x1, y1, color="black", head=12, angle=35):
+      """
+      Line from (x0,y0) to (x1,y1) with the arrow head at (x0,y0),
+      like a ROOT TArrow drawn with option "<|".
+      """
+      self.polyline((x0, x1), (y0, y1), color)
+      px0, py0 = self.px(x0), self.py(y0)
+      phi = math.atan2(self.py(y1) - py0, self.px(x1) - px0)
+      half = math.radians(angle) / 2
+      corners = [(px0, py0)]
+      for sign in (-1, 1):
+         corners.append((px0 + head * math.cos(phi + sign * half),
+                         py0 + head * math.sin(phi + sign * half)))
+      self.elements.append("<polygon points=\"{0}\" fill=\"{1}\"/>".format(
+                           " ".join("{0:.2f},{1:.2f}".format(*c)
+                                    for c in corners), colors[color]))
+
+   def ellipse(self, x, y, a, b, theta, color="black", fill=None,
+               opacity=0.3):
+      """
+      Ellipse centered at (x,y) with semi-axes a, b rotated by theta
+      degrees counterclockwise, as for a ROOT TEllipse.
+      """
+      cx, cy = self.px(x), self.py(y)
+      rx = abs(self.px(x + a) - cx)
+      ry = abs(self.py(y + b) - cy)
+      if not (math.isfinite(rx) and math.isfinite(ry)):
+         return
+      style = "fill=\"none\""
+      if fill is not None:
+         style = "fill=\"{0}\" fill-opacity=\"{1}\"".format(colors[fill],
+                                                            opacity)
+      self.elements.append("<ellipse cx=\"{0:.2f}\" cy=\"{1:.2f}\" "
+                           "rx=\"{2:.2f}\" ry=\"{3:.2f}\" {4} stroke=\"{5}\" "
+                           "transform=\"rotate({6:.3f} {0:.2f} {1:.2f})\" "
+                           "clip-path=\"url(#{name}-frame)\"/>"
+                           .format(cx, cy, rx, ry, style, colors[color],
+                                   -theta, name=self.name))
+
+   def frame(self):
+      x0, x1 = self.px(self.xlim[0]), self.px(self.xlim[1])
+      y0, y1 = self.py(self.ylim[0]), self.py(self.ylim[1])
+      out = ["<rect x=\"{0:.2f}\" y=\"{1:.2f}\" width=\"{2:.2f}\" "
+             "height=\"{3:.2f}\" fill=\"none\" stroke=\"black\"/>"
+             .format(x0, y1, x1 - x0, y0 - y1)]
+      for x in nice_ticks(*self.xlim):
+         out.append("<line x1=\"{0:.2f}\" y1=\"{1:.2f}\" x2=\"{0:.2f}\" "
+                    "y2=\"{2:.2f}\" stroke=\"black\"/>"
+                    .format(self.px(x), y0, y0 - 10))
+         out.append("<text x=\"{0:.2f}\" y=\"{1:.2f}\" "
+                    "text-anchor=\"middle\">{2}</text>"
+                    .format(self.px(x), y0 + 20, tick_label(x)))
+      for y in nice_ticks(*self.ylim):
+         out.append("<line x1=\"{0:.2f}\" y1=\"{1:.2f}\" x2=\"{2:.2f}\" "
+                    "y2=\"{1:.2f}\" stroke=\"black\"/>"
+                    .format(x0, self.py(y), x0 + 10))
+         out.append("<text x=\"{0:.2f}\" y=\"{1:.2f}\" text-anchor=\"end\" "
+                    "dominant-baseline=\"middle\">{2}</text>"
+                    .format(x0 - 6, self.py(y), tick_label(y)))
+      out.append("<text x=\"{0:.2f}\" y=\"{1:.2f}\" text-anchor=\"end\">"
+                 "{2}</text>".format(x1, self.height - 15, self.xtitle))
+      out.append("<text x=\"15\" y=\"{0:.2f}\" text-anchor=\"end\" "
+                 "transform=\"rotate(-90 15 {0:.2f})\">{1}</text>"
+                 .format(y1, self.ytitle))
+      return out
+
+   def svg(self):
+      x0, x1 = self.px(self.xlim[0]), self.px(self.xlim[1])
+      y0, y1 = self.py(self.ylim[0]), self.py(self.ylim[1])
+      head = ["<svg xmlns=\"http://www.w3.org/2000/svg\" width=\"{0}\" "
+              "height=\"{1}\" viewBox=\"0 0 {0} {1}\" font-family=\"helvetica,"
+              "arial\" font-size=\"14\">".format(self.width, self.height),
+              "<rect width=\"100%\" height=\"100%\" fill=\"white\"/>",
+              "<clipPath id=\"{4}-frame\"><rect x=\"{0:.2f}\" y=\"{1:.2f}\" "
+              "width=\"{2:.2f}\" height=\"{3:.2f}\"/></clipPath>"
+              .format(x0, y1, x1 - x0, y0 - y1, self.name)]
+      return "\n".join(head + self.elements + self.frame() + ["</svg>"])
+
+def sigma_title(plane):
+   """
+   Axis title for sigma in the given plane, as "#sigma_{x} (mm)" in ROOT.
+   """
+   return ("&#963;<tspan baseline-shift=\"sub\" font-size=\"10\">" +
+           html.escape(plane) + "</tspan> (mm)")
+
+def envelope_figure(plane, color, slimits, s, curve, lower, upper,
+                    sdata, sigdata, errdata, scol, spec, ymax):
+   """
+   Svg figure of the envelope fit in one plane, matching the ROOT plot
+   drawn by fit_and_plot.
+    s, curve, lower, upper = fitted sigma and its error band on a grid
+    sdata, sigdata, errdata = harp measurements with their errors
+    scol = s coordinate of the collimator (m)
+    spec = specified maximum sigma at the collimator (mm)
+   """
+   c1 = SVGCanvas("harp-" + plane, 800, 600, slimits, (0, ymax),
+                  "accelerator s coordinate (m)", sigma_title(plane))
+   c1.polyline(s, curve, color, 2)
+   c1.errorbars(sdata, sigdata, errdata, color)
+   xs = list(s) + list(s[::-1])
+   ys = list(lower) + list(upper[::-1])
+   c1.polygon(xs, ys, color, 0.2)
+   c1.polyline((scol, scol), (0, 1.5))
+   c1.arrow(scol, spec, slimits[1], spec)
+   return c1.svg()
+
+def trend_figure(name, t, tlimits, ytitle, curves):
+   """
+   Svg figure of quantities binned in time, drawn as a line through the
+   bin means over a band from the bin minimum to maximum, broken where
+   bins are empty.
+    t = bin centers (days)
+    tlimits = range of t to show
+    curves = list of (mean, lower, upper, color) with nan in empty bins
+   """
+   lows = [v for mean, lower, upper, color in curves for v in lower if math.isfinite(v)]
+   highs = [v for mean, lower, upper, color in curves for v in upper if math.isfinite(v)]
+   if lows:
+      pad = max((max(highs) - min(lows)) * 0.05, abs(max(highs)) * 1e-3, 1e-6)
+      ylimits = (min(lows) - pad, max(highs) + pad)
+   else:
+      ylimits = (0, 1)
+   c1 = SVGCanvas(name, 800, 300, tlimits, ylimits, "time (days)", ytitle)
+   for mean, lower, upper, color in curves:
+      segment = []
+      for i in range(len(t) + 1):
+         if i < len(t) and math.isfinite(mean[i]):
+            segment.append(i)
+            continue
+         if segment:
+            ts = [t[j] for j in segment]
+            c1.polygon(ts + ts[::-1], [lower[j] for j in segment] +
+                       [upper[j] for j in segment[::-1]], color, 0.2)
+            c1.polyline(ts, [mean[j] for j in segment], color, 2)
+            if len(segment) == 1:
+               c1.errorbars(ts, [mean[segment[0]]], [0], color, 1, 2)
+         segment = []
+   return c1.svg()
+
+def ellipse_figure(ellipses, limits=(-2, 2), bands=()):
+   """
+   Svg figure of beam ellipses centered on the beam axis, matching the
+   ROOT plot drawn by fit_and_plot_2d.
+    ellipses = list of (A, B, alpha, color, fill) with semi-axes A, B (mm),
+               tilt alpha (rad), line color and fill color or None
+    bands = list of (xs, ys, color) outlines (mm) of shaded regions
+   """
+   c1 = SVGCanvas("harp-2d", 600, 600, limits, limits, "x (mm)", "y (mm)")
+   for xs, ys, color in bands:
+      c1.polygon(xs, ys, color, opacity=0.3)
+   for A, B, alpha, color, fill in ellipses:
+      c1.ellipse(0, 0, A, B, -alpha * 180/math.pi, color, fill)
+   return c1.svg()
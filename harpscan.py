@@ -0,0 +1,241 @@
+#!/usr/bin/python
+#
+# harpscan.py - ingestion of raw harp wire-scan profiles for harptool.py
+#               and harptool_2d.py. Each profile is fitted to a gaussian on
+#               a linear background, all profiles of a scan (or of many
+#               scans) together in one batched least-squares fit, and the
+#               fitted sigmas and their errors are returned as the form
+#               fields of the harp tools, ready for the envelope fits.
+#
+# usage: harpscan.py [--fit] [--query] PROFILE... | DIRECTORY
+#        harpscan.py [--fit] [--chunk N] [-o OUTPUT] --archive SCANS.npy
+#
+# Profile files are named <harp>_<plane>.<ext>, for example harp5C11B_u.txt
+# or radHarp_x.npy, with harp one of the monitors in beamline.json and plane
+# one of x, u, y. A .npy profile holds an array [n, 2] of wire position (mm)
+# and signal, or [n, 3] with the signal errors in the last column, and is
+# memory-mapped; text profiles have the same columns, separated by blanks
+# or commas, and are read as a stream. An archive is a .npy array of shape
+# [nscans, 3 * nmonitors, n, 2 or 3] with the profiles of each scan in the
+# order x, u, y of each monitor in beamline.json, and is memory-mapped
+# and processed chunk by chunk, so it never has to fit in memory. Missing
+# profiles in an archive are filled with nan.
+#
+# The output is a json object of form fields per scan (json lines for an
+# archive), with the harptool_2d fit results added under "fit" by --fit.
+# With --query, the fields of a single scan are printed instead as a query
+# string for harptool.cgi and harptool_2d.cgi.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import re
+import sys
+import json
+import argparse
+import urllib.parse
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harpfit
+import beamline
+
+harps = tuple(beamline.load().names())
+planes = "xuy"
+profile_pattern = re.compile("^(" + "|".join(re.escape(h) for h in harps) +
+                             r")[_-]([xuy])\.(npy|txt|dat|csv)$")
+
+def read_profile(filename):
+   """
+   Return the samples of one profile file as an array [n, 2 or 3],
+   memory-mapped for .npy files and streamed from text otherwise.
+   """
+   if filename.endswith(".npy"):
+      return numpy.load(filename, mmap_mode="r")
+   with open(filename) as f:
+      return numpy.loadtxt((line.replace(",", " ") for line in f), ndmin=2)
+
+def find_profiles(paths):
+   """
+   Collect the profile files among paths, and in any directories among
+   them, as a dict (harp, plane) -> filename.
+   """
+   files = {}
+   for path in paths:
+      names = [path]
+      if os.path.isdir(path):
+         names = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+      for name in names:
+         match = profile_pattern.match(os.path.basename(name))
+         if match:
+            files[(match.group(1), match.group(2))] = name
+   return files
+
+def profile_model(x, par):
+   """
+   x[..., n] = wire position (mm) relative to the profile center
+   par[..., 0] = gaussian amplitude
+   par[..., 1] = gaussian mean (mm)
+   par[..., 2] = gaussian sigma (mm)
+   par[..., 3] = background at the profile center
+   par[..., 4] = background slope (1/mm)
+   """
+   z = (x - par[..., 1, None]) / par[..., 2, None]
+   return (par[..., 0, None] * numpy.exp(-z**2 / 2) +
+           par[..., 3, None] + par[..., 4, None] * x)
+
+def profile_gradient(x, par):
+   """
+   Derivatives of profile_model(x, par) with respect to par[..., i],
+   returned with shape [..., n, 5].
+   """
+   z = (x - par[..., 1, None]) / par[..., 2, None]
+   g = numpy.exp(-z**2 / 2)
+   Ag = par[..., 0, None] * g
+   return numpy.stack((g, Ag * z / par[..., 2, None],
+                       Ag * z**2 / par[..., 2, None],
+                       numpy.ones_like(x), x), axis=-1)
+
+def fit_profiles(profiles):
+   """
+   Fit all profiles in one batch.
+    profiles[k] = array [n_k, 2 or 3] of wire position (mm), signal and
+                  optionally signal error, which is taken from counting
+                  statistics if not given; an empty or non-finite profile
+                  is treated as missing
+   Returns arrays of the fitted sigma (mm) and its error (mm), which is
+   scaled up by sqrt(chi2/ndf) when the fit is worse than the errors
+   allow. Missing or failed fits have sigma and error 0, which the harp
+   tools read as an unmeasured entry.
+   """
+   nprof = len(profiles)
+   npoints = max([len(p) for p in profiles] + [6])
+   xx = numpy.zeros((nprof, npoints))
+   yy = numpy.zeros((nprof, npoints))
+   ww = numpy.zeros((nprof, npoints))
+   par = numpy.ones((nprof, 5))
+   par[:,4] = 0
+   for k, prof in enumerate(profiles):
+      prof = numpy.asarray(prof, dtype=float)
+      if len(prof) < 6 or not numpy.all(numpy.isfinite(prof)):
+         continue
+      n = len(prof)
+      center = numpy.mean(prof[:,0])
+      xx[k,:n] = prof[:,0] - center
+      yy[k,:n] = prof[:,1]
+      if prof.shape[1] > 2:
+         ww[k,:n] = 1 / prof[:,2]
+      else:
+         ww[k,:n] = 1 / numpy.maximum(numpy.abs(prof[:,1]), 1)**0.5
+      edges = numpy.concatenate((prof[:max(n//20, 1),1], prof[-max(n//20, 1):,1]))
+      peak = numpy.argmax(prof[:,1])
+      par[k,3] = numpy.mean(edges)
+      par[k,0] = prof[peak,1] - par[k,3]
+      par[k,1] = xx[k,peak]
+      area = numpy.sum(numpy.maximum(prof[:,1] - par[k,3], 0) *
+                       numpy.abs(numpy.gradient(prof[:,0])))
+      par[k,2] = max(abs(area / (par[k,0] * (2 * numpy.pi)**0.5)), 1e-3)
+   missing = numpy.sum(ww > 0, axis=-1) < 6
+
+   def resid(par):
+      r = (profile_model(xx, par) - yy) * ww
+      J = profile_gradient(xx, par) * ww[..., None]
+      return r, J
+
+   par, chi2, covar = harpfit.minimize(resid, par, True)
+   ndf = numpy.maximum(numpy.sum(ww > 0, axis=-1) - 5, 1)
+   scale = numpy.maximum(chi2 / ndf, 1)**0.5
+   sigma = numpy.abs(par[:,2])
+   sigma_err = numpy.abs(covar[:,2,2])**0.5 * scale
+   bad = missing | ~numpy.isfinite(sigma) | ~numpy.isfinite(sigma_err)
+   return numpy.where(bad, 0, sigma), numpy.where(bad, 0, sigma_err)
+
+def scan_fields(sigma, sigma_err):
+   """
+   Form fields of the harp tools for the sigmas and errors of the
+   profiles of one scan, in archive order.
+   """
+   fields = {}
+   for i, harp in enumerate(harps):
+      for j, plane in enumerate(planes):
+         k = 3 * i + j
+         fields[harp + "_" + plane + "sigma"] = round(float(sigma[k]), 6)
+         fields[harp + "_" + plane + "sigma_err"] = round(float(sigma_err[k]), 6)
+   return fields
+
+def fit_fields(fields):
+   """
+   Run the harptool_2d envelope fits on the form fields of one scan,
+   with the web form defaults for the fields that are not given.
+   """
+   import harpbatch
+   harpbatch.harptool_2d.form = harpbatch.ScanForm(fields)
+   harpbatch.harptool_2d.optics = harpbatch.optics
+   harpbatch.harptool_2d.reset()
+   return harpbatch.harptool_2d.scan_results()
+
+def process_files(paths, fit=False):
+   """
+   Fit the profiles of one scan given as files or directories, and
+   return its form fields.
+   """
+   files = find_profiles(paths)
+   profiles = []
+   for harp in harps:
+      for plane in planes:
+         if (harp, plane) in files:
+            profiles.append(read_profile(files[(harp, plane)]))
+         else:
+            profiles.append(numpy.zeros((0, 2)))
+   fields = scan_fields(*fit_profiles(profiles))
+   if fit:
+      fields["fit"] = fit_fields(fields)
+   return fields
+
+def process_archive(filename, output, chunk=64, fit=False):
+   """
+   Fit the profiles of all scans in a memory-mapped archive, chunk scans
+   at a time, writing the form fields of each scan as a line of json.
+   Returns the number of scans.
+   """
+   archive = numpy.load(filename, mmap_mode="r")
+   nscans = archive.shape[0]
+   for start in range(0, nscans, chunk):
+      block = numpy.asarray(archive[start:start + chunk], dtype=float)
+      profiles = block.reshape(-1, *block.shape[2:])
+      sigma, sigma_err = fit_profiles(profiles)
+      nprof = 3 * len(harps)
+      for n in range(len(block)):
+         fields = scan_fields(sigma[nprof*n:nprof*(n+1)],
+                              sigma_err[nprof*n:nprof*(n+1)])
+         fields["scan"] = start + n
+         if fit:
+            fields["fit"] = fit_fields(fields)
+         output.write(json.dumps(fields) + "\n")
+      output.flush()
+   return nscans
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="fit raw harp wire-scan profiles")
+   parser.add_argument("paths", nargs="*", help="profile files or directories of one scan")
+   parser.add_argument("--archive", help="memory-mapped .npy archive of many scans")
+   parser.add_argument("--chunk", type=int, default=64,
+                       help="archive scans fitted together in one batch")
+   parser.add_argument("-o", "--output", default="-",
+                       help="json lines output file for --archive (default stdout)")
+   parser.add_argument("--fit", action="store_true",
+                       help="also run the harptool_2d envelope fits")
+   parser.add_argument("--query", action="store_true",
+                       help="print the sigmas as a harptool query string")
+   args = parser.parse_args()
+   if args.archive:
+      if args.output == "-":
+         process_archive(args.archive, sys.stdout, args.chunk, args.fit)
+      else:
+         with open(args.output, "w") as output:
+            process_archive(args.archive, output, args.chunk, args.fit)
+   elif args.query:
+      print(urllib.parse.urlencode(process_files(args.paths)))
+   else:
+      print(json.dumps(process_files(args.paths, args.fit)))
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+#
+# harpserver.py - persistent http server for the harptool.py and
+#                 harptool_2d.py fitting tools, serving requests from a
+#                 pool of worker processes that have numpy and ROOT
+#                 already loaded, so each click skips the interpreter
+#                 and ROOT startup of the plain cgi path.
+#
+# usage: harpserver.py [--host H] [--port P] [--workers N] [--max-requests M]
+#        harpserver.py --forward harptool.py
+#
+# The server listens on host:port and advertises its address in the file
+# work/harpserver.addr. The *.cgi gateways look for this file and, if it
+# is present, relay the request through "harpserver.py --forward". If
+# the server cannot be reached, the forwarder falls back to running the
+# worker script directly as a cold-start cgi, exactly as before.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import sys
+import os
+import io
+import signal
+import time
+import argparse
+import contextlib
+import http.client
+import http.server
+import urllib.parse
+
+tools = ("harptool", "harptool_2d")
+basedir = os.path.dirname(os.path.abspath(__file__))
+addrfile = basedir + "/work/harpserver.addr"
+# headers of the server reply that the web server sets for itself
+hop_headers = ("connection", "content-length", "date", "server",
+               "transfer-encoding", "keep-alive")
+
+class HarpRequestHandler(http.server.BaseHTTPRequestHandler):
+   """
+   Serves /<tool>.cgi?<query> by calling <tool>.main in this worker,
+   and /work/<file> from the work directory for the plot images.
+   """
+   def do_GET(self):
+      url = urllib.parse.urlsplit(self.path)
+      name = os.path.basename(url.path)
+      if name.endswith(".cgi") and name[:-4] in self.server.modules:
+         self.run_tool(self.server.modules[name[:-4]], url.query)
+      elif os.path.dirname(url.path).endswith("/work"):
+         self.send_file(basedir + "/work/" + name)
+      else:
+         self.send_error(404)
+
+   def run_tool(self, module, query):
+      self.server.served += 1
+      environ = {"REQUEST_METHOD": "GET", "QUERY_STRING": query}
+      name = str(os.getpid()) + "-" + str(self.server.served)
+      out = io.StringIO()
+      status = 200
+      with contextlib.redirect_stdout(out):
+         try:
+            module.main(environ, name)
+         except Exception:
+            import cgitb
+            # replace the partial page with the traceback
+            out = io.StringIO("Content-Type: text/html\n\n" + cgitb.html(sys.exc_info()))
+            status = 500
+      head, sep, body = out.getvalue().partition("\n\n")
+      if not sep:
+         head, body = "Content-Type: text/html", head
+      body = body.encode("utf-8")
+      headers = []
+      for line in head.split("\n"):
+         key, sep, value = line.partition(":")
+         if not sep:
+            continue
+         if key.strip().lower() == "status":
+            # a cgi status header set by the tool itself
+            status = int(value.split()[0])
+         else:
+            headers.append((key.strip(), value.strip()))
+      self.send_response(status)
+      for key, value in headers:
+         self.send_header(key, value)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def send_file(self, path):
+      types = {".png": "image/png", ".pdf": "application/pdf",
+               ".svg": "image/svg+xml", ".gif": "image/gif"}
+      try:
+         with open(path, "rb") as f:
+            data = f.read()
+      except OSError:
+         self.send_error(404)
+         return
+      self.send_response(200)
+      self.send_header("Content-Type", types.get(os.path.splitext(path)[1],
+                                                 "application/octet-stream"))
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+   def log_message(self, format, *args):
+      pass
+
+def worker(sock, max_requests):
+   """
+   Body of one worker process: load the tools once, then serve up to
+   max_requests requests from the shared listening socket and exit.
+   """
+   signal.signal(signal.SIGINT, signal.SIG_IGN)
+   signal.signal(signal.SIGTERM, signal.SIG_DFL)
+   sys.argv[0] = basedir + "/harpserver.py"
+   sys.path.insert(0, basedir)
+   httpd = http.server.HTTPServer(sock.getsockname(), HarpRequestHandler,
+                                  bind_and_activate=False)
+   httpd.socket.close()
+   httpd.socket = sock
+   httpd.modules = {}
+   for tool in tools:
+      httpd.modules[tool] = __import__(tool)
+   httpd.served = 0
+   while httpd.served < max_requests:
+      httpd.handle_request()
+   os._exit(0)
+
+def serve(host, port, workers, max_requests):
+   """
+   Open the listening socket and keep a pool of forked workers running
+   on it, replacing each worker when it exits after max_requests.
+   """
+   httpd = http.server.HTTPServer((host, port), HarpRequestHandler)
+   sock = httpd.socket
+   children = set()
+
+   def spawn():
+      pid = os.fork()
+      if pid == 0:
+         try:
+            worker(sock, max_requests)
+         finally:
+            os._exit(1)
+      children.add(pid)
+
+   def shutdown(signum, frame):
+      for pid in children:
+         try:
+            os.kill(pid, signal.SIGTERM)
+         except OSError:
+            pass
+      if os.path.exists(addrfile):
+         os.remove(addrfile)
+      sys.exit(0)
+
+   signal.signal(signal.SIGTERM, shutdown)
+   signal.signal(signal.SIGINT, shutdown)
+   for n in range(workers):
+      spawn()
+   with open(addrfile, "w") as f:
+      f.write("{0}:{1}\n".format(*sock.getsockname()[:2]))
+   while True:
+      pid, status = os.wait()
+      children.discard(pid)
+      if status != 0:
+         time.sleep(1)
+      spawn()
+
+def forward(script):
+   """
+   Relay the current cgi request to a running harpserver, or fall back
+   to executing the worker script directly if none is reachable. The
+   status of the reply is passed on as a cgi Status header.
+   """
+   tool = os.path.splitext(os.path.basename(script))[0]
+   query = os.environ.get("QUERY_STRING", "")
+   try:
+      with open(addrfile) as f:
+         host, port = f.read().strip().rsplit(":", 1)
+      conn = http.client.HTTPConnection(host, int(port), timeout=300)
+      conn.request("GET", "/" + tool + ".cgi?" + query)
+      resp = conn.getresponse()
+      body = resp.read()
+   except (OSError, ValueError, http.client.HTTPException):
+      os.execv(sys.executable, [sys.executable, script])
+   head = []
+   if resp.status != 200:
+      head.append("Status: {0} {1}".format(resp.status, resp.reason))
+   for key, value in resp.getheaders():
+      if key.lower() not in hop_headers:
+         head.append(key + ": " + value)
+   if resp.getheader("Content-Type") is None:
+      head.append("Content-Type: text/html")
+   sys.stdout.write("\n".join(head) + "\n\n")
+   sys.stdout.flush()
+   sys.stdout.buffer.write(body)
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="persistent harptool server")
+   parser.add_argument("--host", default="127.0.0.1")
+   parser.add_argument("--port", type=int, default=8642)
+   parser.add_argument("--workers", type=int, default=4,
+                       help="number of preloaded worker processes")
+   parser.add_argument("--max-requests", type=int, default=200,
+                       help="requests served by a worker before it is recycled")
+   parser.add_argument("--forward", metavar="SCRIPT",
+                       help="relay one cgi request to the running server")
+   args = parser.parse_args()
+   if args.forward:
+      forward(args.forward)
+   else:
+      serve(args.host, args.port, args.workers, args.max_requests)
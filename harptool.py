@@ -6,21 +6,42 @@
 # author: richard.t.jones at uconn.edu
 # version: november 9, 2018
 
+import time
+import_start = time.perf_counter()
+
 import sys
 sys.path.insert(0, "/usr/local/root/lib/root")
 
 import numpy
-import ROOT
-ROOT.gROOT.IsBatch()
+import harpfit
+import harpcache
+import harpplot
+import beamline
+import harphistory
+import toolmetrics
+root_start = time.perf_counter()
+try:
+   import ROOT
+   ROOT.gROOT.IsBatch()
+except ImportError:
+   ROOT = None
+root_end = time.perf_counter()
 
 import os
 import cgi
+import json
 import html
 import cgitb
 cgitb.enable()
+toolmetrics.startup("harptool", [("imports", root_start - import_start),
+                                 ("ROOT import", root_end - root_start)],
+                    import_start, script=(__name__ == "__main__"))
 
 slimits = (100, 200)
+band_points = 101
 sigma_spec = (0.5, 0.5)
+metrics = toolmetrics.Timer("harptool", enabled=False)
+last_fit = None
 
 def print_head():
    print("Content-Type: text/html")
@@ -56,125 +77,324 @@ def set_parameter(par, desc, default, unit):
    print(unit)
    print("<input type=\"submit\" name=\"default " + par + "\" value=\"default\"></td>")
 
-def fit_model(var, par):
+def print_inputs(planes):
+   """
+   Print the input boxes for the sigmas of each harp monitor of the
+   beamline in the given planes, followed by the monitor positions and
+   the other beam parameters, with defaults from the beamline config.
+   """
+   defaults = optics.defaults()
+   spacer = "<td width=\"50\"></td>"
+   for monitor in optics.monitors:
+      for plane in planes:
+         par = monitor["name"] + "_" + plane + "sigma"
+         desc = monitor["label"] + " harp " + plane + " sigma"
+         print("<tr>")
+         set_parameter(par, desc, 0, "mm")
+         print(spacer)
+         set_parameter(par + "_err", desc + " error", defaults.get(par + "_err", 0), "mm")
+         print("</tr>")
+         spacer = "<td></td>"
+   left = ["Enter measured values in the above input boxes,",
+           "defaults are generally ok for the other fields.",
+           ("emittance_x", "x emittance of e-beam", "mm.mrad"),
+           ("emittance_y", "y emittance of e-beam", "mm.mrad")]
+   right = [(monitor["name"] + "_spos", "s of " + monitor["label"] + " harp", "m")
+            for monitor in optics.monitors]
+   right.append(("collimator_spos", "s of primary collimator", "m"))
+   for row in range(max(len(left), len(right))):
+      print("<tr>")
+      if row >= len(left):
+         print("<td colspan=\"2\"></td><td></td>")
+      elif isinstance(left[row], str):
+         print("<td colspan=\"2\" bgcolor=\"#dfcfaf\">")
+         print("<i>" + left[row] + "</i>")
+         print("</td><td></td>")
+      else:
+         par, desc, unit = left[row]
+         set_parameter(par, desc, defaults[par], unit)
+         print("<td></td>")
+      if row < len(right):
+         par, desc, unit = right[row]
+         set_parameter(par, desc, defaults[par], unit)
+      print("</tr>")
+
+def render_backend():
+   """
+   Plotting backend selected in the form, either "svg" for inline svg
+   drawn by harpplot (the default, and the only choice without ROOT) or
+   "root" for png images drawn on a ROOT TCanvas. The ROOT backend is
+   also used whenever pdf copies of the plots are asked for.
+   """
+   if ROOT is None:
+      return "svg"
+   elif "pdf" in form or form.getfirst("render") == "root":
+      return "root"
+   return "svg"
+
+def print_render_options():
+   if ROOT is None:
+      return
+   backend = render_backend()
+   print("plots as <select name=\"render\">")
+   for value, desc in (("svg", "inline svg"), ("root", "ROOT png")):
+      selected = " selected" if value == backend else ""
+      print("<option value=\"" + value + "\"" + selected + ">" + desc + "</option>")
+   print("</select>")
+   checked = " checked" if "pdf" in form else ""
+   print("<input type=\"checkbox\" name=\"pdf\" value=\"1\"" + checked + " /> with pdf copies")
+
+def fit_harps(sx, sigx, sigxerr, sy, sigy, sigyerr):
    """
-   var[0] = s coordinate (m)
-   par[0] = s coordinate (m) of focus
-   par[1] = sigma at the focus (mm)
-   par[2] = emittance (mm.mrad)
+   Fit the x and y envelopes with the emittances from the form,
+   returning the harpfit.FitResult for each plane. The fits are also
+   saved in last_fit.
    """
-   return (par[1]**2 + (par[2]/par[1] * (var[0] - par[0]))**2)**0.5
+   global last_fit
+   xemit = float(html.escape(form.getfirst("emittance_x")))
+   yemit = float(html.escape(form.getfirst("emittance_y")))
+   with metrics.phase("fit xy"):
+      last_fit = harpfit.fit_envelopes((sx, sy), (sigx, sigy),
+                                       (sigxerr, sigyerr), (xemit, yemit),
+                                       start=(slimits[1], 1.0))
+   return last_fit
 
-def fit_model_gradient(var, par):
+def fit_harps_transport(sx, sigx, sigxerr, sy, sigy, sigyerr):
    """
-   var[0] = s coordinate (m)
-   par[0] = s coordinate (m) of focus
-   par[1] = sigma at the focus (mm)
-   par[2] = emittance (mm.mrad)
+   Fit the x and y sigma matrices at the collimator to the harp data
+   transported through the beamline optics, returning the
+   harpfit.TransportFit. The emittances are free in this fit, unless
+   there are too few harps for them, when they are held at the values
+   from the form. The fit is also saved in last_fit.
    """
-   y = (par[1]**2 + (par[2]/par[1] * (var[0] - par[0]))**2)**0.5
-   dyds0 = -(par[2]/par[1])**2 * (var[0] - par[0]) / y
-   dydsig0 = (par[1]**2 - (par[2]/par[1] * (var[0] - par[0]))**2) / (y * par[1])
-   return (dyds0, dydsig0)
+   global last_fit
+   scol = float(html.escape(form.getfirst("collimator_spos")))
+   xemit = float(html.escape(form.getfirst("emittance_x")))
+   yemit = float(html.escape(form.getfirst("emittance_y")))
+   with metrics.phase("transport fit xy"):
+      last_fit = harpfit.fit_transport((optics.matrices(scol, sx), [],
+                                        optics.matrices(scol, sy)),
+                                       (sigx, [], sigy), (sigxerr, [], sigyerr),
+                                       coupled=False, emittance=(xemit, yemit))
+   return last_fit
+
+def collimator_sigmas(fit):
+   """
+   Sigmas (mm) in x and y at the collimator from the envelope fits or
+   the transport fit, as a dict.
+   """
+   if isinstance(fit, harpfit.TransportFit):
+      return {"x": float(fit.sigma[0,0]**0.5), "y": float(fit.sigma[2,2]**0.5)}
+   scol = float(html.escape(form.getfirst("collimator_spos")))
+   return {"x": float(harpfit.envelope([scol], fit[0].par)[0]),
+           "y": float(harpfit.envelope([scol], fit[1].par)[0])}
+
+def fit_key(sx, sigx, sigxerr, sy, sigy, sigyerr, render):
+   """
+   harpcache key of the fit of the harp data with the form parameters,
+   drawn with render, or "json" for the json output.
+   """
+   inputs = {"sx": sx, "sigx": sigx, "sigxerr": sigxerr,
+             "sy": sy, "sigy": sigy, "sigyerr": sigyerr,
+             "band_points": band_points}
+   for par in ("emittance_x", "emittance_y", "collimator_spos"):
+      inputs[par] = float(html.escape(form.getfirst(par)))
+   inputs["beamline"] = optics.digest
+   inputs["render"] = render
+   inputs["pdf"] = int("pdf" in form)
+   return harpcache.make_key("harptool", inputs)
+
+def history_row(key, sx, sigx, sigxerr, sy, sigy, sigyerr):
+   """
+   Row of last_fit, the fit key, for the harp fit history, see
+   harphistory.make_row.
+   """
+   scol = float(html.escape(form.getfirst("collimator_spos")))
+   emittance = [float(html.escape(form.getfirst("emittance_" + plane))) for plane in "xy"]
+   return harphistory.make_row("harptool", key, {"x": (sx, sigx, sigxerr), "y": (sy, sigy, sigyerr)},
+                               last_fit, scol, emittance, collimator_sigmas(last_fit))
+
+def record_history(row):
+   """
+   Append a history_row to the harp fit history, see harphistory.py.
+   """
+   with metrics.phase("history"):
+      harphistory.append(row)
+
+def fit_curves(sx, sigx, sigxerr, sy, sigy, sigyerr):
+   """
+   Fitted x and y envelopes on a grid of s values spanning slimits, with
+   their error bands, from the drift envelope fits or from the transport
+   fit if the beamline has focusing elements. Returns the grid s[n] and
+   the arrays sigma[k, n], lower[k, n], upper[k, n] for k = x, y.
+   """
+   if optics.has_optics():
+      fit = fit_harps_transport(sx, sigx, sigxerr, sy, sigy, sigyerr)
+      scol = float(html.escape(form.getfirst("collimator_spos")))
+      ss = optics.grid(slimits, band_points)
+      with metrics.phase("bands"):
+         curves, lower, upper = fit.bands(optics.matrices(scol, ss))
+      return ss, curves[[0, 2]], lower[[0, 2]], upper[[0, 2]]
+   fits = fit_harps(sx, sigx, sigxerr, sy, sigy, sigyerr)
+   with metrics.phase("bands"):
+      ss, lower, upper = harpfit.confidence_bands(fits, slimits, band_points)
+      curves = harpfit.envelope(ss, numpy.array([fit.par for fit in fits]))
+   return ss, curves, lower, upper
+
+def fit_results(sx, sigx, sigxerr, sy, sigy, sigyerr):
+   """
+   Fit the harp data and collect the results as a dict for json output,
+   without doing any of the plotting.
+   """
+   if optics.has_optics():
+      fit = fit_harps_transport(sx, sigx, sigxerr, sy, sigy, sigyerr)
+      result = {"transport": fit.summary()}
+      result["sigma_collimator"] = collimator_sigmas(fit)
+      return result
+   fits = fit_harps(sx, sigx, sigxerr, sy, sigy, sigyerr)
+   result = {"x": fits[0].summary(), "y": fits[1].summary()}
+   result["sigma_collimator"] = collimator_sigmas(fits)
+   return result
+
+def print_json():
+   """
+   Answer a request made with format=json by printing the fit results
+   as a json document, in place of the html page and plots.
+   """
+   sx, sigx, sigxerr, sy, sigy, sigyerr, zero_values, breaking_bad = read_harps()
+   if len(sx) < 2 or len(sy) < 2:
+      result = {"error": "insufficient data, at least 2 valid measurements with errors are needed"}
+   elif zero_values > 0 or breaking_bad > 0:
+      result = {"error": "invalid data"}
+   else:
+      try:
+         result = fit_results(sx, sigx, sigxerr, sy, sigy, sigyerr)
+         record_history(history_row(fit_key(sx, sigx, sigxerr, sy, sigy, sigyerr, "json"),
+                                    sx, sigx, sigxerr, sy, sigy, sigyerr))
+      except ValueError as err:
+         result = {"error": "invalid data, " + str(err)}
+      except TypeError:
+         result = {"error": "invalid data"}
+   print("Content-Type: application/json")
+   print()
+   print(json.dumps(result))
+
+def read_harps():
+   """
+   Read the harp measurements from the form, dropping the ones without
+   a positive error. Returns the x and y measurement lists followed by
+   the counts of zero-valued and unreadable entries.
+   """
+   sx = []
+   sy = []
+   sigx = []
+   sigy = []
+   sigxerr = []
+   sigyerr = []
+   zero_values = 0
+   breaking_bad = 0
+   for key in optics.names():
+      try:
+         sx.append(float(html.escape(form.getfirst(key + "_spos"))))
+         sy.append(float(html.escape(form.getfirst(key + "_spos"))))
+         sigx.append(float(html.escape(form.getfirst(key + "_xsigma"))))
+         sigxerr.append(float(html.escape(form.getfirst(key + "_xsigma_err"))))
+         sigy.append(float(html.escape(form.getfirst(key + "_ysigma"))))
+         sigyerr.append(float(html.escape(form.getfirst(key + "_ysigma_err"))))
+      except:
+         breaking_bad += 1
+         continue
+      if sigxerr[-1] > 0:
+         if sigx[-1] == 0:
+            zero_values += 1
+      else:
+         sx.pop()
+         sigx.pop()
+         sigxerr.pop()
+      if sigyerr[-1] > 0:
+         if sigy[-1] == 0:
+            zero_values += 1
+      else:
+         sy.pop()
+         sigy.pop()
+         sigyerr.pop()
+   return sx, sigx, sigxerr, sy, sigy, sigyerr, zero_values, breaking_bad
 
 def fit_and_plot(sx, sigx, sigxerr, sy, sigy, sigyerr):
    zero = [0] * len(sx)
-   xfitf = ROOT.TF1("xfitf", fit_model, slimits[0], slimits[1], 3)
-   xfitf.SetParameter(0, slimits[1])
-   xfitf.SetParameter(1, 1.0)
-   xfitf.FixParameter(2, float(html.escape(form.getfirst("emittance_x"))))
+   ss, curves, lower, upper = fit_curves(sx, sigx, sigxerr, sy, sigy, sigyerr)
+   scol = float(html.escape(form.getfirst("collimator_spos")))
+   if render_backend() == "svg":
+      print("<tr><td colspan=\"5\">")
+      for k, (plane, color, s, sig, sigerr) in enumerate(
+                               (("x", "red", sx, sigx, sigxerr),
+                                ("y", "blue", sy, sigy, sigyerr))):
+         print("<div align=\"center\">")
+         with metrics.phase("svg plot " + plane):
+            print(harpplot.envelope_figure(plane, color, slimits, ss, curves[k],
+                                           lower[k], upper[k], s, sig, sigerr,
+                                           scol, sigma_spec[k], max(upper[k])))
+         print("</div>")
+      print("</td></tr>")
+      return
+   xfitf = ROOT.TGraph(len(ss), ss, curves[0])
    xfitf.SetLineColor(ROOT.kRed)
+   xfitf.SetLineWidth(2)
    xdata = ROOT.TGraphErrors(len(sx), numpy.array(sx, dtype=float),
                                       numpy.array(sigx, dtype=float),
                                       numpy.array(zero, dtype=float),
                                       numpy.array(sigxerr, dtype=float))
-   xfit = xdata.Fit(xfitf, "qs")
    xdata.SetLineColor(ROOT.kRed)
    xdata.SetLineWidth(2)
    xdata.SetMarkerColor(ROOT.kRed)
    xdata.SetMarkerStyle(20)
 
-   ss = []
-   x0 = []
-   x1 = []
-   par = [xfit.Parameter(0), xfit.Parameter(1), xfit.Parameter(2)]
-   covar = xfit.GetCovarianceMatrix()
-   minvar = 0.01**2
-   for n in range(0, 101):
-      s = slimits[0] + n * (slimits[1] - slimits[0]) / 100
-      xmu = fit_model([s], par)
-      gra = fit_model_gradient([s], par)
-      ss.append(s)
-      xsigma = (covar(0,0) * gra[0]**2 + covar(1,1) * gra[1]**2 +
-                2 * covar(0,1) * gra[0] * gra[1] + minvar)**0.5
-      x0.append(xmu - xsigma)
-      x1.append(xmu + xsigma)
-      if x0[-1] < 0:
-         x0[-1] = 0
-   xshade = ROOT.TGraph(2 * len(ss), numpy.array(ss + ss[::-1], dtype=float),
-                                     numpy.array(x0 + x1[::-1], dtype=float))
+   xshade = ROOT.TGraph(2 * len(ss), *harpfit.band_polygon(ss, lower[0], upper[0]))
    xshade.SetFillColorAlpha(ROOT.kRed, 0.2);
 
-   yfitf = ROOT.TF1("yfitf", fit_model, slimits[0], slimits[1], 3)
-   yfitf.SetParameter(0, slimits[1])
-   yfitf.SetParameter(1, 1.0)
-   yfitf.FixParameter(2, float(html.escape(form.getfirst("emittance_y"))))
+   yfitf = ROOT.TGraph(len(ss), ss, curves[1])
    yfitf.SetLineColor(ROOT.kBlue)
+   yfitf.SetLineWidth(2)
    ydata = ROOT.TGraphErrors(len(sy), numpy.array(sy, dtype=float),
                                       numpy.array(sigy, dtype=float),
                                       numpy.array(zero, dtype=float),
                                       numpy.array(sigyerr, dtype=float))
-   yfit = ydata.Fit(yfitf, "qs")
    ydata.SetLineColor(ROOT.kBlue)
    ydata.SetLineWidth(2)
    ydata.SetMarkerColor(ROOT.kBlue)
    ydata.SetMarkerStyle(20)
 
-   ss = []
-   y0 = []
-   y1 = []
-   par = [yfit.Parameter(0), yfit.Parameter(1), yfit.Parameter(2)]
-   covar = yfit.GetCovarianceMatrix()
-   minvar = 0.01**2
-   for n in range(0, 101):
-      s = slimits[0] + n * (slimits[1] - slimits[0]) / 100
-      ymu = fit_model([s], par)
-      gra = fit_model_gradient([s], par)
-      ss.append(s)
-      ysigma = (covar(0,0) * gra[0]**2 + covar(1,1) * gra[1]**2 +
-                2 * covar(0,1) * gra[0] * gra[1] + minvar)**0.5
-      y0.append(ymu - ysigma)
-      y1.append(ymu + ysigma)
-      if y0[-1] < 0:
-         y0[-1] = 0
-   yshade = ROOT.TGraph(2 * len(ss), numpy.array(ss + ss[::-1], dtype=float),
-                                     numpy.array(y0 + y1[::-1], dtype=float))
+   yshade = ROOT.TGraph(2 * len(ss), *harpfit.band_polygon(ss, lower[1], upper[1]))
    yshade.SetFillColorAlpha(ROOT.kBlue, 0.2);
 
    c1 = ROOT.TCanvas("c1", "", 800, 600)
    xfitf.SetTitle("") # "sigma x vs accelerator s")
    xfitf.GetXaxis().SetTitle("accelerator s coordinate (m)")
+   xfitf.GetXaxis().SetLimits(slimits[0], slimits[1])
    xfitf.GetYaxis().SetTitle("#sigma_{x} (mm)")
    xfitf.SetMinimum(0)
-   xfitf.SetMaximum(max(x1))
-   xfitf.Draw()
+   xfitf.SetMaximum(max(upper[0]))
+   xfitf.Draw("AL")
    xdata.Draw("P")
    xshade.Draw("f")
-   scol = float(html.escape(form.getfirst("collimator_spos")))
    gcol = ROOT.TGraph(2, numpy.array([scol] * 2, dtype=float), numpy.array([0, 1.5], dtype=float))
    gcol.Draw("L")
    xspec = ROOT.TArrow(scol, sigma_spec[0], slimits[1], sigma_spec[0], 0.03, "<|")
    xspec.SetAngle(35)
    xspec.Draw()
    c1.Update()
-   c1.Print(workdir + "harp-x-" + fitimage)
-   c1.Print(workdir + "harp-x-" + str(os.getpid()) + ".pdf")
+   with metrics.phase("c1.Print x png"):
+      c1.Print(workdir + "harp-x-" + fitimage)
+   if "pdf" in form:
+      with metrics.phase("c1.Print x pdf"):
+         c1.Print(workdir + "harp-x-" + fitname + ".pdf")
    yfitf.SetTitle("") # "sigma y vs accelerator s")
    yfitf.GetXaxis().SetTitle("accelerator s coordinate (m)")
+   yfitf.GetXaxis().SetLimits(slimits[0], slimits[1])
    yfitf.GetYaxis().SetTitle("#sigma_{y} (mm)")
    yfitf.SetMinimum(0)
-   yfitf.SetMaximum(max(y1))
-   yfitf.Draw()
+   yfitf.SetMaximum(max(upper[1]))
+   yfitf.Draw("AL")
    ydata.Draw("P")
    yshade.Draw("f")
    gcol.Draw("L")
@@ -182,123 +402,94 @@ def fit_and_plot(sx, sigx, sigxerr, sy, sigy, sigyerr):
    yspec.SetAngle(35)
    yspec.Draw()
    c1.Update()
-   c1.Print(workdir + "harp-y-" + fitimage)
-   c1.Print(workdir + "harp-y-" + str(os.getpid()) + ".pdf")
+   with metrics.phase("c1.Print y png"):
+      c1.Print(workdir + "harp-y-" + fitimage)
+   if "pdf" in form:
+      with metrics.phase("c1.Print y pdf"):
+         c1.Print(workdir + "harp-y-" + fitname + ".pdf")
    print("<tr><td colspan=\"5\">")
    print("<div align=\"center\"><img src=\"work/harp-x-" + fitimage + "\"></div>")
    print("<div align=\"center\"><img src=\"work/harp-y-" + fitimage + "\"></div>")
+   if "pdf" in form:
+      print("<div align=\"center\">pdf copies:")
+      for plane in "xy":
+         print("<a href=\"work/harp-" + plane + "-" + fitname + ".pdf\">" + plane + "</a>")
+      print("</div>")
    print("</td></tr>")
 
-# main execution starts here
+def main(environ=None, name=None):
+   """
+   environ = cgi environment to read the form from (default os.environ)
+   name = unique tag for the output image files (default process id)
+   """
+   global form, optics, workdir, fitname, fitimage, metrics
+   metrics = toolmetrics.Timer("harptool")
+   workdir = os.path.dirname(os.path.abspath(__file__)) + "/work/"
+   fitname = name or str(os.getpid())
+   fitimage = fitname + ".png"
 
-print_head()
-
-workdir = os.path.dirname(sys.argv[0]) + "/work/"
-fitimage = str(os.getpid()) + ".png"
-
-form = cgi.FieldStorage()
-
-print("<tr>")
-set_parameter("harp5C11_xsigma", "5C11 harp x sigma", 0, "mm")
-print("<td width=\"50\"></td>")
-set_parameter("harp5C11_xsigma_err", "5C11 harp x sigma error", 0.030, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("harp5C11_ysigma", "5C11 harp y sigma", 0, "mm")
-print("<td></td>")
-set_parameter("harp5C11_ysigma_err", "5C11 harp y sigma error", 0.030, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("harp5C11B_xsigma", "5C11B harp x sigma", 0, "mm")
-print("<td></td>")
-set_parameter("harp5C11B_xsigma_err", "5C11B harp x sigma error", 0.050, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("harp5C11B_ysigma", "5C11B harp y sigma", 0, "mm")
-print("<td></td>")
-set_parameter("harp5C11B_ysigma_err", "5C11B harp y sigma error", 0.150, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("radHarp_xsigma", "radiator harp x sigma", 0, "mm")
-print("<td></td>")
-set_parameter("radHarp_xsigma_err", "radiator harp x sigma error", 0.020, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("radHarp_ysigma", "radiator harp y sigma", 0, "mm")
-print("<td></td>")
-set_parameter("radHarp_ysigma_err", "radiator harp y sigma error", 0.020, "mm")
-print("</tr>")
-print("<tr>")
-print("<td colspan=\"2\" bgcolor=\"#dfcfaf\">")
-print("<i>Enter measured values in the above input boxes,</i>")
-print("</td><td></td>")
-set_parameter("harp5C11_spos", "s of 5C11 harps", 102.97, "m")
-print("</tr>")
-print("<tr>")
-print("<td colspan=\"2\" bgcolor=\"#dfcfaf\">")
-print("<i>defaults are generally ok for the other fields.</i>")
-print("</td><td></td>")
-set_parameter("harp5C11B_spos", "s of 5C11B harps", 115.11, "m")
-print("</tr>")
-print("<tr>")
-set_parameter("emittance_x", "x emittance of e-beam", 0.0041, "mm.mrad")
-print("<td></td>")
-set_parameter("radHarp_spos", "s of radiator harp", 119.70, "m")
-print("</tr>")
-print("<tr>")
-set_parameter("emittance_y", "y emittance of e-beam", 0.00233, "mm.mrad")
-print("<td></td>")
-set_parameter("collimator_spos", "s of primary collimator", 194.92, "m")
-print("</tr>")
-print("<tr><td colspan=\"5\" align=\"center\" height=\"80\" valign=\"middle\" >")
-print("<input type=\"submit\" name=\"fit\" value=\"fit and plot\" \>")
-print("</td></tr>")
-
-sx = []
-sy = []
-sigx = []
-sigy = []
-sigxerr = []
-sigyerr = []
-zero_values = 0
-breaking_bad = 0
-for key in ("harp5C11", "harp5C11B", "radHarp"):
-   try:
-      sx.append(float(html.escape(form.getfirst(key + "_spos"))))
-      sy.append(float(html.escape(form.getfirst(key + "_spos"))))
-      sigx.append(float(html.escape(form.getfirst(key + "_xsigma"))))
-      sigxerr.append(float(html.escape(form.getfirst(key + "_xsigma_err"))))
-      sigy.append(float(html.escape(form.getfirst(key + "_ysigma"))))
-      sigyerr.append(float(html.escape(form.getfirst(key + "_ysigma_err"))))
-   except:
-      breaking_bad += 1
-      continue
-   if sigxerr[-1] > 0:
-      if sigx[-1] == 0:
-         zero_values += 1
-   else:
-      sx.pop()
-      sigx.pop()
-      sigxerr.pop()
-   if sigyerr[-1] > 0:
-      if sigy[-1] == 0:
-         zero_values += 1
+   with metrics.phase("form parsing"):
+      optics = beamline.load(slimits=slimits, npoints=band_points)
+      if environ is None:
+         form = cgi.FieldStorage()
+      else:
+         form = cgi.FieldStorage(environ=environ)
+   if form.getfirst("format") == "json":
+      print_json()
+      metrics.finish(format="json")
+      return
+
+   print_head()
+
+   print_inputs("xy")
+   print("<tr><td colspan=\"5\" align=\"center\" height=\"80\" valign=\"middle\" >")
+   print("<input type=\"submit\" name=\"fit\" value=\"fit and plot\" \>")
+   print_render_options()
+   print("</td></tr>")
+
+   with metrics.phase("form parsing"):
+      sx, sigx, sigxerr, sy, sigy, sigyerr, zero_values, breaking_bad = read_harps()
+   if len(sx) < 2 or len(sy) < 2:
+      print("<tr><td colspan=\"5\" align=\"center\">")
+      print("<font color=\"red\">")
+      print("Insufficient data, please add at least 2 valid measurements with errors and try again!")
+      print("</font></td></tr>")
+   elif zero_values == 0 and breaking_bad == 0:
+      if "fit" in form:
+         fitname = fit_key(sx, sigx, sigxerr, sy, sigy, sigyerr, render_backend())
+         fitimage = fitname + ".png"
+
+         def produce():
+            metrics.info["cached"] = False
+            result = {"html": harpcache.capture(fit_and_plot, sx, sigx, sigxerr,
+                                                sy, sigy, sigyerr)}
+            row = history_row(fitname, sx, sigx, sigxerr, sy, sigy, sigyerr)
+            result["history"] = harphistory.row_json(row)
+            return result
+
+         metrics.info.update(fit=fitname, cached=True)
+         try:
+            result = harpcache.cached(workdir, fitname, produce)
+         except ValueError as err:
+            print("<tr><td colspan=\"5\" align=\"center\">")
+            print("<font color=\"red\">")
+            print("Fit failed,", html.escape(str(err)) + ", please check the data and the beamline and try again!")
+            print("</font></td></tr>")
+         else:
+            record_history(harphistory.row_from_json(result["history"]))
+            print(result["html"], end="")
    else:
-      sy.pop()
-      sigy.pop()
-      sigyerr.pop()
-if len(sx) < 2 or len(sy) < 2:
-   print("<tr><td colspan=\"5\" align=\"center\">")
-   print("<font color=\"red\">")
-   print("Insufficient data, please add at least 2 valid measurements with errors and try again!")
-   print("</font></td></tr>")
-elif zero_values == 0 and breaking_bad == 0:
-   if "fit" in form:
-      fit_and_plot(sx, sigx, sigxerr, sy, sigy, sigyerr)
-else:
-   print("<tr><td colspan=\"5\" align=\"center\">")
-   print("<font color=\"red\">")
-   print("Invalid data, please correct errors in the above data and try again!")
-   print("</font></td></tr>")
-
-print_tail()
+      print("<tr><td colspan=\"5\" align=\"center\">")
+      print("<font color=\"red\">")
+      print("Invalid data, please correct errors in the above data and try again!")
+      print("</font></td></tr>")
+
+   if form.getfirst("debug"):
+      print(metrics.html())
+   print_tail()
+   metrics.finish()
+
+# main execution starts here
+
+if __name__ == "__main__":
+   main()
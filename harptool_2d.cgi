@@ -13,4 +13,8 @@ if false; then
 	fi
 fi
 
-exec python `echo $0 | sed 's/.cgi/.py/'`
+script=`echo $0 | sed 's/.cgi/.py/'`
+if [[ -r `dirname $0`/work/harpserver.addr ]]; then
+	exec python `dirname $0`/harpserver.py --forward $script
+fi
+exec python $script
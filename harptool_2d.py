@@ -9,22 +9,47 @@
 # author: richard.t.jones at uconn.edu
 # version: january 1, 2022
 
+import time
+import_start = time.perf_counter()
+
 import sys
 sys.path.insert(0, "/usr/local/root/lib/root")
 
 import numpy
-import ROOT
-ROOT.gROOT.IsBatch()
+import harpfit
+import harpcache
+import harpplot
+import harphistory
+import beamline
+import toolmetrics
+root_start = time.perf_counter()
+try:
+   import ROOT
+   ROOT.gROOT.IsBatch()
+except ImportError:
+   ROOT = None
+root_end = time.perf_counter()
 
 import os
 import cgi
+import json
 import html
 import cgitb
 cgitb.enable()
+toolmetrics.startup("harptool_2d", [("imports", root_start - import_start),
+                                    ("ROOT import", root_end - root_start)],
+                    import_start, script=(__name__ == "__main__"))
 
 slimits = (100, 200)
+band_points = 101
 sigma_spec = (0.5, 0.5)
 sigma_collimator = {}
+last_fit = None
+collimator_confidence = {}
+mc_samples = 2000
+mc_levels = (0.68, 0.95)
+mc_min_real = 0.9
+metrics = toolmetrics.Timer("harptool_2d", enabled=False)
 
 def print_head():
    print("Content-Type: text/html")
@@ -60,193 +85,583 @@ def set_parameter(par, desc, default, unit):
    print(unit)
    print("<input type=\"submit\" name=\"default " + par + "\" value=\"default\"></td>")
 
-def fit_model(var, par):
+def print_inputs(planes):
+   """
+   Print the input boxes for the sigmas of each harp monitor of the
+   beamline in the given planes, followed by the monitor positions and
+   the other beam parameters, with defaults from the beamline config.
+   """
+   defaults = optics.defaults()
+   spacer = "<td width=\"50\"></td>"
+   for monitor in optics.monitors:
+      for plane in planes:
+         par = monitor["name"] + "_" + plane + "sigma"
+         desc = monitor["label"] + " harp " + plane + " sigma"
+         print("<tr>")
+         set_parameter(par, desc, 0, "mm")
+         print(spacer)
+         set_parameter(par + "_err", desc + " error", defaults.get(par + "_err", 0), "mm")
+         print("</tr>")
+         spacer = "<td></td>"
+   left = ["Enter measured values in the above input boxes,",
+           "defaults are generally ok for the other fields.",
+           ("emittance_x", "x emittance of e-beam", "mm.mrad"),
+           ("emittance_y", "y emittance of e-beam", "mm.mrad")]
+   right = [(monitor["name"] + "_spos", "s of " + monitor["label"] + " harp", "m")
+            for monitor in optics.monitors]
+   right.append(("collimator_spos", "s of primary collimator", "m"))
+   for row in range(max(len(left), len(right))):
+      print("<tr>")
+      if row >= len(left):
+         print("<td colspan=\"2\"></td><td></td>")
+      elif isinstance(left[row], str):
+         print("<td colspan=\"2\" bgcolor=\"#dfcfaf\">")
+         print("<i>" + left[row] + "</i>")
+         print("</td><td></td>")
+      else:
+         par, desc, unit = left[row]
+         set_parameter(par, desc, defaults[par], unit)
+         print("<td></td>")
+      if row < len(right):
+         par, desc, unit = right[row]
+         set_parameter(par, desc, defaults[par], unit)
+      print("</tr>")
+
+def render_backend():
    """
-   var[0] = s coordinate (m)
-   par[0] = s coordinate (m) of focus
-   par[1] = sigma at the focus (mm)
-   par[2] = emittance (mm.mrad)
+   Plotting backend selected in the form, either "svg" for inline svg
+   drawn by harpplot (the default, and the only choice without ROOT) or
+   "root" for png images drawn on a ROOT TCanvas. The ROOT backend is
+   also used whenever pdf copies of the plots are asked for.
+   """
+   if ROOT is None:
+      return "svg"
+   elif "pdf" in form or form.getfirst("render") == "root":
+      return "root"
+   return "svg"
+
+def print_render_options():
+   if ROOT is None:
+      return
+   backend = render_backend()
+   print("plots as <select name=\"render\">")
+   for value, desc in (("svg", "inline svg"), ("root", "ROOT png")):
+      selected = " selected" if value == backend else ""
+      print("<option value=\"" + value + "\"" + selected + ">" + desc + "</option>")
+   print("</select>")
+   checked = " checked" if "pdf" in form else ""
+   print("<input type=\"checkbox\" name=\"pdf\" value=\"1\"" + checked + " /> with pdf copies")
+
+def print_uncertainty_option():
+   checked = " checked" if "montecarlo" in form else ""
+   print("<input type=\"checkbox\" name=\"montecarlo\" value=\"1\"" + checked +
+         " /> with collimator spot uncertainties")
+
+def read_harps():
    """
-   return (par[1]**2 + (par[2]/par[1] * (var[0] - par[0]))**2)**0.5
+   Read the harp measurements from the form, dropping the ones without
+   a positive error. Returns the x, u and y measurement lists followed
+   by the counts of zero-valued and unreadable entries.
+   """
+   sx = []
+   su = []
+   sy = []
+   sigx = []
+   sigu = []
+   sigy = []
+   sigxerr = []
+   siguerr = []
+   sigyerr = []
+   zero_values = 0
+   breaking_bad = 0
+   for monitor in optics.monitors:
+      key = monitor["name"]
+      try:
+         sx.append(float(html.escape(form.getfirst(key + "_spos"))))
+         su.append(float(html.escape(form.getfirst(key + "_spos"))))
+         sy.append(float(html.escape(form.getfirst(key + "_spos"))))
+         sigx.append(float(html.escape(form.getfirst(key + "_xsigma"))))
+         sigxerr.append(float(html.escape(form.getfirst(key + "_xsigma_err"))))
+         sigu.append(float(html.escape(form.getfirst(key + "_usigma"))))
+         siguerr.append(float(html.escape(form.getfirst(key + "_usigma_err"))))
+         sigy.append(float(html.escape(form.getfirst(key + "_ysigma"))))
+         sigyerr.append(float(html.escape(form.getfirst(key + "_ysigma_err"))))
+         if monitor.get("u_wire") == "x-y":
+            sigu2 = sigx[-1]**2 + sigy[-1]**2 - sigu[-1]**2
+            if sigu2 > 0:
+               sigu[-1] = sigu2**0.5
+            else:
+               sigu[-1] = (sigx[-1]**2 + sigy[-1]**2)**0.5 / 30
+      except:
+         breaking_bad += 1
+         continue
+      if sigxerr[-1] > 0:
+         if sigx[-1] == 0:
+            zero_values += 1
+      else:
+         sx.pop()
+         sigx.pop()
+         sigxerr.pop()
+      if siguerr[-1] > 0:
+         if sigu[-1] == 0:
+            zero_values += 1
+      else:
+         su.pop()
+         sigu.pop()
+         siguerr.pop()
+      if sigyerr[-1] > 0:
+         if sigy[-1] == 0:
+            zero_values += 1
+      else:
+         sy.pop()
+         sigy.pop()
+         sigyerr.pop()
+   return (sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr,
+           zero_values, breaking_bad)
+
+def good_u(su, sigu, siguerr):
+   """
+   Select the u measurements with errors small enough to be fitted.
+   """
+   goodsu = []
+   goodsigu = []
+   goodsuerr = []
+   goodsiguerr = []
+   for i in range(len(su)):
+      if siguerr[i] < 1:
+         goodsu.append(su[i])
+         goodsuerr.append(0)
+         goodsigu.append(sigu[i])
+         goodsiguerr.append(siguerr[i])
+   return goodsu, goodsigu, goodsuerr, goodsiguerr
 
-def fit_model_gradient(var, par):
+def fit_harps(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr):
    """
-   var[0] = s coordinate (m)
-   par[0] = s coordinate (m) of focus
-   par[1] = sigma at the focus (mm)
-   par[2] = emittance (mm.mrad)
+   Fit the beam sigma matrix to the x, u and y harp data together with
+   the emittances from the form, returning the harpfit.SigmaMatrixFit.
+   The predicted sigmas at the collimator are saved in sigma_collimator,
+   and their confidence regions in collimator_confidence if the form
+   asks for them. The fit is also saved in last_fit.
    """
-   y = (par[1]**2 + (par[2]/par[1] * (var[0] - par[0]))**2)**0.5
-   dyds0 = -(par[2]/par[1])**2 * (var[0] - par[0]) / y
-   dydsig0 = (par[1]**2 - (par[2]/par[1] * (var[0] - par[0]))**2) / (y * par[1])
-   return (dyds0, dydsig0)
+   global last_fit
+   goodsu, goodsigu, _, goodsiguerr = good_u(su, sigu, siguerr)
+   xemit = float(html.escape(form.getfirst("emittance_x")))
+   yemit = float(html.escape(form.getfirst("emittance_y")))
+   with metrics.phase("fit xuy"):
+      fit = harpfit.fit_sigma_matrix((sx, goodsu, sy),
+                                     (sigx, goodsigu, sigy),
+                                     (sigxerr, goodsiguerr, sigyerr),
+                                     (xemit, yemit),
+                                     start=(slimits[1], 1.0))
+   scol = float(html.escape(form.getfirst("collimator_spos")))
+   sigmas = harpfit.coupled_sigmas(numpy.array([scol]), fit.par)
+   for plane, sigma in zip("xuy", sigmas):
+      sigma_collimator[plane] = float(sigma[0])
+   if "montecarlo" in form:
+      yy, ww, model = harpfit.joint_problem((sx, goodsu, sy), (sigx, goodsigu, sigy),
+                                            (sigxerr, goodsiguerr, sigyerr))[:3]
+      collimator_uncertainty(fit, yy, ww, model)
+   last_fit = fit
+   return fit
+
+def fit_harps_transport(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr):
+   """
+   Fit the full beam sigma matrix at the collimator to the x, u and y
+   harp data transported through the beamline optics, returning the
+   harpfit.TransportFit. The emittances are free in this fit, unless
+   there are too few harps for them, when they are held at the values
+   from the form. The predicted sigmas at the collimator are saved in
+   sigma_collimator, and their confidence regions in
+   collimator_confidence if the form asks for them. The fit is also
+   saved in last_fit.
+   """
+   global last_fit
+   goodsu, goodsigu, _, goodsiguerr = good_u(su, sigu, siguerr)
+   scol = float(html.escape(form.getfirst("collimator_spos")))
+   xemit = float(html.escape(form.getfirst("emittance_x")))
+   yemit = float(html.escape(form.getfirst("emittance_y")))
+   R = (optics.matrices(scol, sx), optics.matrices(scol, goodsu),
+        optics.matrices(scol, sy))
+   with metrics.phase("transport fit xuy"):
+      fit = harpfit.fit_transport(R, (sigx, goodsigu, sigy),
+                                  (sigxerr, goodsiguerr, sigyerr),
+                                  emittance=(xemit, yemit))
+   curves = fit.bands(numpy.eye(4)[None, :, :])[0]
+   for plane, sigma in zip("xuy", curves):
+      sigma_collimator[plane] = float(sigma[0])
+   if "montecarlo" in form:
+      symmetric = fit.free[6] and not fit.free[8]
+      yy, ww, model = harpfit.transport_problem(R, (sigx, goodsigu, sigy),
+                                                (sigxerr, goodsiguerr, sigyerr),
+                                                symmetric)[1:]
+      collimator_uncertainty(fit, yy, ww, model)
+   last_fit = fit
+   return fit
+
+def fit_key(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr, render):
+   """
+   harpcache key of the fit of the harp data with the form parameters,
+   drawn with render, or "json" for the json output.
+   """
+   inputs = {"sx": sx, "sigx": sigx, "sigxerr": sigxerr,
+             "su": su, "sigu": sigu, "siguerr": siguerr,
+             "sy": sy, "sigy": sigy, "sigyerr": sigyerr,
+             "band_points": band_points}
+   for par in ("emittance_x", "emittance_y", "collimator_spos"):
+      inputs[par] = float(html.escape(form.getfirst(par)))
+   inputs["beamline"] = optics.digest
+   inputs["render"] = render
+   inputs["pdf"] = int("pdf" in form)
+   inputs["montecarlo"] = int("montecarlo" in form)
+   return harpcache.make_key("harptool_2d", inputs)
+
+def history_row(key, sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr):
+   """
+   Row of last_fit, the fit key, with the sigmas and beam ellipse at the
+   collimator, for the harp fit history, see harphistory.make_row.
+   """
+   scol = float(html.escape(form.getfirst("collimator_spos")))
+   emittance = [float(html.escape(form.getfirst("emittance_" + plane))) for plane in "xy"]
+   harps = {"x": (sx, sigx, sigxerr), "u": (su, sigu, siguerr), "y": (sy, sigy, sigyerr)}
+   return harphistory.make_row("harptool_2d", key, harps, last_fit, scol, emittance,
+                               sigma_collimator, collimator_ellipse())
+
+def record_history(row):
+   """
+   Append a history_row to the harp fit history, see harphistory.py.
+   """
+   with metrics.phase("history"):
+      harphistory.append(row)
+
+def collimator_uncertainty(fit, yy, ww, model):
+   """
+   Confidence regions of the beam sigmas, tilt and ellipse at the
+   collimator, see harpfit.ellipse_confidence, saved in
+   collimator_confidence. They are found by refitting mc_samples
+   resamplings of the harp measurements yy with weights ww to the
+   model of the joint or transport fit, see harpfit.refit_samples, and
+   computing the ellipse of each refit. Unlike samples drawn from the
+   fit covariance, the refits stay within the physical parameter range
+   and follow the fit where it is far from linear, as for a coupling
+   near saturation. If too few of the refits give a real ellipse, only
+   the reason is saved, under "problem".
+   """
+   scol = float(html.escape(form.getfirst("collimator_spos")))
+   with metrics.phase("monte carlo"):
+      if isinstance(fit, harpfit.TransportFit):
+         samples = harpfit.refit_samples(model, fit.model_par, fit.free, yy, ww, mc_samples)
+         if fit.free[6] and not fit.free[8]:
+            samples[:,8] = samples[:,7]
+         # the transport fit is made at the collimator, where R = 1
+         S = harpfit.transport_sigma(samples)
+         sigx, sigu, sigy = [numpy.einsum("i,bij,j->b", row, S, row)**0.5
+                             for row in harpfit.projections]
+      else:
+         samples = harpfit.refit_samples(model, fit.par, fit.free, yy, ww, mc_samples)
+         sigx, sigu, sigy = [sigma[:, 0] for sigma in
+                             harpfit.coupled_sigmas(numpy.array([scol]), samples)]
+      conf = harpfit.ellipse_confidence(sigx, sigy, sigu, mc_levels)
+      collimator_confidence.clear()
+      if conf["real"] < mc_min_real:
+         conf = {"samples": conf["samples"], "real": conf["real"],
+                 "problem": "only {0:.1f}% of the refits give a real ellipse".format(100 * conf["real"])}
+      collimator_confidence.update(conf)
+
+def fit_curves(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr):
+   """
+   Fitted x, u and y envelopes on a grid of s values spanning slimits,
+   with their error bands, from the joint drift fit or from the transport
+   fit if the beamline has focusing elements. Returns the grid s[n] and
+   the arrays sigma[k, n], lower[k, n], upper[k, n] for k = x, u, y.
+   """
+   if optics.has_optics():
+      fit = fit_harps_transport(sx, sigx, sigxerr, su, sigu, siguerr,
+                                sy, sigy, sigyerr)
+      scol = float(html.escape(form.getfirst("collimator_spos")))
+      ss = optics.grid(slimits, band_points)
+      with metrics.phase("bands"):
+         curves, lower, upper = fit.bands(optics.matrices(scol, ss))
+      return ss, curves, lower, upper
+   fits = fit_harps(sx, sigx, sigxerr, su, sigu, siguerr,
+                    sy, sigy, sigyerr).planes()
+   with metrics.phase("bands"):
+      ss, lower, upper = harpfit.confidence_bands(fits, slimits, band_points)
+      curves = harpfit.envelope(ss, numpy.array([fit.par for fit in fits]))
+   return ss, curves, lower, upper
+
+def harp_ellipses(su, sigx, sigy, sigu):
+   """
+   Beam ellipse (A, B, alpha) at each of the three harps, see
+   harpfit.ellipse_parameters. A missing u measurement, marked by
+   sigu = 999, is interpolated from the other two harps.
+   """
+   ellipses = []
+   for i in range(len(sigu)):
+      if sigu[i] == 999:
+         sigu[i] = sigu[0] + ((sigu[1] - sigu[0]) * (su[2] - su[0]) /
+                              (su[1] - su[0]))
+      ellipses.append(harpfit.ellipse_parameters(sigx[i], sigy[i], sigu[i]))
+   return ellipses
+
+def collimator_ellipse():
+   """
+   Beam ellipse (A, B, alpha) at the collimator from the sigmas saved
+   in sigma_collimator, or None if the fits have not been done. The
+   joint sigma matrix fit guarantees that these satisfy the triangle
+   inequality (sigma_x - sigma_y)**2 <= 2 sigma_u**2 <= (sigma_x + sigma_y)**2
+   """
+   if 'x' in sigma_collimator and 'y' in sigma_collimator and 'u' in sigma_collimator:
+      return harpfit.ellipse_parameters(sigma_collimator['x'],
+                                        sigma_collimator['y'],
+                                        sigma_collimator['u'])
+   return None
+
+def fit_results(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr):
+   """
+   Fit the harp data and collect the results as a dict for json output,
+   including the 2d beam ellipses, without doing any of the plotting.
+   """
+   if optics.has_optics():
+      fit = fit_harps_transport(sx, sigx, sigxerr, su, sigu, siguerr,
+                                sy, sigy, sigyerr)
+      result = {"transport": fit.summary()}
+   else:
+      fit = fit_harps(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr)
+      result = {"joint": fit.summary()}
+      for plane, planefit in zip("xuy", fit.planes()):
+         result[plane] = planefit.summary()
+   result["sigma_collimator"] = dict(sigma_collimator)
+   if collimator_confidence:
+      result["collimator_confidence"] = confidence_json()
+   ellipses = harp_ellipses(su, sigx, sigy, list(sigu))
+   ellipses.append(collimator_ellipse())
+   for n, (A, B, alpha) in enumerate(ellipses):
+      ellipse = {"A": float(A), "B": float(B), "alpha": float(alpha)}
+      for key in ellipse:
+         if not numpy.isfinite(ellipse[key]):
+            ellipse[key] = None
+      if n < len(ellipses) - 1:
+         result.setdefault("ellipses", []).append(ellipse)
+      else:
+         result["ellipse_collimator"] = ellipse
+   return result
+
+def confidence_json():
+   """
+   The collimator_confidence regions as plain python numbers, with the
+   intervals keyed by their confidence level in percent.
+   """
+   doc = {}
+   for key, value in collimator_confidence.items():
+      if isinstance(value, dict):
+         doc[key] = {}
+         for level, q in value.items():
+            name = level if level == "median" else "{0:g}".format(100 * level)
+            doc[key][name] = numpy.asarray(q).tolist()
+      else:
+         doc[key] = numpy.asarray(value).tolist()
+   return doc
+
+def print_confidence():
+   """
+   Table of the confidence intervals of the beam sigmas and tilt at
+   the collimator, under the 2d plot.
+   """
+   conf = collimator_confidence
+   if "problem" in conf:
+      print("<tr><td colspan=\"5\" align=\"center\"><font color=\"red\">")
+      print("No collimator spot uncertainties: " + html.escape(conf["problem"]) +
+            ", the harp data do not constrain the beam ellipse")
+      print("</font></td></tr>")
+      return
+   print("<tr><td colspan=\"5\" align=\"center\"><table>")
+   print("<tr><th>at the collimator</th><th>median</th>" +
+         "".join("<th>{0:g}% interval</th>".format(100 * level) for level in mc_levels) +
+         "</tr>")
+   for key, desc, unit, scale in (("sigma_x", "sigma x", "mm", 1),
+                                  ("sigma_y", "sigma y", "mm", 1),
+                                  ("sigma_u", "sigma u", "mm", 1),
+                                  ("tilt", "major axis tilt", "deg", 180 / numpy.pi)):
+      cells = ["{0:.3f}".format(conf[key]["median"] * scale)]
+      for level in mc_levels:
+         lo, hi = conf[key][level] * scale
+         cells.append("{0:.3f} to {1:.3f}".format(lo, hi))
+      print("<tr><td>" + desc + " (" + unit + ")</td><td>" + "</td><td>".join(cells) + "</td></tr>")
+   print("<tr><td colspan=\"{0}\">from {1} samples of the fit, {2:.1f}% of them real ellipses;"
+         .format(2 + len(mc_levels), conf["samples"], 100 * conf["real"]) +
+         " the shaded ring holds the collimator ellipse at {0:g}% confidence</td></tr>"
+         .format(100 * mc_levels[-1]))
+   print("</table></td></tr>")
+
+def confidence_ring():
+   """
+   Outline (x, y) in mm of the ring between the inner and outer bounds
+   of the collimator ellipse at the highest of mc_levels, traced as the
+   outer boundary followed by the inner one in the opposite direction.
+   """
+   conf = collimator_confidence
+   phi = numpy.append(conf["phi"], conf["phi"][0])
+   inner, outer = conf["radius"][mc_levels[-1]]
+   inner = numpy.append(inner, inner[0])[::-1]
+   outer = numpy.append(outer, outer[0])
+   r = numpy.concatenate((outer, inner))
+   phi = numpy.concatenate((phi, phi[::-1]))
+   return r * numpy.cos(phi), r * numpy.sin(phi)
+
+def scan_results(harps=None):
+   """
+   Read and fit the harp scan in the form, returning the results from
+   fit_results, or a dict with an "error" message if the data are not
+   sufficient or not valid for the fit.
+    harps = the read_harps() of the form, if it was already read
+   """
+   if harps is None:
+      harps = read_harps()
+   sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr = harps[:9]
+   zero_values, breaking_bad = harps[9:]
+   if len(sx) < 2 or len(su) < 2 or len(sy) < 2:
+      result = {"error": "insufficient data, all " + str(3 * len(optics.monitors)) +
+                " inputs with errors are needed"}
+   elif zero_values > 0 or breaking_bad > 0:
+      result = {"error": "invalid data"}
+   else:
+      try:
+         result = fit_results(sx, sigx, sigxerr, su, sigu, siguerr,
+                              sy, sigy, sigyerr)
+      except ValueError as err:
+         result = {"error": "invalid data, " + str(err)}
+      except (TypeError, IndexError):
+         result = {"error": "invalid data"}
+   return result
+
+def print_json():
+   """
+   Answer a request made with format=json by printing the fit results
+   as a json document, in place of the html page and plots. A fit that
+   succeeds is appended to the harp fit history.
+   """
+   harps = read_harps()
+   result = scan_results(harps)
+   if "error" not in result:
+      key = fit_key(*harps[:9], render="json")
+      record_history(history_row(key, *harps[:9]))
+   print("Content-Type: application/json")
+   print()
+   print(json.dumps(result))
 
 def fit_and_plot(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr):
    zero = [0] * len(sx)
-   xfitf = ROOT.TF1("xfitf", fit_model, slimits[0], slimits[1], 3)
-   xfitf.SetParameter(0, slimits[1])
-   xfitf.SetParameter(1, 1.0)
-   xfitf.FixParameter(2, float(html.escape(form.getfirst("emittance_x"))))
+   goodsu, goodsigu, goodsuerr, goodsiguerr = good_u(su, sigu, siguerr)
+   ss, curves, lower, upper = fit_curves(sx, sigx, sigxerr, su, sigu, siguerr,
+                                         sy, sigy, sigyerr)
+   scol = float(html.escape(form.getfirst("collimator_spos")))
+   if render_backend() == "svg":
+      print("<tr><td colspan=\"5\">")
+      for k, (plane, color, s, sig, sigerr, spec) in enumerate(
+                   (("x", "red", sx, sigx, sigxerr, sigma_spec[0]),
+                    ("u", "green", goodsu, goodsigu, goodsiguerr, sigma_spec[0]),
+                    ("y", "blue", sy, sigy, sigyerr, sigma_spec[1]))):
+         print("<div align=\"center\">")
+         with metrics.phase("svg plot " + plane):
+            print(harpplot.envelope_figure(plane, color, slimits, ss, curves[k],
+                                           lower[k], upper[k], s, sig, sigerr,
+                                           scol, spec, max(upper[k]) * 1.2))
+         print("</div>")
+      print("</td></tr>")
+      return
+   xfitf = ROOT.TGraph(len(ss), ss, curves[0])
    xfitf.SetLineColor(ROOT.kRed)
+   xfitf.SetLineWidth(2)
    xdata = ROOT.TGraphErrors(len(sx), numpy.array(sx, dtype=float),
                                       numpy.array(sigx, dtype=float),
                                       numpy.array(zero, dtype=float),
                                       numpy.array(sigxerr, dtype=float))
-   xfit = xdata.Fit(xfitf, "qs")
    xdata.SetLineColor(ROOT.kRed)
    xdata.SetLineWidth(2)
    xdata.SetMarkerColor(ROOT.kRed)
    xdata.SetMarkerStyle(20)
 
-   ss = []
-   x0 = []
-   x1 = []
-   par = [xfit.Parameter(0), xfit.Parameter(1), xfit.Parameter(2)]
-   covar = xfit.GetCovarianceMatrix()
-   minvar = 0.01**2
-   for n in range(0, 101):
-      s = slimits[0] + n * (slimits[1] - slimits[0]) / 100
-      xmu = fit_model([s], par)
-      gra = fit_model_gradient([s], par)
-      ss.append(s)
-      xsigma = (covar(0,0) * gra[0]**2 + covar(1,1) * gra[1]**2 +
-                2 * covar(0,1) * gra[0] * gra[1] + minvar)**0.5
-      x0.append(xmu - xsigma)
-      x1.append(xmu + xsigma)
-      if x0[-1] < 0:
-         x0[-1] = 0
-   xshade = ROOT.TGraph(2 * len(ss), numpy.array(ss + ss[::-1], dtype=float),
-                                     numpy.array(x0 + x1[::-1], dtype=float))
+   xshade = ROOT.TGraph(2 * len(ss), *harpfit.band_polygon(ss, lower[0], upper[0]))
    xshade.SetFillColorAlpha(ROOT.kRed, 0.2);
 
-   ufitf = ROOT.TF1("ufitf", fit_model, slimits[0], slimits[1], 3)
-   ufitf.SetParameter(0, slimits[1])
-   ufitf.SetParameter(1, 1.0)
-   xemit = float(html.escape(form.getfirst("emittance_x")))
-   yemit = float(html.escape(form.getfirst("emittance_y")))
-   ufitf.FixParameter(2, (xemit * yemit)**0.5)
+   ufitf = ROOT.TGraph(len(ss), ss, curves[1])
    ufitf.SetLineColor(ROOT.kGreen)
-   goodsu = []
-   goodsigu = []
-   goodsuerr = []
-   goodsiguerr = []
-   for i in range(len(su)):
-      if siguerr[i] < 1:
-         goodsu.append(su[i])
-         goodsuerr.append(0)
-         goodsigu.append(sigu[i])
-         goodsiguerr.append(siguerr[i])
+   ufitf.SetLineWidth(2)
    udata = ROOT.TGraphErrors(len(goodsu), numpy.array(goodsu, dtype=float),
                                           numpy.array(goodsigu, dtype=float),
                                           numpy.array(goodsuerr, dtype=float),
                                           numpy.array(goodsiguerr, dtype=float))
-   ufit = udata.Fit(ufitf, "qs")
    udata.SetLineColor(ROOT.kBlue)
    udata.SetLineWidth(2)
    udata.SetMarkerColor(ROOT.kGreen)
    udata.SetMarkerStyle(20)
 
-   ss = []
-   u0 = []
-   u1 = []
-   par = [ufit.Parameter(0), ufit.Parameter(1), ufit.Parameter(2)]
-   covar = ufit.GetCovarianceMatrix()
-   minvar = 0.01**2
-   for n in range(0, 101):
-      s = slimits[0] + n * (slimits[1] - slimits[0]) / 100
-      umu = fit_model([s], par)
-      gra = fit_model_gradient([s], par)
-      ss.append(s)
-      usigma = (covar(0,0) * gra[0]**2 + covar(1,1) * gra[1]**2 +
-                2 * covar(0,1) * gra[0] * gra[1] + minvar)**0.5
-      u0.append(umu - usigma)
-      u1.append(umu + usigma)
-      if u0[-1] < 0:
-         u0[-1] = 0
-   ushade = ROOT.TGraph(2 * len(ss), numpy.array(ss + ss[::-1], dtype=float),
-                                     numpy.array(u0 + u1[::-1], dtype=float))
+   ushade = ROOT.TGraph(2 * len(ss), *harpfit.band_polygon(ss, lower[1], upper[1]))
    ushade.SetFillColorAlpha(ROOT.kGreen, 0.2);
 
-   yfitf = ROOT.TF1("yfitf", fit_model, slimits[0], slimits[1], 3)
-   yfitf.SetParameter(0, slimits[1])
-   yfitf.SetParameter(1, 1.0)
-   yfitf.FixParameter(2, float(html.escape(form.getfirst("emittance_y"))))
+   yfitf = ROOT.TGraph(len(ss), ss, curves[2])
    yfitf.SetLineColor(ROOT.kBlue)
+   yfitf.SetLineWidth(2)
    ydata = ROOT.TGraphErrors(len(sy), numpy.array(sy, dtype=float),
                                       numpy.array(sigy, dtype=float),
                                       numpy.array(zero, dtype=float),
                                       numpy.array(sigyerr, dtype=float))
-   yfit = ydata.Fit(yfitf, "qs")
    ydata.SetLineColor(ROOT.kBlue)
    ydata.SetLineWidth(2)
    ydata.SetMarkerColor(ROOT.kBlue)
    ydata.SetMarkerStyle(20)
 
-   ss = []
-   y0 = []
-   y1 = []
-   par = [yfit.Parameter(0), yfit.Parameter(1), yfit.Parameter(2)]
-   covar = yfit.GetCovarianceMatrix()
-   minvar = 0.01**2
-   for n in range(0, 101):
-      s = slimits[0] + n * (slimits[1] - slimits[0]) / 100
-      ymu = fit_model([s], par)
-      gra = fit_model_gradient([s], par)
-      ss.append(s)
-      ysigma = (covar(0,0) * gra[0]**2 + covar(1,1) * gra[1]**2 +
-                2 * covar(0,1) * gra[0] * gra[1] + minvar)**0.5
-      y0.append(ymu - ysigma)
-      y1.append(ymu + ysigma)
-      if y0[-1] < 0:
-         y0[-1] = 0
-   yshade = ROOT.TGraph(2 * len(ss), numpy.array(ss + ss[::-1], dtype=float),
-                                     numpy.array(y0 + y1[::-1], dtype=float))
+   yshade = ROOT.TGraph(2 * len(ss), *harpfit.band_polygon(ss, lower[2], upper[2]))
    yshade.SetFillColorAlpha(ROOT.kBlue, 0.2);
 
    c1 = ROOT.TCanvas("c1", "", 800, 600)
    xfitf.SetTitle("") # "sigma x vs accelerator s")
    xfitf.GetXaxis().SetTitle("accelerator s coordinate (m)")
+   xfitf.GetXaxis().SetLimits(slimits[0], slimits[1])
    xfitf.GetYaxis().SetTitle("#sigma_{x} (mm)")
    xfitf.SetMinimum(0)
-   xfitf.SetMaximum(max(x1) * 1.2)
-   xfitf.Draw()
+   xfitf.SetMaximum(max(upper[0]) * 1.2)
+   xfitf.Draw("AL")
    xdata.Draw("P")
    xshade.Draw("f")
-   scol = float(html.escape(form.getfirst("collimator_spos")))
-   sigma_collimator['x'] = xfitf.Eval(scol)
-   sigma_collimator['u'] = ufitf.Eval(scol)
-   sigma_collimator['y'] = yfitf.Eval(scol)
    gcol = ROOT.TGraph(2, numpy.array([scol] * 2, dtype=float), numpy.array([0, 1.5], dtype=float))
    gcol.Draw("L")
    xspec = ROOT.TArrow(scol, sigma_spec[0], slimits[1], sigma_spec[0], 0.03, "<|")
    xspec.SetAngle(35)
    xspec.Draw()
    c1.Update()
-   c1.Print(workdir + "harp-x-" + fitimage)
-   c1.Print(workdir + "harp-x-" + str(os.getpid()) + ".pdf")
+   with metrics.phase("c1.Print x png"):
+      c1.Print(workdir + "harp-x-" + fitimage)
+   if "pdf" in form:
+      with metrics.phase("c1.Print x pdf"):
+         c1.Print(workdir + "harp-x-" + fitname + ".pdf")
    ufitf.SetTitle("") # "sigma u vs accelerator s")
    ufitf.GetXaxis().SetTitle("accelerator s coordinate (m)")
+   ufitf.GetXaxis().SetLimits(slimits[0], slimits[1])
    ufitf.GetYaxis().SetTitle("#sigma_{u} (mm)")
    ufitf.SetMinimum(0)
-   ufitf.SetMaximum(max(u1) * 1.2)
-   ufitf.Draw()
+   ufitf.SetMaximum(max(upper[1]) * 1.2)
+   ufitf.Draw("AL")
    udata.Draw("P")
    ushade.Draw("f")
-   scol = float(html.escape(form.getfirst("collimator_spos")))
    gcol = ROOT.TGraph(2, numpy.array([scol] * 2, dtype=float), numpy.array([0, 1.5], dtype=float))
    gcol.Draw("L")
    uspec = ROOT.TArrow(scol, sigma_spec[0], slimits[1], sigma_spec[0], 0.03, "<|")
    uspec.SetAngle(35)
    uspec.Draw()
    c1.Update()
-   c1.Print(workdir + "harp-u-" + fitimage)
-   c1.Print(workdir + "harp-u-" + str(os.getpid()) + ".pdf")
+   with metrics.phase("c1.Print u png"):
+      c1.Print(workdir + "harp-u-" + fitimage)
+   if "pdf" in form:
+      with metrics.phase("c1.Print u pdf"):
+         c1.Print(workdir + "harp-u-" + fitname + ".pdf")
    yfitf.SetTitle("") # "sigma y vs accelerator s")
    yfitf.GetXaxis().SetTitle("accelerator s coordinate (m)")
+   yfitf.GetXaxis().SetLimits(slimits[0], slimits[1])
    yfitf.GetYaxis().SetTitle("#sigma_{y} (mm)")
    yfitf.SetMinimum(0)
-   yfitf.SetMaximum(max(y1) * 1.2)
-   yfitf.Draw()
+   yfitf.SetMaximum(max(upper[2]) * 1.2)
+   yfitf.Draw("AL")
    ydata.Draw("P")
    yshade.Draw("f")
    gcol.Draw("L")
@@ -254,15 +669,40 @@ def fit_and_plot(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr):
    yspec.SetAngle(35)
    yspec.Draw()
    c1.Update()
-   c1.Print(workdir + "harp-y-" + fitimage)
-   c1.Print(workdir + "harp-y-" + str(os.getpid()) + ".pdf")
+   with metrics.phase("c1.Print y png"):
+      c1.Print(workdir + "harp-y-" + fitimage)
+   if "pdf" in form:
+      with metrics.phase("c1.Print y pdf"):
+         c1.Print(workdir + "harp-y-" + fitname + ".pdf")
    print("<tr><td colspan=\"5\">")
    print("<div align=\"center\"><img src=\"work/harp-x-" + fitimage + "\"></div>")
    print("<div align=\"center\"><img src=\"work/harp-u-" + fitimage + "\"></div>")
    print("<div align=\"center\"><img src=\"work/harp-y-" + fitimage + "\"></div>")
+   if "pdf" in form:
+      print("<div align=\"center\">pdf copies:")
+      for plane in "xuy":
+         print("<a href=\"work/harp-" + plane + "-" + fitname + ".pdf\">" + plane + "</a>")
+      print("</div>")
    print("</td></tr>")
 
 def fit_and_plot_2d(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr):
+   if render_backend() == "svg":
+      ellipses = []
+      for i, (A, B, alpha) in enumerate(harp_ellipses(su, sigx, sigy, sigu)):
+         ellipses.append((A, B, alpha, 1+(i*2+1)%5, None))
+      colellipse = collimator_ellipse()
+      if colellipse is not None:
+         ellipses.append(tuple(colellipse) + (6, 6))
+      bands = [confidence_ring() + (6,)] if "radius" in collimator_confidence else []
+      print("<tr><td colspan=\"5\">")
+      print("<div align=\"center\">")
+      with metrics.phase("svg plot 2d"):
+         print(harpplot.ellipse_figure(ellipses, bands=bands))
+      print("</div>")
+      print("</td></tr>")
+      if collimator_confidence:
+         print_confidence()
+      return
    c1 = ROOT.TCanvas("c1", "", 600, 600)
    axes = ROOT.TH2D("axes", "", 1, -2, 2, 1, -2, 2)
    axes.GetXaxis().SetTitle("x (mm)")
@@ -271,211 +711,130 @@ def fit_and_plot_2d(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr):
    axes.SetStats(0)
    axes.Draw()
    ellipse = []
-   for i in range(3):
-      if sigu[i] == 999:
-         sigu[i] = sigu[0] + ((sigu[1] - sigu[0]) * (su[2] - su[0]) /
-                              (su[1] - su[0]))
-      tan2alpha = ((sigx[i]**2 + sigy[i]**2 - 2*sigu[i]**2) /
-                   (sigx[i]**2 - sigy[i]**2 + 1e-99))
-      alpha = numpy.arctan(tan2alpha) / 2
-      cos2alpha = numpy.cos(2 * alpha)
-      cosalpha = numpy.cos(alpha)
-      sinalpha = numpy.sin(alpha)
-      A2 = ((sigx[i] * cosalpha)**2 - (sigy[i] * sinalpha)**2) / (2 * cos2alpha)
-      B2 = ((sigy[i] * cosalpha)**2 - (sigx[i] * sinalpha)**2) / (2 * cos2alpha)
-      ellipse.append(ROOT.TEllipse(0, 0, A2**0.5, B2**0.5, 
-                                   0, 360, -alpha * 180/numpy.pi))
+   for i, (A, B, alpha) in enumerate(harp_ellipses(su, sigx, sigy, sigu)):
+      ellipse.append(ROOT.TEllipse(0, 0, A, B, 0, 360, -alpha * 180/numpy.pi))
       ellipse[-1].SetFillStyle(0)
       ellipse[-1].SetLineColor(1+(i*2+1)%5)
       ellipse[-1].Draw()
 
-   if 'x' in sigma_collimator and 'y' in sigma_collimator and 'u' in sigma_collimator:
-      # enforce the triangle inequality between sigma_x, sigma_y, and sigma_u
-      #   (sigma_x - sigma_y)**2 < 2 sigma_u**2 < (sigma_x + sigma_y)**2
-      sigx = sigma_collimator['x']
-      sigy = sigma_collimator['y']
-      sigu = sigma_collimator['u']
-      while (sigx - sigy)**2 > 2 * sigu**2:
-         if sigx > sigy:
-            sigx *= 0.95
-            sigy *= 1.05
-         else:
-            sigx *= 1.05
-            sigy *= 0.95
-      while (sigx + sigy)**2 < 2 * sigu**2:
-         sigx *= 1.05
-         sigy *= 1.05
-         sigu *= 0.95
-      tan2alpha = ((sigx**2 + sigy**2 - 2*sigu**2) / (sigx**2 - sigy**2))
-      alpha = numpy.arctan(tan2alpha) / 2
-      cos2alpha = numpy.cos(2 * alpha)
-      cosalpha = numpy.cos(alpha)
-      sinalpha = numpy.sin(alpha)
-      A2 = ((sigx * cosalpha)**2 -
-            (sigy * sinalpha)**2) / (2 * cos2alpha)
-      B2 = ((sigy * cosalpha)**2 -
-            (sigx * sinalpha)**2) / (2 * cos2alpha)
-      ellipse.append(ROOT.TEllipse(0, 0, A2**0.5, B2**0.5,
-                                   0, 360, -alpha * 180/numpy.pi))
+   colellipse = collimator_ellipse()
+   if colellipse is not None:
+      A, B, alpha = colellipse
+      ellipse.append(ROOT.TEllipse(0, 0, A, B, 0, 360, -alpha * 180/numpy.pi))
       ellipse[-1].SetFillStyle(3002)
       ellipse[-1].SetFillColor(6)
       ellipse[-1].SetLineColor(6)
       ellipse[-1].Draw()
 
+   if "radius" in collimator_confidence:
+      xs, ys = confidence_ring()
+      ring = ROOT.TGraph(len(xs), xs, ys)
+      ring.SetFillColorAlpha(6, 0.3)
+      ring.Draw("f")
+
    c1.Update()
-   c1.Print(workdir + "harp-2d-" + fitimage)
+   with metrics.phase("c1.Print 2d png"):
+      c1.Print(workdir + "harp-2d-" + fitimage)
    print("<tr><td colspan=\"5\">")
    print("<div align=\"center\"><img src=\"work/harp-2d-" + fitimage + "\"></div>")
    print("</td></tr>")
+   if collimator_confidence:
+      print_confidence()
 
+def reset():
+   """
+   Forget the results of the previous fit, before fitting a new scan
+   in the same process.
+   """
+   global last_fit
+   sigma_collimator.clear()
+   collimator_confidence.clear()
+   last_fit = None
 
-# main execution starts here
+def main(environ=None, name=None):
+   """
+   environ = cgi environment to read the form from (default os.environ)
+   name = unique tag for the output image files (default process id)
+   """
+   global form, optics, workdir, fitname, fitimage, metrics
+   metrics = toolmetrics.Timer("harptool_2d")
+   reset()
+   workdir = os.path.dirname(os.path.abspath(__file__)) + "/work/"
+   fitname = name or str(os.getpid())
+   fitimage = fitname + ".png"
+
+   with metrics.phase("form parsing"):
+      optics = beamline.load(slimits=slimits, npoints=band_points)
+      if environ is None:
+         form = cgi.FieldStorage()
+      else:
+         form = cgi.FieldStorage(environ=environ)
+   if form.getfirst("format") == "json":
+      print_json()
+      metrics.finish(format="json")
+      return
+
+   print_head()
+
+   print_inputs("xuy")
+   print("<tr><td colspan=\"5\" align=\"center\" height=\"80\" valign=\"middle\" >")
+   print("<input type=\"submit\" name=\"fit\" value=\"fit and plot\" \>")
+   print_render_options()
+   print_uncertainty_option()
+   print("</td></tr>")
+
+   with metrics.phase("form parsing"):
+      harps = read_harps()
+   sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr = harps[:9]
+   zero_values, breaking_bad = harps[9:]
+   if len(sx) < 2 or len(su) < 2 or len(sy) < 2:
+      print("<tr><td colspan=\"5\" align=\"center\">")
+      print("<font color=\"red\">")
+      print("Insufficient data, please fill in all", 3 * len(optics.monitors), "inputs with errors and try again!")
+      print("</font></td></tr>")
+   elif zero_values == 0 and breaking_bad == 0:
+      if "fit" in form:
+         fitname = fit_key(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr,
+                           render_backend())
+         fitimage = fitname + ".png"
 
-print_head()
-
-workdir = os.path.dirname(sys.argv[0]) + "/work/"
-fitimage = str(os.getpid()) + ".png"
-
-form = cgi.FieldStorage()
-
-print("<tr>")
-set_parameter("harp5C11_xsigma", "5C11 harp x sigma", 0, "mm")
-print("<td width=\"50\"></td>")
-set_parameter("harp5C11_xsigma_err", "5C11 harp x sigma error", 0.030, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("harp5C11_usigma", "5C11 harp u sigma", 0, "mm")
-print("<td width=\"50\"></td>")
-set_parameter("harp5C11_usigma_err", "5C11 harp u sigma error", 0.030, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("harp5C11_ysigma", "5C11 harp y sigma", 0, "mm")
-print("<td></td>")
-set_parameter("harp5C11_ysigma_err", "5C11 harp y sigma error", 0.030, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("harp5C11B_xsigma", "5C11B harp x sigma", 0, "mm")
-print("<td></td>")
-set_parameter("harp5C11B_xsigma_err", "5C11B harp x sigma error", 0.050, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("harp5C11B_usigma", "5C11B harp u sigma", 0, "mm")
-print("<td></td>")
-set_parameter("harp5C11B_usigma_err", "5C11B harp u sigma error", 0.050, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("harp5C11B_ysigma", "5C11B harp y sigma", 0, "mm")
-print("<td></td>")
-set_parameter("harp5C11B_ysigma_err", "5C11B harp y sigma error", 0.150, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("radHarp_xsigma", "radiator harp x sigma", 0, "mm")
-print("<td></td>")
-set_parameter("radHarp_xsigma_err", "radiator harp x sigma error", 0.020, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("radHarp_usigma", "radiator harp u sigma", 0, "mm")
-print("<td></td>")
-set_parameter("radHarp_usigma_err", "radiator harp u sigma error", 0.020, "mm")
-print("</tr>")
-print("<tr>")
-set_parameter("radHarp_ysigma", "radiator harp y sigma", 0, "mm")
-print("<td></td>")
-set_parameter("radHarp_ysigma_err", "radiator harp y sigma error", 0.020, "mm")
-print("</tr>")
-print("<tr>")
-print("<td colspan=\"2\" bgcolor=\"#dfcfaf\">")
-print("<i>Enter measured values in the above input boxes,</i>")
-print("</td><td></td>")
-set_parameter("harp5C11_spos", "s of 5C11 harps", 102.97, "m")
-print("</tr>")
-print("<tr>")
-print("<td colspan=\"2\" bgcolor=\"#dfcfaf\">")
-print("<i>defaults are generally ok for the other fields.</i>")
-print("</td><td></td>")
-set_parameter("harp5C11B_spos", "s of 5C11B harps", 115.11, "m")
-print("</tr>")
-print("<tr>")
-set_parameter("emittance_x", "x emittance of e-beam", 0.0041, "mm.mrad")
-print("<td></td>")
-set_parameter("radHarp_spos", "s of radiator harp", 119.70, "m")
-print("</tr>")
-print("<tr>")
-set_parameter("emittance_y", "y emittance of e-beam", 0.00233, "mm.mrad")
-print("<td></td>")
-set_parameter("collimator_spos", "s of primary collimator", 194.92, "m")
-print("</tr>")
-print("<tr><td colspan=\"5\" align=\"center\" height=\"80\" valign=\"middle\" >")
-print("<input type=\"submit\" name=\"fit\" value=\"fit and plot\" \>")
-print("</td></tr>")
-
-sx = []
-su = []
-sy = []
-sigx = []
-sigu = []
-sigy = []
-sigxerr = []
-siguerr = []
-sigyerr = []
-zero_values = 0
-breaking_bad = 0
-for key in ("harp5C11", "harp5C11B", "radHarp"):
-   try:
-      sx.append(float(html.escape(form.getfirst(key + "_spos"))))
-      su.append(float(html.escape(form.getfirst(key + "_spos"))))
-      sy.append(float(html.escape(form.getfirst(key + "_spos"))))
-      sigx.append(float(html.escape(form.getfirst(key + "_xsigma"))))
-      sigxerr.append(float(html.escape(form.getfirst(key + "_xsigma_err"))))
-      sigu.append(float(html.escape(form.getfirst(key + "_usigma"))))
-      siguerr.append(float(html.escape(form.getfirst(key + "_usigma_err"))))
-      sigy.append(float(html.escape(form.getfirst(key + "_ysigma"))))
-      sigyerr.append(float(html.escape(form.getfirst(key + "_ysigma_err"))))
-      if key != "radHarp":
-         sigu2 = sigx[-1]**2 + sigy[-1]**2 - sigu[-1]**2
-         if sigu2 > 0:
-            sigu[-1] = sigu2**0.5
+         def produce():
+            metrics.info["cached"] = False
+            out = harpcache.capture(fit_and_plot,
+                                    sx, [s for s in sigx], [e for e in sigxerr],
+                                    su, [s for s in sigu], [e for e in siguerr],
+                                    sy, [s for s in sigy], [e for e in sigyerr])
+            out += harpcache.capture(fit_and_plot_2d, sx, sigx, sigxerr,
+                                     su, sigu, siguerr, sy, sigy, sigyerr)
+            row = history_row(fitname, sx, sigx, sigxerr, su, sigu, siguerr,
+                              sy, sigy, sigyerr)
+            return {"html": out, "sigma_collimator": dict(sigma_collimator),
+                    "history": harphistory.row_json(row)}
+
+         metrics.info.update(fit=fitname, cached=True)
+         try:
+            result = harpcache.cached(workdir, fitname, produce)
+         except ValueError as err:
+            print("<tr><td colspan=\"5\" align=\"center\">")
+            print("<font color=\"red\">")
+            print("Fit failed,", html.escape(str(err)) + ", please check the data and the beamline and try again!")
+            print("</font></td></tr>")
          else:
-            sigu[-1] = (sigx[-1]**2 + sigy[-1]**2)**0.5 / 30
-   except:
-      breaking_bad += 1
-      continue
-   if sigxerr[-1] > 0:
-      if sigx[-1] == 0:
-         zero_values += 1
-   else:
-      sx.pop()
-      sigx.pop()
-      sigxerr.pop()
-   if siguerr[-1] > 0:
-      if sigu[-1] == 0:
-         zero_values += 1
+            record_history(harphistory.row_from_json(result["history"]))
+            sigma_collimator.update(result["sigma_collimator"])
+            print(result["html"], end="")
    else:
-      su.pop()
-      sigu.pop()
-      siguerr.pop()
-   if sigyerr[-1] > 0:
-      if sigy[-1] == 0:
-         zero_values += 1
-   else:
-      sy.pop()
-      sigy.pop()
-      sigyerr.pop()
-if len(sx) < 2 or len(su) < 2 or len(sy) < 2:
-   print("<tr><td colspan=\"5\" align=\"center\">")
-   print("<font color=\"red\">")
-   print("Insufficient data, please fill in all 9 inputs with errors and try again!")
-   print("</font></td></tr>")
-elif zero_values == 0 and breaking_bad == 0:
-   if "fit" in form:
-      fit_and_plot(sx, [s for s in sigx], [e for e in sigxerr],
-                   su, [s for s in sigu], [e for e in siguerr],
-                   sy, [s for s in sigy], [e for e in sigyerr])
-      fit_and_plot_2d(sx, sigx, sigxerr, su, sigu, siguerr, sy, sigy, sigyerr)
-else:
-   print("<tr><td colspan=\"5\" align=\"center\">")
-   print("<font color=\"red\">")
-   print("Invalid data,", breaking_bad, "please correct errors in the above data and try again!")
-   print("</font></td></tr>")
-
-print_tail()
+      print("<tr><td colspan=\"5\" align=\"center\">")
+      print("<font color=\"red\">")
+      print("Invalid data,", breaking_bad, "please correct errors in the above data and try again!")
+      print("</font></td></tr>")
+
+   if form.getfirst("debug"):
+      print(metrics.html())
+   print_tail()
+   metrics.finish()
+
+# main execution starts here
+
+if __name__ == "__main__":
+   main()
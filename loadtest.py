@@ -0,0 +1,393 @@
+#!/usr/bin/python
+#
+# loadtest.py - load test of the harptool, harptool_2d and ratetool web
+#               tools, replaying synthetic or recorded form submissions
+#               at a given concurrency against a local stand-in for the
+#               cgi web server.
+#
+# usage: loadtest.py [-n REQUESTS] [-c CONCURRENCY] [--mix KIND=WEIGHT,...]
+#                    [--replay LOG] [--url URL] [--follow] [--clean]
+#                    [--json FILE]
+#
+# The synthetic traffic is a mix of the requests that people make during
+# beam studies, drawn at random with the --mix weights:
+#    form     the bare page of one of the tools
+#    default  a filled-in harp form with one of its "default" buttons
+#             pressed
+#    fit      "fit and plot" of a new harp scan, in harptool or harptool_2d
+#    refit    "fit and plot" of a scan that was fitted before, as when the
+#             page is reloaded or shared
+#    rates    a ratetool_py calculation with a random peak energy and tilt
+# The harp scans are made from the beamline.json envelopes with the
+# synthetic_fields of benchmark.py, with random measurement noise. With
+# --replay, the requests are instead the *.cgi urls found in LOG, which
+# can be a web server access log or a plain list of urls, replayed in
+# order and repeated as needed.
+#
+# Unless --url gives the address of a running server, the *.cgi scripts
+# are run as in production, one process per request with the cgi
+# environment, by a threaded http server on a free local port, which
+# also serves the plot files in work/. A running harpserver.py is used
+# by the harp tools as it would be under the real web server. The rate
+# calculations are queued by ratetool_py, and --follow makes each client
+# reload the job page until the results are shown, as a browser would,
+# reporting the time to the results as the kind "rates result".
+#
+# The report gives for each kind of request and in total the number of
+# requests, the error rate (http errors, failed connections and pages
+# with a python traceback), the p50, p95 and p99 latencies and the
+# throughput, and the growth of work/ in bytes and files per request.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import re
+import sys
+import json
+import time
+import html
+import random
+import argparse
+import threading
+import subprocess
+import http.client
+import http.server
+import urllib.parse
+
+import numpy
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+workdir = basedir + "/work/"
+sys.path.insert(0, basedir)
+import benchmark
+import ratetool
+
+default_mix = {"form": 2, "default": 1, "fit": 4, "refit": 2, "rates": 1}
+harp_tools = ("harptool", "harptool_2d")
+page_tools = ("harptool", "harptool_2d", "ratetool_py")
+request_timeout = 600
+url_pattern = re.compile(r"/?(?:[\w.~-]+/)*(\w+)\.cgi(?:\?([^\s\"]*))?")
+refresh_pattern = re.compile(r"<meta http-equiv=\"refresh\" content=\"(\d+); url=([^\"]*)\">")
+error_marks = ("A problem occurred in a Python script", "Traceback (most recent call last)")
+
+class CGIRequestHandler(http.server.BaseHTTPRequestHandler):
+   """
+   Runs /<name>.cgi?<query> as a cgi script in its own process, and
+   serves /work/<file> from the work directory.
+   """
+   def do_GET(self):
+      url = urllib.parse.urlsplit(self.path)
+      name = os.path.basename(url.path)
+      if name.endswith(".cgi") and os.path.exists(basedir + "/" + name):
+         self.run_script(basedir + "/" + name, url.query)
+      elif os.path.dirname(url.path).endswith("/work"):
+         self.send_file(workdir + name)
+      else:
+         self.send_error(404)
+
+   def run_script(self, script, query):
+      environ = dict(os.environ, GATEWAY_INTERFACE="CGI/1.1",
+                     REQUEST_METHOD="GET", QUERY_STRING=query,
+                     SCRIPT_NAME="/" + os.path.basename(script),
+                     SERVER_NAME="localhost", SERVER_PROTOCOL="HTTP/1.1")
+      proc = subprocess.run([script], cwd=basedir, env=environ,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+      out = proc.stdout.replace(b"\r\n", b"\n")
+      head, sep, body = out.partition(b"\n\n")
+      if proc.returncode != 0 or not sep:
+         self.send_error(500, "cgi script exited with status {0}".format(proc.returncode))
+         return
+      self.send_response(200)
+      for line in head.decode("latin-1").split("\n"):
+         key, sep, value = line.partition(":")
+         if sep:
+            self.send_header(key.strip(), value.strip())
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def send_file(self, path):
+      try:
+         with open(path, "rb") as f:
+            data = f.read()
+      except OSError:
+         self.send_error(404)
+         return
+      self.send_response(200)
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+   def log_message(self, format, *args):
+      pass
+
+def start_server():
+   """
+   Start the stand-in cgi server on a free local port in a background
+   thread, returning its base url.
+   """
+   httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), CGIRequestHandler)
+   httpd.daemon_threads = True
+   thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+   thread.start()
+   return "http://127.0.0.1:{0}/".format(httpd.server_address[1])
+
+class Traffic:
+   """
+   Thread-safe source of the requests of a test, as (kind, path) with
+   path relative to the server url.
+   """
+   def __init__(self, mix, seed=1, replay=None, engine=None):
+      self.lock = threading.Lock()
+      self.random = random.Random(seed)
+      self.kinds = list(mix)
+      self.weights = [mix[kind] for kind in self.kinds]
+      self.count = 0
+      self.fitted = []
+      self.replay = replay
+      self.engine = engine
+
+   def next(self):
+      with self.lock:
+         self.count += 1
+         if self.replay:
+            tool, query = self.replay[(self.count - 1) % len(self.replay)]
+            return "replay " + tool, tool + ".cgi?" + query
+         kind = self.random.choices(self.kinds, self.weights)[0]
+         return kind, getattr(self, kind)()
+
+   def form(self):
+      return self.random.choice(page_tools) + ".cgi"
+
+   def scan(self):
+      fields = benchmark.synthetic_fields(noise=benchmark.scan_noise,
+                                          seed=self.random.randrange(2**31))
+      return {key: "{0:.4g}".format(value) for key, value in fields.items()}
+
+   def default(self):
+      fields = self.scan()
+      name = self.random.choice([key for key in fields if key.endswith("sigma")])
+      fields["default " + name] = "default"
+      return self.random.choice(harp_tools) + ".cgi?" + urllib.parse.urlencode(fields)
+
+   def fit(self):
+      fields = self.scan()
+      fields["fit"] = "fit and plot"
+      path = self.random.choice(harp_tools) + ".cgi?" + urllib.parse.urlencode(fields)
+      self.fitted.append(path)
+      return path
+
+   def refit(self):
+      if not self.fitted:
+         return self.fit()
+      return self.random.choice(self.fitted)
+
+   def rates(self):
+      fields = {par: default for par, desc, default, unit in
+                ratetool.beam_parameters + ratetool.window_parameters}
+      fields["photonEpeak"] = round(self.random.uniform(8., 9.5), 2)
+      fields["radSecondTilt"] = round(self.random.uniform(0.2, 0.3), 3)
+      fields["run"] = "plot collimated beam rate spectrum"
+      if self.engine:
+         fields["engine"] = self.engine
+      return "ratetool_py.cgi?" + urllib.parse.urlencode(fields)
+
+def read_replay(filename):
+   """
+   The (tool, query) of each *.cgi url in a web server access log or a
+   list of urls.
+   """
+   requests = []
+   with open(filename) as f:
+      for line in f:
+         match = url_pattern.search(line)
+         if match:
+            requests.append((match.group(1), match.group(2) or ""))
+   if not requests:
+      raise ValueError("no *.cgi requests found in " + filename)
+   return requests
+
+class Results:
+   """
+   Latencies and errors of the requests made so far, by kind.
+   """
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.latency = {}
+      self.errors = {}
+
+   def add(self, kind, seconds, error):
+      with self.lock:
+         self.latency.setdefault(kind, []).append(seconds)
+         self.errors[kind] = self.errors.get(kind, 0) + int(error)
+
+def fetch(base, path):
+   """
+   GET base + path, returning (latency, body, error) with error True for
+   a failed request or a page showing a python traceback.
+   """
+   url = urllib.parse.urlsplit(urllib.parse.urljoin(base, path))
+   start = time.perf_counter()
+   try:
+      conn = http.client.HTTPConnection(url.hostname, url.port, timeout=request_timeout)
+      conn.request("GET", url.path + ("?" + url.query if url.query else ""))
+      resp = conn.getresponse()
+      body = resp.read().decode("utf-8", "replace")
+      conn.close()
+      error = resp.status != 200 or any(mark in body for mark in error_marks)
+   except (OSError, http.client.HTTPException):
+      body = ""
+      error = True
+   return time.perf_counter() - start, body, error
+
+def client(base, traffic, results, count, follow):
+   """
+   Body of one simulated user, making requests one after another until
+   count of them have been started by all clients together.
+   """
+   while True:
+      with traffic.lock:
+         if traffic.count >= count:
+            return
+      kind, path = traffic.next()
+      seconds, body, error = fetch(base, path)
+      results.add(kind, seconds, error)
+      refresh = refresh_pattern.search(body) if follow and not error else None
+      if refresh:
+         total = seconds
+         while refresh and not error:
+            time.sleep(int(refresh.group(1)))
+            total += int(refresh.group(1))
+            seconds, body, error = fetch(base, html.unescape(refresh.group(2)))
+            results.add(kind + " poll", seconds, error)
+            total += seconds
+            refresh = refresh_pattern.search(body)
+         results.add(kind + " result", total, error)
+
+def disk_usage(path):
+   """
+   Total size (bytes) and number of the files under path.
+   """
+   size = files = 0
+   for root, _, names in os.walk(path):
+      for name in names:
+         try:
+            size += os.path.getsize(os.path.join(root, name))
+            files += 1
+         except OSError:
+            pass
+   return size, files
+
+def snapshot(path):
+   """
+   Paths of the directories and files under path.
+   """
+   found = set()
+   for root, dirs, names in os.walk(path):
+      found.update(os.path.join(root, name) for name in dirs + names)
+   return found
+
+def summary(results, elapsed, growth, requests):
+   """
+   Report of a test as a dict, with the statistics of each kind of
+   request and of all of them under "total".
+   """
+   report = {"elapsed": elapsed, "requests": requests,
+             "work_bytes_per_request": growth[0] / max(requests, 1),
+             "work_files_per_request": growth[1] / max(requests, 1),
+             "kinds": {}}
+   everything = []
+   for kind in sorted(results.latency):
+      latency = numpy.array(results.latency[kind])
+      if not kind.endswith(" result"):
+         everything.append(latency)
+      report["kinds"][kind] = stats(latency, results.errors[kind], elapsed)
+   errors = sum(results.errors[kind] for kind in results.errors
+                if not kind.endswith(" result"))
+   report["kinds"]["total"] = stats(numpy.concatenate(everything), errors, elapsed)
+   return report
+
+def stats(latency, errors, elapsed):
+   p50, p95, p99 = numpy.percentile(latency, (50, 95, 99))
+   return {"count": len(latency), "error_rate": errors / len(latency),
+           "p50": float(p50), "p95": float(p95), "p99": float(p99),
+           "throughput": len(latency) / elapsed}
+
+def print_report(report):
+   print("{0:24s} {1:>7s} {2:>7s} {3:>9s} {4:>9s} {5:>9s} {6:>8s}".format(
+         "kind", "count", "errors", "p50 (s)", "p95 (s)", "p99 (s)", "req/s"))
+   for kind, s in report["kinds"].items():
+      print("{0:24s} {1:7d} {2:6.1f}% {3:9.3f} {4:9.3f} {5:9.3f} {6:8.2f}".format(
+            kind, s["count"], 100 * s["error_rate"], s["p50"], s["p95"], s["p99"],
+            s["throughput"]))
+   print("{0} requests in {1:.1f} s, work/ grew by {2:.0f} bytes and {3:.2f} files per request"
+         .format(report["requests"], report["elapsed"], report["work_bytes_per_request"],
+                 report["work_files_per_request"]))
+
+def run(count, concurrency, mix=None, replay=None, url=None, follow=False,
+        seed=1, clean=False, engine=None):
+   """
+   Make count requests from concurrency simulated users at once and
+   return the report.
+   """
+   base = url or start_server()
+   if not base.endswith("/"):
+      base += "/"
+   traffic = Traffic(mix or default_mix, seed, replay, engine)
+   results = Results()
+   before = disk_usage(workdir)
+   files = snapshot(workdir)
+   start = time.perf_counter()
+   clients = [threading.Thread(target=client, args=(base, traffic, results, count, follow))
+              for _ in range(concurrency)]
+   for thread in clients:
+      thread.start()
+   for thread in clients:
+      thread.join()
+   elapsed = time.perf_counter() - start
+   after = disk_usage(workdir)
+   if clean:
+      # deepest first, so that new directories are empty when they are reached
+      for name in sorted(snapshot(workdir) - files, reverse=True):
+         if os.path.isdir(name):
+            os.rmdir(name)
+         else:
+            os.remove(name)
+   return summary(results, elapsed, (after[0] - before[0], after[1] - before[1]), count)
+
+def parse_mix(text):
+   mix = {}
+   for item in text.split(","):
+      kind, _, weight = item.partition("=")
+      if kind not in default_mix:
+         raise argparse.ArgumentTypeError("unknown kind of request " + kind)
+      mix[kind] = float(weight or 1)
+   return mix
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="load test of the web tools")
+   parser.add_argument("-n", "--requests", type=int, help="number of requests (default 100, "
+                       "or one pass through the --replay log)")
+   parser.add_argument("-c", "--concurrency", type=int, default=4, help="simultaneous users")
+   parser.add_argument("--mix", type=parse_mix, help="weights of the kinds of request, "
+                       "as form=2,default=1,fit=4,refit=2,rates=1")
+   parser.add_argument("--replay", metavar="LOG", help="replay the *.cgi requests in LOG")
+   parser.add_argument("--url", help="base url of a running server to test instead")
+   parser.add_argument("--follow", action="store_true",
+                       help="reload queued rate jobs until their results are shown")
+   parser.add_argument("--engine", help="engine of the rate calculations (default as on the form)")
+   parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic traffic")
+   parser.add_argument("--clean", action="store_true",
+                       help="remove the files the test added to work/")
+   parser.add_argument("--json", metavar="FILE", help="also write the report as json")
+   args = parser.parse_args()
+   replay = read_replay(args.replay) if args.replay else None
+   count = args.requests or (len(replay) if replay else 100)
+   report = run(count, args.concurrency, args.mix, replay, args.url, args.follow,
+                args.seed, args.clean, args.engine)
+   print_report(report)
+   if args.json:
+      with open(args.json, "w") as f:
+         json.dump(report, f, indent=1)
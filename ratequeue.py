@@ -0,0 +1,280 @@
+#!/usr/bin/python
+#
+# ratequeue.py - local job queue for the ratetool.py rate calculations,
+#                so that the web server never waits on a long spectrum
+#                calculation.
+#
+# usage: ratequeue.py --run      (work off the queued jobs, normally
+#                                 started by ratetool.py itself)
+#        ratequeue.py --list     (show the jobs in the queue)
+#
+# A job is a set of ratetool form parameters and the engine to compute
+# them with. Its id is a hash of these, so a submission that is identical
+# to one already queued, running or finished is merged with it and gets
+# the same id, unless it failed or its results are gone, when it is
+# queued again. Each job is a record work/ratequeue/<id>.json holding its
+# state, "queued", "running", "done" or "failed", and the times of these
+# transitions; the results are written next to it in <id>.result.json,
+# and the histograms and the fortran output to work/cobrems_<id>.npz and
+# work/cobrems_<id>.log as for a direct ratetool run, so that every job
+# has a log of its own.
+#
+# Jobs are worked off by runner processes, at most max_workers of them at
+# a time, each holding one of the slot locks work/ratequeue/slot<n>.lock
+# while it runs. Submitting a job starts a detached runner, which exits at
+# once if all slots are taken; a runner that finds the queue empty gives
+# up its slot and looks again before exiting, so no job is left behind.
+# All changes to the job records are made under the lock queue.lock. A
+# job left running by a runner that died is queued again, and finished
+# jobs are removed with their files after job_lifetime seconds.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import hashlib
+import argparse
+import contextlib
+import subprocess
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+workdir = basedir + "/work/"
+queuedir = workdir + "ratequeue/"
+max_workers = 2
+job_lifetime = 86400
+
+def job_id(values, engine):
+   """
+   Id of the job computing the ratetool form parameters in values, a
+   dict of name -> number, with engine.
+   """
+   norm = {name: repr(float(values[name])) for name in values}
+   text = json.dumps([engine, norm], sort_keys=True)
+   return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+@contextlib.contextmanager
+def locked():
+   """
+   Hold the exclusive lock on the queue, for any change to the jobs.
+   """
+   os.makedirs(queuedir, exist_ok=True)
+   with open(queuedir + "queue.lock", "a") as lockfile:
+      fcntl.flock(lockfile, fcntl.LOCK_EX)
+      try:
+         yield
+      finally:
+         fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+def valid(job):
+   return re.match(r"^[0-9a-f]{16}$", job or "") is not None
+
+def read_job(job):
+   """
+   Return the record of job, or None if there is no such job.
+   """
+   if not valid(job):
+      return None
+   try:
+      with open(queuedir + job + ".json") as f:
+         return json.load(f)
+   except (OSError, ValueError):
+      return None
+
+def write_job(record):
+   """
+   Save a job record, written atomically so that readers never see a
+   partial one.
+   """
+   path = queuedir + record["id"] + ".json"
+   with open(path + "." + str(os.getpid()), "w") as f:
+      json.dump(record, f)
+   os.replace(path + "." + str(os.getpid()), path)
+
+def read_result(job):
+   """
+   Return the results document of a finished job, or None.
+   """
+   if not valid(job):
+      return None
+   try:
+      with open(queuedir + job + ".result.json") as f:
+         return json.load(f)
+   except (OSError, ValueError):
+      return None
+
+def jobs():
+   """
+   Records of all jobs, oldest submission first.
+   """
+   records = []
+   if os.path.isdir(queuedir):
+      for name in os.listdir(queuedir):
+         if name.endswith(".json") and not name.endswith(".result.json"):
+            record = read_job(name[:-5])
+            if record is not None:
+               records.append(record)
+   return sorted(records, key=lambda record: record["submitted"])
+
+def alive(pid):
+   try:
+      os.kill(pid, 0)
+   except ProcessLookupError:
+      return False
+   except PermissionError:
+      pass
+   return True
+
+def job_files(job):
+   return [queuedir + job + ".json", queuedir + job + ".result.json",
+           workdir + "cobrems_" + job + ".log", workdir + "cobrems_" + job + ".npz",
+           workdir + "cobrems_" + job + ".root"]
+
+def tidy(records):
+   """
+   Under the queue lock, queue again the jobs of runners that died and
+   delete the jobs that finished more than job_lifetime ago. Returns the
+   records that are left.
+   """
+   now = time.time()
+   kept = []
+   for record in records:
+      if record["state"] == "running" and not alive(record["pid"]):
+         record["state"] = "queued"
+         write_job(record)
+      elif record["state"] in ("done", "failed") and now - record["finished"] > job_lifetime:
+         for name in job_files(record["id"]):
+            if os.path.exists(name):
+               os.remove(name)
+         continue
+      kept.append(record)
+   return kept
+
+def submit(values, engine):
+   """
+   Queue the calculation of the ratetool form parameters in values with
+   engine, unless the same job is already queued, running or done, and
+   make sure a runner is working on the queue. A job that failed, or is
+   done but has lost its results, is queued again, so that it can be
+   retried. Returns the job id at once.
+   """
+   job = job_id(values, engine)
+   with locked():
+      tidy(jobs())
+      record = read_job(job)
+      if (record is None or record["state"] == "failed" or
+          record["state"] == "done" and read_result(job) is None):
+         write_job({"id": job, "values": values, "engine": engine,
+                    "state": "queued", "submitted": time.time()})
+   start_runner()
+   return job
+
+def status(job):
+   """
+   Record of job with its "position" in the queue added, the number of
+   jobs waiting ahead of it, or None if there is no such job.
+   """
+   record = read_job(job)
+   if record is not None:
+      queued = [r["id"] for r in jobs() if r["state"] == "queued"]
+      record["position"] = queued.index(job) if job in queued else 0
+   return record
+
+def start_runner():
+   """
+   Start a runner process, detached from the caller so that the web
+   request can return while it works.
+   """
+   subprocess.Popen([sys.executable, basedir + "/ratequeue.py", "--run"],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL, close_fds=True,
+                    start_new_session=True)
+
+def claim():
+   """
+   Mark the oldest queued job as running in this process and return its
+   record, or None if nothing is queued.
+   """
+   with locked():
+      for record in tidy(jobs()):
+         if record["state"] == "queued":
+            record.update(state="running", pid=os.getpid(), started=time.time())
+            write_job(record)
+            return record
+   return None
+
+def execute(record):
+   """
+   Compute one job with ratetool.py and record its results or error.
+   """
+   import ratetool
+   import toolmetrics
+   job = record["id"]
+   ratetool.metrics = toolmetrics.Timer("ratequeue")
+   ratetool.metrics.add("waiting in queue", record["started"] - record["submitted"])
+   try:
+      result = ratetool.compute_rates(record["values"], record["engine"],
+                                      log=workdir + "cobrems_" + job + ".log")
+      with ratetool.metrics.phase("save histograms"):
+         files = ratetool.save_histograms(result, workdir + "cobrems_" + job)
+      doc = ratetool.results_json(record["values"], result, files)
+      with open(queuedir + job + ".result.json." + str(os.getpid()), "w") as f:
+         json.dump(doc, f)
+      os.replace(queuedir + job + ".result.json." + str(os.getpid()),
+                 queuedir + job + ".result.json")
+      record.update(state="done", engine_used=result["engine"])
+   except Exception as err:
+      record.update(state="failed", error=str(err) or type(err).__name__)
+   record["finished"] = time.time()
+   with locked():
+      write_job(record)
+   ratetool.metrics.finish(job=job, engine=record.get("engine_used", record["engine"]),
+                           state=record["state"])
+
+def run():
+   """
+   Body of a runner: take a free worker slot, or return at once if there
+   is none, and compute queued jobs one after another until there are no
+   more. Returns the number of jobs computed.
+   """
+   sys.path.insert(0, basedir)
+   os.makedirs(queuedir, exist_ok=True)
+   count = 0
+   while True:
+      for slot in range(max_workers):
+         lockfile = open(queuedir + "slot" + str(slot) + ".lock", "a")
+         try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+         except OSError:
+            lockfile.close()
+      else:
+         return count
+      with lockfile:
+         record = claim()
+         while record is not None:
+            execute(record)
+            count += 1
+            record = claim()
+      # a job submitted while the slot was being given up would be left
+      # waiting by a runner that found every slot taken, so look again
+      if not any(r["state"] == "queued" for r in jobs()):
+         return count
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="ratetool job queue")
+   parser.add_argument("--run", action="store_true", help="work off the queued jobs")
+   parser.add_argument("--list", action="store_true", help="list the jobs in the queue")
+   args = parser.parse_args()
+   if args.run:
+      run()
+   if args.list or not args.run:
+      now = time.time()
+      for record in jobs():
+         print("{0} {1:8s} {2:8s} submitted {3:.0f}s ago {4}".format(
+               record["id"], record["state"], record["engine"],
+               now - record["submitted"], record.get("error", "")))
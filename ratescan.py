@@ -0,0 +1,210 @@
+#!/usr/bin/python
+#
+# ratescan.py - parameter scans of the Hall D coherent bremsstrahlung beam
+#               rates over a grid of collimator diameter, coherent edge
+#               energy, radiator secondary tilt and beam emittance, in
+#               place of the serial cobrems#scan paw macro.
+#
+# usage: ratescan.py [-j N] [-o OUTPUT] [--coldiam GRID] [--Epeak GRID]
+#                    [--ytilt GRID] [--emit GRID] [other fixed parameters]
+#
+# Each GRID is either a comma separated list of values "a,b,c" or
+# "start:stop:n" for n values evenly spaced from start to stop. The
+# spectra are computed with cobrems.py on a pool of worker processes. All
+# collimator diameters of one (Epeak, ytilt, emit) point are done by one
+# worker in a single pass over the lattice table and energy grid, and the
+# points of one crystal orientation are handed out together, so that each
+# worker builds the lattice table of an orientation and the acceptance
+# table of a collimator only once.
+#
+# The output is a text table with one row per grid point and the columns
+#    coldiam Epeak ytilt emit tagged background endpoint polarized polarization
+# giving the collimated rates (/s) in the tagged, background and endpoint
+# windows, the linearly polarized rate in the tagged window and the
+# average polarization there. Rows are appended and flushed as each point
+# finishes, so the file can be read while the scan is running. The first
+# line records the fixed parameters of the scan. Running the same scan
+# again with the same output file skips the points that are already in
+# it, so an interrupted scan is resumed where it stopped.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import sys
+import argparse
+import multiprocessing
+
+# each worker does its own vectorized numpy work, so threading only gets in the way
+for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+   os.environ.setdefault(var, "1")
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cobrems
+
+axes = ("coldiam", "Epeak", "ytilt", "emit")
+columns = axes + ("tagged", "background", "endpoint", "polarized", "polarization")
+
+def grid_values(spec):
+   """
+   Values of one grid axis from its command line spec, either a comma
+   separated list "a,b,c" or "start:stop:n" for n values from start to stop.
+   """
+   if ":" in spec:
+      start, stop, n = spec.split(":")
+      return [float(v) for v in numpy.linspace(float(start), float(stop), int(n))]
+   return [float(v) for v in spec.split(",")]
+
+def point_key(values):
+   """
+   Key of a grid point identifying it in the output file.
+   """
+   return tuple("{0:.9g}".format(float(v)) for v in values)
+
+def settings_line(fixed, windows):
+   """
+   First line of the output file, recording the fixed scan parameters.
+   """
+   words = ["{0}={1:.9g}".format(par, fixed[par]) for par in sorted(fixed)]
+   words += ["{0}={1:.9g}:{2:.9g}".format(window, *windows[window])
+             for window in sorted(windows)]
+   return "# ratescan " + " ".join(words) + "\n"
+
+def read_done(filename, settings):
+   """
+   Keys of the grid points already in the output file of an earlier run
+   of the same scan. A last line that was cut off by an interrupted scan
+   is removed, and so is a header that was cut off before any rows were
+   written. Raises ValueError if the file was made with different fixed
+   parameters.
+   """
+   if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+      return set()
+   with open(filename, "r+") as f:
+      lines = f.readlines()
+      if not lines[-1].endswith("\n"):
+         f.truncate(sum(len(line) for line in lines[:-1]))
+         lines.pop()
+      if len(lines) < 2:
+         f.truncate(0)
+         return set()
+      if lines[0] != settings:
+         raise ValueError(filename + " holds a scan with different settings")
+   done = set()
+   for line in lines:
+      if is_header(line):
+         continue
+      done.add(point_key(line.split()[:len(axes)]))
+   return done
+
+def is_header(line):
+   """
+   True for the settings and column name lines of the output file, which
+   an earlier version repeated when an interrupted scan was resumed.
+   """
+   words = line.split()
+   return not words or words[0].startswith("#") or words[0] == columns[0]
+
+def scan_group(task):
+   """
+   Rates at all collimator diameters of one (Epeak, ytilt, emit) point of
+   the grid, in a worker process. Returns the lines of the output table.
+    task = (coldiams, Epeak, ytilt, emit, fixed, windows)
+   """
+   coldiams, Epeak, ytilt, emit, fixed, windows = task
+   cobrems.max_acceptances = max(cobrems.max_acceptances, len(coldiams) + 4)
+   E0 = fixed["E0"]
+   setup = cobrems.Setup(E0, Epeak, ytilt, emit, fixed["radt"], fixed["dist"],
+                         coldiams[0], 0, fixed["epol"], fixed["mos"])
+   edges = numpy.linspace(fixed["Emin"], fixed["Emax"], int(fixed["nbins"]) + 1)
+   x = (edges[:-1] + edges[1:]) / 2 / E0
+   modes = [(polar, coldiam) for coldiam in coldiams for polar in (0, 1)]
+   spectra = setup.coherent(x, modes)
+   spectra[0::2] += setup.incoherent(x, modes[0::2])
+   rates = setup.convol(x, spectra * fixed["cur"] / 1.6e-13) / E0
+   lines = []
+   for n, coldiam in enumerate(coldiams):
+      total, linear = rates[2 * n], rates[2 * n + 1]
+      sums = [cobrems.window_sum(edges, total, *windows[window])
+              for window in ("tagged", "background", "endpoint")]
+      sums.append(cobrems.window_sum(edges, linear, *windows["tagged"]))
+      sums.append(sums[3] / (sums[0] + 1e-99))
+      lines.append(" ".join(point_key((coldiam, Epeak, ytilt, emit))) + " " +
+                   " ".join("{0:.6g}".format(s) for s in sums) + "\n")
+   return "".join(lines)
+
+def run(grid, fixed, windows, filename, jobs):
+   """
+   Scan the rates over the grid, a dict of axis -> list of values, with
+   the other parameters in fixed, on a pool of jobs processes, appending
+   the results to filename. Returns the number of grid points computed.
+   """
+   settings = settings_line(fixed, windows)
+   done = read_done(filename, settings)
+   tasks = []
+   for Epeak in grid["Epeak"]:
+      for ytilt in grid["ytilt"]:
+         for emit in grid["emit"]:
+            coldiams = [d for d in grid["coldiam"]
+                        if point_key((d, Epeak, ytilt, emit)) not in done]
+            if coldiams:
+               tasks.append((coldiams, Epeak, ytilt, emit, fixed, windows))
+   with open(filename, "a") as output:
+      if output.tell() == 0:
+         output.write(settings + " ".join(columns) + "\n")
+         output.flush()
+      count = 0
+      with multiprocessing.Pool(jobs) as pool:
+         for lines in pool.imap_unordered(scan_group, tasks, len(grid["emit"])):
+            output.write(lines)
+            output.flush()
+            count += lines.count("\n")
+   return count
+
+def read_scan(filename):
+   """
+   Read the output table of a scan as a dict of column -> array.
+   """
+   with open(filename) as f:
+      rows = [line for line in f if not is_header(line)]
+   table = numpy.loadtxt(rows, ndmin=2).reshape(-1, len(columns))
+   return {column: table[:,n] for n, column in enumerate(columns)}
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="coherent bremsstrahlung rate scans")
+   parser.add_argument("-o", "--output", default="ratescan.dat",
+                       help="output table, appended to if it exists")
+   parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                       help="number of worker processes")
+   parser.add_argument("--coldiam", default="0.0003:0.0099:25",
+                       help="collimator diameters (m)")
+   parser.add_argument("--Epeak", default="9", help="coherent edge energies (GeV)")
+   parser.add_argument("--ytilt", default="0.25", help="radiator secondary tilts (rad)")
+   parser.add_argument("--emit", default="2.5e-9", help="beam emittances (m.rad)")
+   fixed_defaults = (("E0", 12., "electron beam energy (GeV)"),
+                     ("radt", 20e-6, "radiator thickness (m)"),
+                     ("dist", 76., "radiator-collimator distance (m)"),
+                     ("mos", 2e-5, "radiator mosaic spread (rad)"),
+                     ("epol", 0., "electron beam circular polarization"),
+                     ("cur", 2.2, "electron beam current (uA)"),
+                     ("nbins", 200, "number of bins in photon spectrum"),
+                     ("Emin", 0., "photon spectrum energy minimum (GeV)"),
+                     ("Emax", 12., "photon spectrum energy maximum (GeV)"))
+   for par, default, desc in fixed_defaults:
+      parser.add_argument("--" + par, type=type(default), default=default, help=desc)
+   for window in cobrems.default_windows:
+      parser.add_argument("--" + window, default="{0}:{1}".format(*cobrems.default_windows[window]),
+                          help="Elow:Ehigh of the " + window + " window (GeV)")
+   args = parser.parse_args()
+   grid = {axis: grid_values(getattr(args, axis)) for axis in axes}
+   fixed = {par: float(getattr(args, par)) for par, default, desc in fixed_defaults}
+   windows = {window: tuple(float(e) for e in getattr(args, window).split(":"))
+              for window in cobrems.default_windows}
+   try:
+      count = run(grid, fixed, windows, args.output, args.jobs)
+   except ValueError as err:
+      sys.stderr.write("ratescan: " + str(err) + "\n")
+      sys.exit(1)
+   sys.stderr.write("ratescan: computed {0} grid points\n".format(count))
@@ -0,0 +1,443 @@
+#!/usr/bin/python
+#
+# ratesurrogate.py - precomputed table of coherent bremsstrahlung rate
+#                    spectra for fast interactive answers from ratetool.py.
+#
+# usage: ratesurrogate.py [-j N] [-o DIR] [--photonEpeak GRID]
+#                         [--collimDiam GRID] [--beamEmittance GRID]
+#                         [other fixed ratetool parameters]
+#
+# The table holds the rate spectra computed with cobrems.py on a grid over
+# the ratetool form parameters that are most often changed, photonEpeak,
+# collimDiam and beamEmittance (each GRID is "a,b,c" or "start:stop:n"),
+# with the other parameters fixed at their form defaults or as given. The
+# current and the electron circular polarization only scale the spectra
+# and are applied when the table is read, and the window sums are computed
+# from the interpolated spectra, so they are free as well. The coherent and
+# incoherent parts are stored separately, per uA and for full electron
+# polarization, in a memory-mapped array work/ratesurrogate/spectra.npy,
+# with the grid, the fixed parameters and the format version in meta.json.
+#
+# Between grid points the spectra are interpolated linearly, except that
+# the coherent parts are first stretched in x/(1-x) to line up their
+# coherent edges with the edge interpolated to the requested photonEpeak,
+# so that the edge and its harmonics move with photonEpeak instead of
+# fading from one bin to the next. When the table is built, the
+# interpolation is checked against the full calculation at the centers of
+# the grid cells, and the largest relative errors found in the total rate
+# sums over the default ratetool windows, and in the peak polarization,
+# are recorded in meta.json as the stated accuracy of the table.
+#
+# A table is only used while cobrems.py is the same as when it was built.
+# Requests outside the grid, or with other fixed parameters, are computed
+# in full by the caller and may then be added to the table as extra exact
+# entries in work/ratesurrogate/extras.*, from which a repeat of the same
+# request is answered directly.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import argparse
+import multiprocessing
+
+# each worker does its own vectorized numpy work, so threading only gets in the way
+for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+   os.environ.setdefault(var, "1")
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cobrems
+
+table_version = 1
+basedir = os.path.dirname(os.path.abspath(__file__))
+default_path = basedir + "/work/ratesurrogate"
+max_extras = 10000
+uncollimated = 0.1
+tables = {}
+
+# ratetool form parameters interpolated in the table, with their default grids
+grid_axes = ("photonEpeak", "collimDiam", "beamEmittance")
+default_grid = {"photonEpeak": "7.0:10.5:36",
+                "collimDiam": "0.002:0.006:11",
+                "beamEmittance": "1e-9:1e-8:10"}
+
+# ratetool form parameters that are fixed in a table, with the form defaults
+fixed_defaults = {"beamEnergy": 12., "radSecondTilt": 250e-3,
+                  "radThickness": 20e-6, "collimDistance": 75.,
+                  "mosaicSpread": 20e-6, "photonNbins": 200,
+                  "photonEmin": 0., "photonEmax": 12.}
+
+# ratetool form parameters that identify an extra entry
+extra_parameters = grid_axes + tuple(sorted(fixed_defaults)) + ("beamCurrent",
+                                                                 "beamCircPolar")
+
+# parts of the stored spectra, coherent ones first
+parts = ("coherent_total", "coherent_linear", "coherent_circular",
+         "coherent_uncollimated", "incoherent_total", "incoherent_circular",
+         "incoherent_uncollimated")
+ncoherent = 4
+
+def cobrems_digest():
+   """
+   Hash of the cobrems.py source, to recognize tables made with another
+   version of the spectrum calculation.
+   """
+   with open(os.path.join(basedir, "cobrems.py"), "rb") as f:
+      return hashlib.sha1(f.read()).hexdigest()[:20]
+
+def grid_values(spec):
+   """
+   Values of one grid axis from its spec, either a comma separated list
+   "a,b,c" or "start:stop:n" for n values from start to stop.
+   """
+   if ":" in spec:
+      start, stop, n = spec.split(":")
+      return [float(v) for v in numpy.linspace(float(start), float(stop), int(n))]
+   return [float(v) for v in spec.split(",")]
+
+def energy_bins(fixed):
+   """
+   Photon energy bin edges (GeV) and bin centers x = k/E of a table.
+   """
+   edges = numpy.linspace(fixed["photonEmin"], fixed["photonEmax"],
+                          int(fixed["photonNbins"]) + 1)
+   return edges, (edges[:-1] + edges[1:]) / 2 / fixed["beamEnergy"]
+
+def compute_parts(task):
+   """
+   Smeared spectra of all parts, in rate per uA (/GeV/s/uA), at all the
+   collimator diameters of one (photonEpeak, beamEmittance) point of the
+   grid, in one pass, and the position x of the coherent edge there.
+    task = (Epeak, emit, coldiams, fixed)
+   Returns (spectra[ncoldiams, nparts, nbins], edge).
+   """
+   Epeak, emit, coldiams, fixed = task
+   cobrems.max_acceptances = max(cobrems.max_acceptances, len(coldiams) + 4)
+   E0 = fixed["beamEnergy"]
+   setup = cobrems.Setup(E0, Epeak, fixed["radSecondTilt"], emit,
+                         fixed["radThickness"], fixed["collimDistance"],
+                         coldiams[0], 0, 1., fixed["mosaicSpread"])
+   x = energy_bins(fixed)[1]
+   nd = len(coldiams)
+   coh = setup.coherent(x, [(polar, d) for d in coldiams for polar in (0, 1, 2)] +
+                           [(0, uncollimated)])
+   inc = setup.incoherent(x, [(polar, d) for d in coldiams for polar in (0, 2)] +
+                             [(0, uncollimated)])
+   smeared = setup.convol(x, numpy.concatenate((coh, inc)) / 1.6e-13 / E0)
+   coh, inc = smeared[:3 * nd + 1], smeared[3 * nd + 1:]
+   spectra = numpy.empty((nd, len(parts), len(x)))
+   spectra[:,0:3] = coh[:3 * nd].reshape(nd, 3, -1)
+   spectra[:,3] = coh[-1]
+   spectra[:,4:6] = inc[:2 * nd].reshape(nd, 2, -1)
+   spectra[:,6] = inc[-1]
+   return spectra, setup.coherent_edge(x, coh[-1])
+
+def morph(x, spectrum, edge_from, edge_to):
+   """
+   Spectra spectrum[..., n] at x[n] with their coherent edge at edge_from
+   moved to edge_to, by stretching u = x/(1-x) by the ratio of the edges in
+   u, which also moves the edges of the higher harmonics at multiples of
+   the edge in u. Each interval between harmonic edges is interpolated
+   on its own, so that the edges stay as sharp as in the original.
+   """
+   ufrom = edge_from / (1 - edge_from)
+   u = x / (1 - x) * ufrom / (edge_to / (1 - edge_to))
+   xt = u / (1 + u)
+   n = numpy.arange(1, int(x[-1] / (1 - x[-1]) / ufrom) + 2)
+   harmonics = n * ufrom / (1 + n * ufrom)
+   source = numpy.searchsorted(harmonics, x)
+   target = numpy.searchsorted(harmonics, xt)
+   result = numpy.empty(spectrum.shape)
+   for index in numpy.ndindex(spectrum.shape[:-1]):
+      s = spectrum[index]
+      result[index] = numpy.interp(xt, x, s)
+      for seg in numpy.unique(target):
+         src = source == seg
+         if numpy.any(src):
+            tgt = target == seg
+            result[index][tgt] = numpy.interp(xt[tgt], x[src], s[src])
+   return result
+
+def combine(spectra, values):
+   """
+   The four ratetool rate spectra (/GeV/s) from the parts spectra[nparts,
+   nbins], for the current and electron polarization in values.
+   """
+   cur = values["beamCurrent"]
+   epol = values["beamCircPolar"]
+   return {"uncollimated": (spectra[3] + spectra[6]) * cur,
+           "linear": spectra[1] * cur,
+           "circular": (spectra[2] + spectra[5]) * cur * epol,
+           "total": (spectra[0] + spectra[4]) * cur}
+
+def cell(axis, value):
+   """
+   Index i of the grid cell [axis[i], axis[i+1]] holding value, and the
+   fraction of the way through it.
+   """
+   i = int(numpy.clip(numpy.searchsorted(axis, value, "right") - 1, 0, len(axis) - 2))
+   return i, (value - axis[i]) / (axis[i + 1] - axis[i])
+
+class Table:
+   """
+   A rate table opened from its directory, with the spectra memory-mapped
+   so that only the grid points needed for a request are read.
+   """
+   def __init__(self, path):
+      self.path = path
+      with open(os.path.join(path, "meta.json")) as f:
+         self.meta = json.load(f)
+      self.fixed = self.meta["fixed"]
+      self.axes = [numpy.array(self.meta["axes"][axis]) for axis in grid_axes]
+      self.accuracy = self.meta.get("accuracy", {})
+      self.spectra = numpy.load(os.path.join(path, "spectra.npy"), mmap_mode="r")
+      self.edges = numpy.load(os.path.join(path, "edges.npy"))
+      self.ebins, self.x = energy_bins(self.fixed)
+      self.extras = {}
+      self.extras_size = 0
+
+   def current(self):
+      """
+      True if the table was made by this version of the format and of
+      cobrems.py.
+      """
+      return (self.meta.get("version") == table_version and
+              self.meta.get("cobrems") == cobrems_digest())
+
+   def covers(self, values):
+      """
+      True if the fixed parameters in values are those of the table and
+      the grid parameters are within the grid.
+      """
+      for par in self.fixed:
+         if abs(values[par] - self.fixed[par]) > 1e-9 * max(abs(self.fixed[par]), 1e-30):
+            return False
+      for axis, par in zip(self.axes, grid_axes):
+         if not axis[0] <= values[par] <= axis[-1]:
+            return False
+      return True
+
+   def interpolate(self, values):
+      """
+      The four rate spectra (/GeV/s) for the ratetool form values, which
+      must be covered by the table.
+      """
+      (i, ti), (j, tj), (k, tk) = [cell(axis, values[par])
+                                   for axis, par in zip(self.axes, grid_axes)]
+      block = numpy.array(self.spectra[i:i+2, j:j+2, k:k+2])
+      edge = (1 - ti) * self.edges[i,k:k+2] + ti * self.edges[i+1,k:k+2]
+      for a in range(2):
+         for c in range(2):
+            block[a,:,c,:ncoherent] = morph(self.x, block[a,:,c,:ncoherent],
+                                            self.edges[i+a,k+c], edge[c])
+      weights = numpy.einsum("a,b,c->abc", [1 - ti, ti], [1 - tj, tj], [1 - tk, tk])
+      return combine(numpy.einsum("abc,abcpn->pn", weights, block), values)
+
+   def read_extras(self):
+      """
+      Update the index of the extra entries from extras.jsonl.
+      """
+      index = os.path.join(self.path, "extras.jsonl")
+      if not os.path.exists(index) or os.path.getsize(index) == self.extras_size:
+         return
+      with open(index) as f:
+         lines = f.readlines()
+      self.extras_size = sum(len(line) for line in lines)
+      for line in lines:
+         if line.endswith("\n"):
+            entry = json.loads(line)
+            self.extras[tuple(entry["key"])] = (entry["offset"], entry["nbins"])
+
+   def lookup_extra(self, values):
+      """
+      The four rate spectra of an extra entry for exactly these values,
+      and its bin edges, or None if there is none.
+      """
+      self.read_extras()
+      key = extra_key(values)
+      if key not in self.extras:
+         return None
+      offset, nbins = self.extras[key]
+      data = numpy.memmap(os.path.join(self.path, "extras.bin"), dtype=numpy.float64,
+                          mode="r", offset=offset, shape=(4, nbins))
+      edges = numpy.linspace(values["photonEmin"], values["photonEmax"], nbins + 1)
+      return dict(zip(("uncollimated", "linear", "circular", "total"),
+                      numpy.array(data))), edges
+
+   def add_extra(self, values, result):
+      """
+      Append the rate spectra of a full calculation for values to the
+      extra entries, unless there are max_extras of them already.
+      """
+      self.read_extras()
+      key = extra_key(values)
+      if key in self.extras or len(self.extras) >= max_extras:
+         return
+      data = numpy.array([result["rate"][name] for name in
+                          ("uncollimated", "linear", "circular", "total")],
+                         dtype=numpy.float64)
+      with open(os.path.join(self.path, "extras.jsonl"), "a") as index:
+         fcntl.flock(index, fcntl.LOCK_EX)
+         with open(os.path.join(self.path, "extras.bin"), "ab") as f:
+            offset = f.tell()
+            f.write(data.tobytes())
+         index.write(json.dumps({"key": list(key), "offset": offset,
+                                 "nbins": data.shape[1]}) + "\n")
+
+def extra_key(values):
+   return tuple("{0:.9g}".format(float(values[par])) for par in extra_parameters)
+
+def load(path=None):
+   """
+   Return the Table in directory path (default work/ratesurrogate), opening
+   it only the first time or when it has been rebuilt since, or None if
+   there is no table there or it is out of date.
+   """
+   path = path or default_path
+   meta = os.path.join(path, "meta.json")
+   if not os.path.exists(meta):
+      return None
+   mtime = os.stat(meta).st_mtime
+   if path not in tables or tables[path][0] != mtime:
+      table = Table(path)
+      tables[path] = (mtime, table if table.current() else None)
+   return tables[path][1]
+
+def rates(values, windows=None, path=None):
+   """
+   Rates result as from cobrems.rates for the ratetool form values, from
+   an extra entry or interpolated in the table at path, or None if the
+   table cannot answer. The result has "accuracy" set to the stated
+   accuracy of the table for interpolated answers, and {} for exact ones.
+    values = dict of ratetool form parameter -> value
+    windows = dict of name -> (Elow, Ehigh) for the sums
+   """
+   table = load(path)
+   if table is None:
+      return None
+   extra = table.lookup_extra(values)
+   if extra is not None:
+      result = cobrems.rate_summary(extra[1], extra[0], windows)
+      result["accuracy"] = {}
+      return result
+   if not table.covers(values):
+      return None
+   result = cobrems.rate_summary(table.ebins, table.interpolate(values), windows)
+   result["accuracy"] = table.accuracy
+   return result
+
+def add(values, result, path=None):
+   """
+   Add the result of a full calculation for the ratetool form values to
+   the extra entries of the table at path, if there is a current one.
+   """
+   table = load(path)
+   if table is not None:
+      table.add_extra(values, result)
+
+def validate(table, jobs):
+   """
+   Largest relative errors of the window sums of the total rate for the
+   default windows, and the largest absolute error of the peak
+   polarization, between the table
+   and the full calculation at the centers of the grid cells: all cells
+   along photonEpeak, at the central cell and the first and last cells of
+   the other axes.
+   """
+   axes = table.axes
+   centers = [(axis[:-1] + axis[1:]) / 2 for axis in axes]
+   others = sorted({(j, k) for j in (0, len(centers[1]) // 2, len(centers[1]) - 1)
+                           for k in (0, len(centers[2]) // 2, len(centers[2]) - 1)})
+   tasks = [(Epeak, centers[2][k], [centers[1][j]], table.fixed)
+            for Epeak in centers[0] for j, k in others]
+   values = {"beamCurrent": 1., "beamCircPolar": 1.}
+   values.update(table.fixed)
+   errors = {}
+   with multiprocessing.Pool(jobs) as pool:
+      for task, (spectra, _) in zip(tasks, pool.imap(compute_parts, tasks)):
+         values.update(zip(grid_axes, (task[0], task[2][0], task[1])))
+         exact = cobrems.rate_summary(table.ebins, combine(spectra[0], values))
+         approx = cobrems.rate_summary(table.ebins, table.interpolate(values))
+         for window in exact["sums"]["total"]:
+            err = abs(approx["sums"]["total"][window] /
+                      (exact["sums"]["total"][window] + 1e-99) - 1)
+            errors[window] = max(errors.get(window, 0), err)
+         err = abs(approx["peak_polarization"] - exact["peak_polarization"])
+         errors["peak_polarization"] = max(errors.get("peak_polarization", 0), err)
+   return errors
+
+def build(grid, fixed, path=None, jobs=None):
+   """
+   Compute a new table for the grid, a dict of grid axis -> list of values,
+   and the fixed parameters, on a pool of jobs processes, validate it and
+   put it in place of the table at path. Returns the new Table.
+   """
+   path = path or default_path
+   if fixed["photonEmax"] > fixed["beamEnergy"]:
+      raise ValueError("photon spectrum must end below the beam energy")
+   axes = [sorted(grid[axis]) for axis in grid_axes]
+   if min(len(axis) for axis in axes) < 2:
+      raise ValueError("each grid axis needs at least 2 values")
+   newpath = path + ".new"
+   shutil.rmtree(newpath, ignore_errors=True)
+   os.makedirs(newpath)
+   nbins = int(fixed["photonNbins"])
+   spectra = numpy.lib.format.open_memmap(os.path.join(newpath, "spectra.npy"), "w+",
+                                          numpy.float32, (len(axes[0]), len(axes[1]),
+                                          len(axes[2]), len(parts), nbins))
+   edges = numpy.zeros((len(axes[0]), len(axes[2])))
+   tasks = [(Epeak, emit, axes[1], fixed) for Epeak in axes[0] for emit in axes[2]]
+   with multiprocessing.Pool(jobs) as pool:
+      for n, (block, edge) in enumerate(pool.imap(compute_parts, tasks, len(axes[2]))):
+         i, k = divmod(n, len(axes[2]))
+         spectra[i,:,k] = block
+         edges[i,k] = edge
+   spectra.flush()
+   del spectra
+   numpy.save(os.path.join(newpath, "edges.npy"), edges)
+   meta = {"version": table_version, "cobrems": cobrems_digest(),
+           "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+           "axes": dict(zip(grid_axes, axes)), "fixed": fixed}
+   with open(os.path.join(newpath, "meta.json"), "w") as f:
+      json.dump(meta, f, indent=1)
+   meta["accuracy"] = validate(Table(newpath), jobs)
+   with open(os.path.join(newpath, "meta.json"), "w") as f:
+      json.dump(meta, f, indent=1)
+   if os.path.exists(path):
+      shutil.rmtree(path + ".old", ignore_errors=True)
+      os.rename(path, path + ".old")
+   os.rename(newpath, path)
+   shutil.rmtree(path + ".old", ignore_errors=True)
+   return load(path)
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="build the ratetool rate table")
+   parser.add_argument("-o", "--output", default=default_path,
+                       help="table directory (default work/ratesurrogate)")
+   parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                       help="number of worker processes")
+   for axis in grid_axes:
+      parser.add_argument("--" + axis, default=default_grid[axis],
+                          help="grid of " + axis + " values")
+   for par in sorted(fixed_defaults):
+      parser.add_argument("--" + par, type=type(fixed_defaults[par]),
+                          default=fixed_defaults[par], help="fixed value of " + par)
+   args = parser.parse_args()
+   grid = {axis: grid_values(getattr(args, axis)) for axis in grid_axes}
+   fixed = {par: getattr(args, par) for par in fixed_defaults}
+   try:
+      table = build(grid, fixed, args.output, args.jobs)
+   except ValueError as err:
+      sys.stderr.write("ratesurrogate: " + str(err) + "\n")
+      sys.exit(1)
+   for key in sorted(table.accuracy):
+      sys.stderr.write("ratesurrogate: largest {0} error {1:.4f}\n"
+                       .format(key, table.accuracy[key]))
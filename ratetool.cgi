@@ -5,6 +5,8 @@
 #
 
 use CGI;
+use File::Basename;
+use Time::HiRes qw(time);
 
 our $q = new CGI;
 
@@ -154,11 +156,14 @@ if (defined $q->param('run')) {
       "close 25\n",
       "exit\n";
    close(OUT);
-   $shcmd = ". /etc/profile.d/cern.sh;" .
-            "cd work; " .
-            "DISPLAY=:99.0 pawX11 -w 1 < $datafile;" .
-            "h2root cobrems_$$.hbook";
-   open(OUT,"$shcmd |") || die;
+   $pawcmd = ". /etc/profile.d/cern.sh;" .
+             "cd work; " .
+             "DISPLAY=:99.0 pawX11 -w 1 < $datafile";
+   $h2rootcmd = ". /etc/profile.d/cern.sh;" .
+                "cd work; " .
+                "h2root cobrems_$$.hbook";
+   $t0 = time;
+   open(OUT,"$pawcmd |") || die;
    @polar_sums = ();
    @outlog = ();
    while (<OUT>) {
@@ -177,9 +182,23 @@ if (defined $q->param('run')) {
       $beam_power =~ s/beam power/beam power/;
    }
    close(OUT);
-   open(LOG,">/tmp/ratetool.log") || die;
+   $t1 = time;
+   open(OUT,"$h2rootcmd |") || die;
+   push(@outlog,<OUT>);
+   close(OUT);
+   $t2 = time;
+   # written aside and renamed, so work/ratetool.log is always the
+   # complete log of the latest run, even with runs at the same time
+   open(LOG,">work/ratetool_$$.log") || die;
    print LOG @outlog;
    close(LOG);
+   rename("work/ratetool_$$.log", "work/ratetool.log") || die;
+   @timings = (sprintf("paw=%.6f", $t1 - $t0), sprintf("h2root=%.6f", $t2 - $t1));
+   # toolmetrics.py sits next to this script, run by the same python
+   # as the other tool gateways, whatever the cwd of the web server
+   my $status = system("python", dirname($0) . "/toolmetrics.py",
+                       "--record", "ratetool_paw", @timings);
+   warn "ratetool.cgi: toolmetrics.py --record failed with status $?\n" if ($status != 0);
 }
 
 print $q->header(),
@@ -283,6 +302,12 @@ print "</table>\n",
          "ROOT file containing the above histograms</a>",
          "</td></tr>";
       }
+      if ($q->param('debug') and (@timings)) {
+         print
+         "<tr><td align=\"center\" colspan=\"2\">\n",
+         join("<br>\n", @timings),
+         "</td></tr>";
+      }
       print
       "</table>\n",
       $q->end_form;
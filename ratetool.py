@@ -0,0 +1,692 @@
+#!/usr/bin/python
+#
+# ratetool.py - cgi script for running the Hall D coherent bremsstrahlung
+#               rates calculator, a python version of the paw tool in
+#               ratetool.cgi written by R.T.Jones.
+#
+# The spectra are computed in-process, without the Xvnc session, paw
+# macros and hbook conversion of ratetool.cgi. If a rate table has been
+# built with ratesurrogate.py, the spectra are interpolated in it, and
+# requests outside of the table are computed in full and added to it.
+# Otherwise the routines of work/cobrems.f are called directly from a
+# shared library that is compiled from it once, the first time it is
+# needed or whenever the fortran source changes, and is reused by every
+# request after that. The paw vectors hisx, hisy of convol are mapped
+# onto a common block for this, and the CERNLIB function EXPINT is
+# supplied by a small fortran routine if CERNLIB is not installed.
+# Without a fortran compiler, or with engine=numpy in the form, the numpy
+# version in cobrems.py is used instead. The histograms are saved in
+# work/cobrems_<name>.npz, and also in work/cobrems_<name>.root if ROOT
+# is available.
+#
+# Answers from the rate table are given at once. Any other calculation is
+# submitted to the job queue of ratequeue.py, and the page that is
+# returned shows the job id and reloads itself with job=<id> until the
+# job is finished and its results can be shown, so that the web server
+# is not held up while the spectra are computed.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import time
+import_start = time.perf_counter()
+
+import sys
+sys.path.insert(0, "/usr/local/root/lib/root")
+
+import numpy
+import cobrems
+import harpplot
+import ratequeue
+import ratesurrogate
+import toolmetrics
+root_start = time.perf_counter()
+try:
+   import ROOT
+   ROOT.gROOT.IsBatch()
+except ImportError:
+   ROOT = None
+root_end = time.perf_counter()
+
+import os
+import re
+import cgi
+import json
+import html
+import fcntl
+import ctypes
+import shutil
+import subprocess
+import urllib.parse
+import cgitb
+cgitb.enable()
+toolmetrics.startup("ratetool", [("imports", root_start - import_start),
+                                 ("ROOT import", root_end - root_start)],
+                    import_start, script=(__name__ == "__main__"))
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+fortran_source = basedir + "/work/cobrems.f"
+fortran_include = basedir + "/work/cobrems.inc"
+fortran_library_file = basedir + "/work/libcobrems.so"
+fortran_maxbins = 10000
+fortran_loaded = {}
+surrogate_add = True
+use_queue = True
+refresh_seconds = 2
+metrics = toolmetrics.Timer("ratetool", enabled=False)
+
+# replacement for the CERNLIB function EXPINT (exponential integral E1)
+expint_source = """
+      real function expint(x)
+      real x
+      double precision xx,s,t,b,c,d,h,an
+      integer k
+      xx=x
+      if (xx.le.1d0) then
+        s=0
+        t=1
+        do k=1,60
+          t=-t*xx/k
+          s=s-t/k
+        enddo
+        expint=real(-0.5772156649015329d0-log(xx)+s)
+      else
+        b=xx+1
+        c=1d300
+        d=1/b
+        h=d
+        do k=1,200
+          an=-k*k
+          b=b+2
+          d=1/(an*d+b)
+          c=b+an/c
+          h=h*c*d
+        enddo
+        expint=real(h*exp(-xx))
+      endif
+      end
+"""
+
+# form parameter, description, default, unit, in the order of ratetool.cgi
+beam_parameters = (
+   ("beamEnergy", "Electron beam energy", 12., "GeV"),
+   ("beamCurrent", "Electron beam current", 2.2, "&#956;A"),
+   ("beamEmittance", "Electron beam emmitance", 2.5e-9, "m"),
+   ("beamCircPolar", "Electron beam circular polarization", 0, ""),
+   ("radThickness", "Radiator thickness", 20e-6, "m"),
+   ("mosaicSpread", "Radiator mosaic spread", 20e-6, "rad"),
+   ("radSecondTilt", "Radiator secondary tilt", 250e-3, "rad"),
+   ("photonEpeak", "Photon spectrum peak energy", 9., "GeV"),
+   ("photonNbins", "Number of bins in photon spectrum", 200, ""),
+   ("photonEmax", "Photon spectrum energy maximum", 12., "GeV"),
+   ("photonEmin", "Photon spectrum energy minimum", 0., "GeV"),
+   ("collimDistance", "Radiator-collimator distance", 75., "m"),
+   ("collimDiam", "Collimator diameter", 3.4e-3, "m"),
+)
+window_parameters = (
+   ("peakElow", "Low edge of primary peak window", 8.4, "GeV"),
+   ("peakEhigh", "High edge of primary peak window", 9.0, "GeV"),
+   ("backElow", "Low edge of background window", 0.1, "GeV"),
+   ("backEhigh", "High edge of background window", 3.0, "GeV"),
+   ("endpElow", "Low edge of endpoint tagging window", 10.7, "GeV"),
+   ("endpEhigh", "High edge of endpoint tagging window", 11.7, "GeV"),
+)
+
+# plots shown on the page, in the order of ratetool.cgi
+figures = (
+   ("rate", "collimated beam rate (/GeV/s)"),
+   ("linear_polarization", "linear polarization"),
+   ("tagging_efficiency", "tagging efficiency"),
+   ("circular_polarization", "circular polarization"),
+)
+
+def print_head(refresh=None):
+   print("Content-Type: text/html")
+   print()
+   print("<html>")
+   print("<head>")
+   print("<title>Hall D Coherent Bremsstrahlung Rate Calculator</title>")
+   if refresh is not None:
+      print("<meta http-equiv=\"refresh\" content=\"{0}; url={1}\">"
+            .format(refresh_seconds, html.escape(refresh)))
+   print("</head>")
+   print("<body>")
+   print("<form action=\"ratetool_py.cgi\" method=\"get\" enctype=\"application/x-www-form-urlencoded\">")
+   print("<p align=\"center\">")
+   print("<table>")
+   print("<tr><td colspan=\"2\">")
+   print("<h2 align=\"center\">Hall D Coherent Bremsstrahlung Rate Calculator</h2>")
+   print("<p align=\"center\">Richard Jones, University of Connecticut<br>")
+   print("August 12, 2012</p>")
+   print("</td></tr>")
+   print("<tr><td align=\"center\" colspan=\"2\">")
+   print("<input type=\"submit\" name=\"submit\" value=\"update\" />")
+   print("</td></tr>")
+
+def print_tail():
+   print("</table>")
+   print("</form>")
+   print("</body>")
+   print("</html>")
+
+def get_parameter(par, default):
+   if par in form and str("default " + par) not in form:
+      return form.getfirst(par)
+   return default
+
+def set_parameter(par, desc, default, unit):
+   value = html.escape(str(get_parameter(par, default)))
+   print("<tr><td>" + desc)
+   print("<input type=\"text\" name=\"" + par + "\" value=\"" + value + "\" size=\"5\" />" + unit)
+   print("<input type=\"submit\" name=\"default " + par + "\" value=\"default\"></td></tr>")
+
+def read_parameters():
+   """
+   Return the form parameters of beam_parameters and window_parameters
+   as a dict of floats, with the defaults for those not given. Raises
+   ValueError for values that are not numbers.
+   """
+   values = {}
+   for par, desc, default, unit in beam_parameters + window_parameters:
+      values[par] = float(get_parameter(par, default))
+   values["photonNbins"] = int(values["photonNbins"])
+   if values["photonNbins"] < 1 or values["photonEmax"] <= values["photonEmin"]:
+      raise ValueError("empty photon spectrum")
+   return values
+
+def engines():
+   """
+   Spectrum calculations that are available, as a list of (engine,
+   description): "table" for interpolation in the rate table of
+   ratesurrogate.py, "fortran" for the routines of cobrems.f and "numpy"
+   for those of cobrems.py.
+   """
+   available = []
+   if ratesurrogate.load() is not None:
+      available.append(("table", "rate table"))
+   if fortran_library() is not None:
+      available.append(("fortran", "cobrems.f"))
+   available.append(("numpy", "cobrems.py"))
+   return available
+
+def engine_choice():
+   """
+   Spectrum calculation selected in the form, by default the first one
+   in engines().
+   """
+   available = [engine for engine, desc in engines()]
+   if form.getfirst("engine") in available:
+      return form.getfirst("engine")
+   return available[0]
+
+def print_engine_options():
+   engine = engine_choice()
+   print("spectrum from <select name=\"engine\">")
+   for value, desc in engines():
+      selected = " selected" if value == engine else ""
+      print("<option value=\"" + value + "\"" + selected + ">" + desc + "</option>")
+   print("</select>")
+
+def fortran_library_current():
+   """
+   True if the shared library exists and is newer than the fortran source.
+   """
+   if not os.path.exists(fortran_library_file):
+      return False
+   mtime = os.path.getmtime(fortran_library_file)
+   return (mtime >= os.path.getmtime(fortran_source) and
+           mtime >= os.path.getmtime(fortran_include))
+
+def build_fortran_library():
+   """
+   Compile work/cobrems.f into the shared library fortran_library_file,
+   with the paw vectors hisx, hisy of convol moved into the common block
+   /hisvec/ and the other vectors made ordinary arrays. The library is
+   built under a lock and moved into place when it is complete, so that
+   concurrent requests never load a partial one.
+   """
+   with open(fortran_library_file + ".lock", "w") as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      if fortran_library_current():
+         return
+      with open(fortran_source) as f:
+         source = f.read()
+      source = re.sub(r"(?im)^(\s+)vector\s+hisx\(10000\),hisy\(10000\),",
+                      r"\1common /hisvec/hisx(10000),hisy(10000)\n\1real hisx,hisy,",
+                      source)
+      source = re.sub(r"(?im)^(\s+)vector\s", r"\1real ", source)
+      tmpfile = fortran_library_file + "." + str(os.getpid())
+      sources = [tmpfile + ".f"]
+      with open(sources[0], "w") as f:
+         f.write(source)
+      libs = []
+      if shutil.which("cernlib"):
+         libs = subprocess.run(["cernlib", "mathlib"], stdout=subprocess.PIPE,
+                               universal_newlines=True).stdout.split()
+      if not libs:
+         sources.append(tmpfile + "_expint.f")
+         with open(sources[1], "w") as f:
+            f.write(expint_source)
+      try:
+         subprocess.run(["gfortran", "-O2", "-fPIC", "-shared", "-std=legacy",
+                         "-I", os.path.dirname(fortran_include), "-o", tmpfile] + sources + libs,
+                        check=True, stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+         os.replace(tmpfile, fortran_library_file)
+      finally:
+         for name in sources + [tmpfile]:
+            if os.path.exists(name):
+               os.remove(name)
+
+def fortran_library():
+   """
+   Return the cobrems.f routines as a ctypes library, building it first
+   if needed, or None if it cannot be built or loaded.
+   """
+   if "lib" in fortran_loaded:
+      return fortran_loaded["lib"]
+   fortran_loaded["lib"] = None
+   if not os.path.exists(fortran_source):
+      return None
+   try:
+      if not fortran_library_current():
+         if shutil.which("gfortran") is None:
+            return None
+         build_fortran_library()
+      # so that fortran writes to unit 6 reach the log before it is closed
+      os.environ["GFORTRAN_UNBUFFERED_PRECONNECTED"] = "y"
+      lib = ctypes.CDLL(fortran_library_file)
+   except (OSError, subprocess.CalledProcessError):
+      return None
+   real = ctypes.POINTER(ctypes.c_float)
+   lib.cobrems_.argtypes = [real] * 7 + [ctypes.POINTER(ctypes.c_int)] + [real] * 2
+   lib.cobrems_.restype = None
+   for func in (lib.dncdx_, lib.dnidx_, lib.dntdx_):
+      func.argtypes = [real]
+      func.restype = ctypes.c_float
+   lib.convol_.argtypes = [ctypes.POINTER(ctypes.c_int)]
+   lib.convol_.restype = None
+   lib.hisx = (ctypes.c_float * fortran_maxbins).in_dll(lib, "hisvec_")
+   lib.hisy = (ctypes.c_float * fortran_maxbins).from_address(
+              ctypes.addressof(lib.hisx) + ctypes.sizeof(lib.hisx))
+   fortran_loaded["lib"] = lib
+   return lib
+
+def fortran_spectrum(lib, x, args, polar, func):
+   """
+   One cobrems macro run with the fortran routines: set up cobrems with
+   args and polarization polar, evaluate func at the bin centers x and
+   smear the result with convol, returning the smeared spectrum dN/dx.
+    args = (E0, Epeak, ytilt, emit, radt, dist, coldiam, epol, mos)
+   """
+   f = [ctypes.c_float(arg) for arg in args]
+   lib.cobrems_(*f[:7], ctypes.c_int(polar), *f[7:])
+   nbins = len(x)
+   for i in range(nbins):
+      lib.hisx[i] = x[i]
+      lib.hisy[i] = func(ctypes.c_float(x[i]))
+   lib.convol_(ctypes.c_int(nbins))
+   return numpy.array(lib.hisy[:nbins], dtype=float)
+
+def fortran_rates(E0=12., Epeak=9., ytilt=250e-3, emit=2.5e-9, radt=20e-6,
+                  dist=76., coldiam=3.4e-3, epol=0., mos=2e-5, nbins=200,
+                  Emin=0., Emax=12., cur=2.2, windows=None, uncollimated=0.1,
+                  log=None):
+   """
+   Same as cobrems.rates, computed with the routines of cobrems.f run
+   as in the four cobrems macro runs of ratetool.cgi. The output that
+   the fortran writes to stdout is sent to the file log (default
+   /dev/null) instead.
+   """
+   lib = fortran_library()
+   if nbins > fortran_maxbins:
+      raise ValueError("at most {0} bins for cobrems.f".format(fortran_maxbins))
+   if Epeak >= E0:
+      raise ValueError("coherent edge must be below the beam energy")
+   edges = numpy.linspace(Emin, Emax, nbins + 1)
+   x = (edges[:-1] + edges[1:]) / 2 / E0
+   runs = (("uncollimated", uncollimated, 0, lib.dntdx_),
+           ("linear", coldiam, 1, lib.dncdx_),
+           ("circular", coldiam, 2, lib.dntdx_),
+           ("total", coldiam, 0, lib.dntdx_))
+   rate = {}
+   sys.stdout.flush()
+   stdout = os.dup(1)
+   with open(log or os.devnull, "a") as logfile:
+      os.dup2(logfile.fileno(), 1)
+      try:
+         for name, diam, polar, func in runs:
+            args = (E0, Epeak, ytilt, emit, radt, dist, diam, epol, mos)
+            with metrics.phase("cobrems.f " + name):
+               rate[name] = fortran_spectrum(lib, x, args, polar, func) * cur / 1.6e-13 / E0
+      finally:
+         os.dup2(stdout, 1)
+         os.close(stdout)
+   return cobrems.rate_summary(edges, rate, windows)
+
+def form_windows(values):
+   """
+   The tagging windows of the form parameters in values, as a dict of
+   name -> (Elow, Ehigh) for cobrems.rates.
+   """
+   return {"tagged": (values["peakElow"], values["peakEhigh"]),
+           "background": (values["backElow"], values["backEhigh"]),
+           "endpoint": (values["endpElow"], values["endpEhigh"])}
+
+def table_rates(values):
+   """
+   Rates for the form parameters in values from the rate table, or None
+   if the table cannot answer them.
+   """
+   result = ratesurrogate.rates(values, form_windows(values))
+   if result is not None:
+      result["engine"] = "table"
+   return result
+
+def compute_rates(values, engine, log=None):
+   """
+   Rates for the form parameters in values, with the given engine, with
+   the engine that was actually used in result["engine"]. Requests that
+   the rate table cannot answer are computed in full instead, with
+   cobrems.f if it is available, and added to the table if surrogate_add
+   is set.
+   """
+   windows = form_windows(values)
+   if engine == "table":
+      with metrics.phase("rate table"):
+         result = table_rates(values)
+      if result is not None:
+         return result
+      engine = "fortran" if fortran_library() is not None else "numpy"
+   args = dict(E0=values["beamEnergy"], Epeak=values["photonEpeak"],
+               ytilt=values["radSecondTilt"], emit=values["beamEmittance"],
+               radt=values["radThickness"], dist=values["collimDistance"],
+               coldiam=values["collimDiam"], epol=values["beamCircPolar"],
+               mos=values["mosaicSpread"], nbins=values["photonNbins"],
+               Emin=values["photonEmin"], Emax=values["photonEmax"],
+               cur=values["beamCurrent"], windows=windows)
+   if engine == "fortran" and values["photonNbins"] <= fortran_maxbins:
+      result = fortran_rates(log=log, **args)
+   else:
+      engine = "numpy"
+      with metrics.phase("cobrems.py rates"):
+         result = cobrems.rates(**args)
+   if surrogate_add:
+      ratesurrogate.add(values, result)
+   result["engine"] = engine
+   return result
+
+def histograms(result):
+   """
+   The histograms of a rates result as a dict of name -> array, all with
+   the bin edges in "edges".
+   """
+   hists = {"edges": result["edges"]}
+   for name in result["rate"]:
+      hists["rate_" + name] = result["rate"][name]
+   for name in ("linear_polarization", "circular_polarization",
+                "tagging_efficiency"):
+      hists[name] = result[name]
+   return hists
+
+def save_histograms(result, basename):
+   """
+   Write the histograms of a rates result to basename.npz, and as TH1D
+   histograms to basename.root if ROOT is available. Returns the list
+   of files written.
+   """
+   hists = histograms(result)
+   numpy.savez(basename + ".npz", **hists)
+   files = [basename + ".npz"]
+   if ROOT is not None:
+      edges = hists.pop("edges")
+      rootfile = ROOT.TFile(basename + ".root", "recreate")
+      for name in hists:
+         h = ROOT.TH1D(name, name.replace("_", " "), len(edges) - 1,
+                       edges[0], edges[-1])
+         for i, y in enumerate(hists[name]):
+            h.SetBinContent(i + 1, y)
+         h.Write()
+      rootfile.Close()
+      files.append(basename + ".root")
+   return files
+
+def results_json(values, result, files=()):
+   """
+   Structured summary of a rates result, with the window sums of each
+   spectrum, the peak polarization and the histograms.
+   """
+   doc = {"engine": result["engine"], "parameters": values,
+          "sums": result["sums"], "peak_polarization": result.get("peak_polarization")}
+   if "accuracy" in result:
+      doc["accuracy"] = result["accuracy"]
+   doc.update({name: [float(y) for y in h]
+               for name, h in histograms(result).items()})
+   doc["files"] = [os.path.basename(name) for name in files]
+   return doc
+
+def result_from_json(doc):
+   """
+   Rates result, as needed for the page and plots, from the results_json
+   document of a queued job.
+   """
+   edges = numpy.array(doc["edges"])
+   result = {"edges": edges, "energy": (edges[:-1] + edges[1:]) / 2,
+             "rate": {name[5:]: numpy.array(doc[name]) for name in doc
+                      if name.startswith("rate_")},
+             "sums": doc["sums"], "peak_polarization": doc["peak_polarization"],
+             "engine": doc["engine"]}
+   for name in ("linear_polarization", "circular_polarization",
+                "tagging_efficiency"):
+      result[name] = numpy.array(doc[name])
+   if "accuracy" in doc:
+      result["accuracy"] = doc["accuracy"]
+   return result
+
+def job_json(job):
+   """
+   Status of a queued job as a json document, with its results once it
+   is done.
+   """
+   record = ratequeue.status(job)
+   if record is None:
+      return {"job": job, "error": "unknown job"}
+   doc = {"job": job, "state": record["state"], "position": record["position"]}
+   if record["state"] == "done":
+      doc["result"] = ratequeue.read_result(job)
+   elif record["state"] == "failed":
+      doc["error"] = record["error"]
+   return doc
+
+def print_json():
+   """
+   Answer a request made with format=json by printing the results as a
+   json document, in place of the html page and plots. With job=<id> the
+   document is the status of that queued job. Otherwise the results are
+   answered at once from the rate table if it can, as on the page, or
+   else the calculation is queued and the document holds the id and state
+   of its job; with sync=1 the results are computed before answering.
+   """
+   try:
+      if "job" in form:
+         doc = job_json(form.getfirst("job"))
+      else:
+         values = read_parameters()
+         engine = engine_choice()
+         result = None
+         if not use_queue or form.getfirst("sync"):
+            result = compute_rates(values, engine,
+                                   log=workdir + "cobrems_" + fitname + ".log")
+         elif engine == "table":
+            result = table_rates(values)
+         if result is None:
+            doc = job_json(ratequeue.submit(values, engine))
+         else:
+            doc = results_json(values, result)
+   except ValueError as err:
+      doc = {"error": str(err)}
+   print("Content-Type: application/json")
+   print()
+   print(json.dumps(doc))
+
+def print_sums(result):
+   sums = result["sums"]["total"]
+   print("<tr><td>&nbsp;</td></tr>")
+   print("<tr><td><b>Primary peak sum is {0:.6g} </b></td></tr>".format(sums["tagged"]))
+   print("<tr><td><b>Average peak polarization {0:.5f}</b></td></tr>"
+         .format(result["peak_polarization"]))
+   print("<tr><td><b>Background sum is {0:.6g} </b></td></tr>".format(sums["background"]))
+   print("<tr><td><b>Endpoint tagged sum is {0:.6g} </b></td></tr>".format(sums["endpoint"]))
+   print("<tr><td><b>Total beam power/W is {0:.6g} </b></td></tr>".format(sums["beam_power"]))
+   accuracy = result.get("accuracy")
+   if accuracy:
+      worst = max(accuracy[key] for key in accuracy if key != "peak_polarization")
+      print("<tr><td>interpolated from the rate table, sums within {0:.1f}%, "
+            "polarization within {1:.3f}</td></tr>"
+            .format(100 * worst, accuracy.get("peak_polarization", 0)))
+
+def job_url(job):
+   """
+   Url of the page for job, keeping the form parameters of this request.
+   """
+   query = [(key, form.getfirst(key)) for key in form if key not in ("run", "job")]
+   return "ratetool_py.cgi?" + urllib.parse.urlencode(query + [("job", job)])
+
+def print_job_status(record):
+   print("<tr><td colspan=\"2\" align=\"center\">")
+   if record["state"] == "queued":
+      print("Job {0} is waiting in the queue, with {1} job(s) ahead of it."
+            .format(record["id"], record["position"]))
+   else:
+      print("Job {0} is running, for {1:.0f} s so far."
+            .format(record["id"], time.time() - record["started"]))
+   print("This page reloads itself until the results are ready,")
+   print("<a href=\"" + html.escape(job_url(record["id"])) + "\">or reload it now</a>.")
+   print("</td></tr>")
+
+def plot_figure(result, name, ytitle):
+   """
+   Svg plot of one of the spectra in a rates result, drawn as a smooth
+   curve through the bin centers like the paw "c" option.
+   """
+   energy = result["energy"]
+   y = result["rate"]["total"] if name == "rate" else result[name]
+   ylim = (min(0, float(numpy.min(y))), float(numpy.max(y)) * 1.1 or 1)
+   canvas = harpplot.SVGCanvas("rate-" + name, 600, 450,
+                               (float(result["edges"][0]), float(result["edges"][-1])),
+                               ylim, "E&#947; (GeV)", ytitle)
+   canvas.polyline(energy, y)
+   return canvas.svg()
+
+def print_plots(result, files):
+   for name, ytitle in figures:
+      print("<tr><td align=\"center\" colspan=\"2\">")
+      print(plot_figure(result, name, ytitle))
+      print("</td></tr>")
+   for name in files:
+      print("<tr><td align=\"center\" colspan=\"2\">")
+      print("<a href=\"work/" + os.path.basename(name) + "\">")
+      print(name[-4:].lstrip(".") + " file containing the above histograms</a>")
+      print("</td></tr>")
+
+def main(environ=None, name=None):
+   """
+   environ = cgi environment to read the form from (default os.environ)
+   name = unique tag for the output files (default process id)
+   """
+   global form, workdir, fitname, metrics
+   metrics = toolmetrics.Timer("ratetool")
+   workdir = basedir + "/work/"
+   fitname = name or str(os.getpid())
+
+   with metrics.phase("form parsing"):
+      if environ is None:
+         form = cgi.FieldStorage()
+      else:
+         form = cgi.FieldStorage(environ=environ)
+   if form.getfirst("format") == "json":
+      print_json()
+      metrics.finish(format="json")
+      return
+
+   result = None
+   error = None
+   files = None
+   record = None
+   job = form.getfirst("job")
+   if "run" in form:
+      try:
+         with metrics.phase("form parsing"):
+            values = read_parameters()
+         with metrics.phase("engine setup"):
+            engine = engine_choice()
+         if not use_queue:
+            result = compute_rates(values, engine,
+                                   log=workdir + "cobrems_" + fitname + ".log")
+            metrics.info["engine"] = result["engine"]
+         elif engine == "table":
+            with metrics.phase("rate table"):
+               result = table_rates(values)
+         if result is None:
+            with metrics.phase("queue submit"):
+               job = ratequeue.submit(values, engine)
+      except ValueError as err:
+         error = str(err)
+   if result is None and job is not None and error is None:
+      metrics.info["job"] = job
+      record = ratequeue.status(job)
+      if record is None:
+         error = "unknown job " + job
+      elif record["state"] == "done":
+         doc = ratequeue.read_result(job)
+         if doc is None:
+            error = "the results of job " + job + " are no longer available"
+         else:
+            result = result_from_json(doc)
+            files = [workdir + name for name in doc["files"]]
+      elif record["state"] == "failed":
+         error = record["error"]
+
+   if record is not None and record["state"] in ("queued", "running"):
+      print_head(job_url(job))
+   else:
+      print_head()
+   print("<tr valign=\"top\"><td width=\"500\">")
+   print("<table>")
+   for par, desc, default, unit in beam_parameters:
+      set_parameter(par, desc, default, unit)
+   print("</table>")
+   print("</td><td width=\"500\">")
+   print("<table>")
+   for par, desc, default, unit in window_parameters:
+      set_parameter(par, desc, default, unit)
+   if result is not None:
+      print_sums(result)
+   print("</table>")
+   print("</td></tr>")
+   print("<tr height=\"50\"><td align=\"center\" colspan=\"2\">")
+   print("<input type=\"submit\" name=\"run\" value=\"plot collimated beam rate spectrum\" />")
+   print_engine_options()
+   print("</td></tr>")
+   if error is not None:
+      print("<tr><td colspan=\"2\" align=\"center\">")
+      print("<font color=\"red\">")
+      print("Invalid input: " + html.escape(error) + ", please correct it and try again!")
+      print("</font></td></tr>")
+   elif result is not None:
+      if files is None:
+         with metrics.phase("save histograms"):
+            files = save_histograms(result, workdir + "cobrems_" + fitname)
+      with metrics.phase("svg plots"):
+         print_plots(result, files)
+   elif record is not None:
+      print_job_status(record)
+   if form.getfirst("debug"):
+      print(metrics.html(colspan=2))
+   print_tail()
+   metrics.finish()
+
+# main execution starts here
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+#
+# toolmetrics.py - per-request timing of the phases of the harptool,
+#                  harptool_2d and ratetool web tools, with a structured
+#                  log and a prometheus metrics file for the collected
+#                  timings.
+#
+# usage: toolmetrics.py                    (summary of the timings so far)
+#        toolmetrics.py --record TOOL PHASE=SECONDS ...
+#                                          (add the timings of a request
+#                                           made outside of python, such as
+#                                           the paw and h2root steps of
+#                                           ratetool.cgi, as tool ratetool_paw)
+#
+# Each request of a tool is timed by a Timer, which the tool fills with
+# the durations of its phases, from the interpreter startup and imports
+# of a cold cgi start to the fits, bands, plots and external programs.
+# When the request is done the timings are appended as one json line to
+# work/metrics/<tool>.log, which is rotated when it grows beyond
+# max_log_bytes with log_backups old copies kept, and added to latency
+# histograms of each tool and phase that are written out in the
+# prometheus text format to work/metrics/metrics.prom, for collection by
+# the node exporter textfile collector or any other scraper. The tools
+# add the timings to the page when the form has debug=1.
+#
+# author: richard.t.jones at uconn.edu
+# version: october 18, 2026
+
+import os
+import sys
+import json
+import html
+import time
+import fcntl
+import argparse
+import contextlib
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+metricsdir = basedir + "/work/metrics/"
+max_log_bytes = 1024**2
+log_backups = 5
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+startup_phases = {}
+
+def process_age():
+   """
+   Time (s) since this process was started, or None where /proc cannot
+   tell, to 1/CLK_TCK resolution.
+   """
+   try:
+      with open("/proc/self/stat") as f:
+         fields = f.read().rsplit(")", 1)[1].split()
+      with open("/proc/uptime") as f:
+         uptime = float(f.read().split()[0])
+      return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+   except (OSError, ValueError, IndexError):
+      return None
+
+def startup(tool, phases, started, script=False):
+   """
+   Save the startup phases of tool to be added to the first request
+   timed in this process.
+    phases = list of (phase, seconds) for the imports of the tool module
+    started = time.perf_counter() at the start of the imports
+    script = True if the tool is run as a script, so that the time from
+             the process start to started was spent starting the
+             interpreter
+   """
+   phases = list(phases)
+   if script:
+      age = process_age()
+      if age is not None:
+         phases.insert(0, ("interpreter", max(age - (time.perf_counter() - started), 0)))
+   startup_phases[tool] = phases
+
+class Timer:
+   """
+   Durations of the phases of one request of a tool, in the order they
+   were first timed, with the times of a phase that is entered more than
+   once added up. A Timer made with enabled=False times nothing, for the
+   tool functions used outside of a web request.
+   """
+   def __init__(self, tool, enabled=True):
+      self.tool = tool
+      self.enabled = enabled
+      self.phases = []
+      self.info = {}
+      self.start = time.perf_counter()
+      if enabled:
+         self.phases += startup_phases.pop(tool, [])
+
+   @contextlib.contextmanager
+   def phase(self, name):
+      if not self.enabled:
+         yield
+         return
+      start = time.perf_counter()
+      try:
+         yield
+      finally:
+         self.add(name, time.perf_counter() - start)
+
+   def add(self, name, seconds):
+      if not self.enabled:
+         return
+      for i, (phase, total) in enumerate(self.phases):
+         if phase == name:
+            self.phases[i] = (name, total + seconds)
+            return
+      self.phases.append((name, seconds))
+
+   def elapsed(self):
+      return time.perf_counter() - self.start
+
+   def html(self, colspan=5):
+      """
+      Table of the phase timings for the debug view of the page, as a row
+      spanning colspan columns of the page table.
+      """
+      rows = ["<tr><td>" + html.escape(name) + "</td><td align=\"right\">" +
+              "{0:.1f} ms</td></tr>".format(1e3 * seconds)
+              for name, seconds in self.phases]
+      rows.append("<tr><td><b>request so far</b></td><td align=\"right\"><b>" +
+                  "{0:.1f} ms</b></td></tr>".format(1e3 * self.elapsed()))
+      return ("<tr><td colspan=\"" + str(colspan) + "\" align=\"center\">" +
+              "<table border=\"1\">\n" +
+              "<tr><th>phase</th><th>time</th></tr>\n" + "\n".join(rows) +
+              "\n</table></td></tr>")
+
+   def finish(self, **info):
+      """
+      Record the timings of the request, with any info given, in the
+      log and the histograms. Problems with the metrics files are not
+      allowed to fail the request.
+      """
+      if not self.enabled:
+         return
+      self.info.update(info)
+      try:
+         record(self.tool, self.phases, self.elapsed(), self.info)
+      except OSError as err:
+         sys.stderr.write("toolmetrics: cannot record timings: {0}\n".format(err))
+      self.enabled = False
+
+@contextlib.contextmanager
+def locked():
+   os.makedirs(metricsdir, exist_ok=True)
+   with open(metricsdir + "metrics.lock", "a") as lockfile:
+      fcntl.flock(lockfile, fcntl.LOCK_EX)
+      try:
+         yield
+      finally:
+         fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+def rotate(logfile):
+   """
+   Shift logfile to logfile.1, logfile.1 to logfile.2 and so on, dropping
+   the oldest beyond log_backups.
+   """
+   for n in range(log_backups - 1, 0, -1):
+      if os.path.exists(logfile + "." + str(n)):
+         os.replace(logfile + "." + str(n), logfile + "." + str(n + 1))
+   os.replace(logfile, logfile + ".1")
+
+def record(tool, phases, total, info=None):
+   """
+   Append the timings of one request of tool to its log and add them to
+   the histograms.
+    phases = list of (phase, seconds)
+    total = duration (s) of the whole request
+   """
+   entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "tool": tool,
+            "pid": os.getpid(), "total": round(total, 6),
+            "phases": [[name, round(seconds, 6)] for name, seconds in phases]}
+   entry.update(info or {})
+   logfile = metricsdir + tool + ".log"
+   with locked():
+      if os.path.exists(logfile) and os.path.getsize(logfile) > max_log_bytes:
+         rotate(logfile)
+      with open(logfile, "a") as f:
+         f.write(json.dumps(entry) + "\n")
+      hists = read_histograms()
+      observe(hists, tool, "request", total)
+      for name, seconds in phases:
+         observe(hists, tool, name, seconds)
+      write_file(metricsdir + "histograms.json", json.dumps(hists))
+      write_file(metricsdir + "metrics.prom", prometheus(hists))
+
+def read_histograms():
+   try:
+      with open(metricsdir + "histograms.json") as f:
+         return json.load(f)
+   except (OSError, ValueError):
+      return {}
+
+def observe(hists, tool, phase, seconds):
+   """
+   Add one duration to the histogram of a tool phase, kept as counts in
+   each of the buckets plus the overflow, the sum and the count.
+   """
+   key = tool + "/" + phase
+   if key not in hists:
+      hists[key] = {"tool": tool, "phase": phase, "counts": [0] * (len(buckets) + 1),
+                    "sum": 0., "count": 0}
+   h = hists[key]
+   h["counts"][sum(seconds > le for le in buckets)] += 1
+   h["sum"] += seconds
+   h["count"] += 1
+
+def write_file(path, text):
+   with open(path + "." + str(os.getpid()), "w") as f:
+      f.write(text)
+   os.replace(path + "." + str(os.getpid()), path)
+
+def label(value):
+   return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def prometheus(hists):
+   """
+   The histograms in the prometheus text exposition format, as the
+   request latency of each tool and the duration of each of its phases.
+   """
+   lines = []
+   for metric, desc, requests in (
+         ("tool_request_seconds", "Duration of the web tool requests", True),
+         ("tool_phase_seconds", "Duration of the phases of the web tool requests", False)):
+      lines.append("# HELP " + metric + " " + desc)
+      lines.append("# TYPE " + metric + " histogram")
+      for key in sorted(hists):
+         h = hists[key]
+         if (h["phase"] == "request") != requests:
+            continue
+         labels = "tool=\"" + label(h["tool"]) + "\""
+         if not requests:
+            labels += ",phase=\"" + label(h["phase"]) + "\""
+         count = 0
+         for le, n in zip(buckets + ("+Inf",), h["counts"]):
+            count += n
+            lines.append("{0}_bucket{{{1},le=\"{2}\"}} {3}".format(metric, labels, le, count))
+         lines.append("{0}_sum{{{1}}} {2:.6f}".format(metric, labels, h["sum"]))
+         lines.append("{0}_count{{{1}}} {2}".format(metric, labels, h["count"]))
+   return "\n".join(lines) + "\n"
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="web tool timing metrics")
+   parser.add_argument("--record", nargs="+", metavar="ARG",
+                       help="TOOL PHASE=SECONDS ... timings of one request")
+   args = parser.parse_args()
+   if args.record:
+      phases = []
+      for arg in args.record[1:]:
+         name, seconds = arg.rsplit("=", 1)
+         phases.append((name, float(seconds)))
+      record(args.record[0], phases, sum(seconds for name, seconds in phases))
+   else:
+      hists = read_histograms()
+      for key in sorted(hists):
+         h = hists[key]
+         print("{0:12s} {1:28s} {2:7d} requests, mean {3:9.1f} ms".format(
+               h["tool"], h["phase"], h["count"], 1e3 * h["sum"] / h["count"]))